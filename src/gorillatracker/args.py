@@ -69,6 +69,7 @@ class TrainingArgs:
     l2_alpha: float = field(default=0.1)
     l2_beta: float = field(default=0.01)
     path_to_pretrained_weights: Union[str, None] = field(default=None)
+    l2sp_exclude: list[str] = field(default_factory=lambda: [])  # regexes of parameter names L2SP leaves alone
 
     lr_schedule: Literal["linear", "cosine", "exponential", "reduce_on_plateau", "constant"] = field(default="constant")
     warmup_mode: Literal["linear", "cosine", "exponential", "constant"] = field(default="constant")
@@ -142,6 +143,14 @@ class TrainingArgs:
     save_interval: float = field(default=10)
     embedding_save_interval: int = field(default=1)
     knn_with_train: bool = field(default=True)
+    knn_backend: Literal["brute-force", "block", "faiss-hnsw", "faiss-ivf"] = field(default="block")
+    val_loss_chunk_size: int = field(default=4096)
+    train_embedding_cache_policy: Literal["every_n_epochs", "on_checkpoint", "momentum"] = field(
+        default="every_n_epochs"
+    )
+    train_embedding_cache_refresh_interval: int = field(default=1)
+    train_embedding_cache_momentum: float = field(default=0.9)
+    train_embedding_cache_max_size: Union[int, None] = field(default=None)
     plugins: List[str] = list_field(default=None)
 
     # Config and Data Arguments
@@ -151,6 +160,16 @@ class TrainingArgs:
     additional_val_data_dirs: list[str] = field(default_factory=lambda: [])
     dataset_names: list[str] = field(default_factory=lambda: [])
     data_resize_transform: Union[int, None] = field(default=None)
+    sample_cache_memory_mb: float = field(default=1024.0)  # per DataLoader worker
+    sample_cache_store: Literal["none", "shared", "disk"] = field(default="none")
+    sample_cache_store_mb: float = field(default=8192.0)
+    sample_cache_dir: Union[Path, None] = field(default=None)
+    train_batch_sampler: Literal["shuffle", "pk"] = field(default="shuffle")
+    pk_identities: int = field(default=4)  # P, batch_size // P samples per identity
+    pk_video_diverse: bool = field(default=False)
+    loader_profile: Literal["default", "throughput", "low-memory", "debug"] = field(default="default")
+    device_augmentation: bool = field(default=False)  # training augmentation on whole batches on the device
+    loader_autotune_batches: int = field(default=10)  # warmup batches per candidate of the "throughput" profile
 
     # SSL Config
     use_ssl: bool = field(default=False)
@@ -165,6 +184,7 @@ class TrainingArgs:
     height_range: tuple[Union[int, None], Union[int, None]] = field(default=(None, None))
     movement_delta: Union[float, None] = field(default=None)
     forced_train_image_count: Union[int, None] = field(default=None)
+    ssl_snapshot_dir: Union[Path, None] = field(default=None)  # reuse the SSL samplers across runs, see snapshot.py
 
     def __post_init__(self) -> None:
         assert self.num_devices > 0
@@ -0,0 +1,94 @@
+"""Class-balanced P x K batches for online triplet mining."""
+
+from __future__ import annotations
+
+from typing import Iterator, Optional, Sequence, Union
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+from gorillatracker.data.columnar_index import GroupedIndex
+from gorillatracker.type_helper import Label
+
+
+class PKBatchSampler(Sampler[list[int]]):
+    """Batches of `p` identities with `k` samples each, so every sample of a batch has at least one positive.
+
+    Identities are visited in rounds of random permutations, i.e. evenly, and only identities with at least two samples
+    are used. Identities with fewer than `k` samples repeat samples. With `video_ids`, the `k` samples of an identity
+    are drawn round-robin over its (shuffled) videos, spreading the samples over as many videos as possible.
+
+    An epoch has about as many samples as the dataset. The batches only depend on `seed` and the epoch (`set_epoch`),
+    every replica computes the same batches and keeps every `num_replicas`-th, starting at `rank`.
+    """
+
+    def __init__(
+        self,
+        labels: Union[Sequence[Label], np.ndarray],
+        p: int,
+        k: int,
+        video_ids: Optional[Union[Sequence[int], np.ndarray]] = None,
+        seed: int = 0,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+    ) -> None:
+        assert p > 0 and k > 1, "A P x K batch needs at least one identity and two samples per identity"
+        distributed = dist.is_available() and dist.is_initialized()
+        self.num_replicas = num_replicas if num_replicas is not None else dist.get_world_size() if distributed else 1
+        self.rank = rank if rank is not None else dist.get_rank() if distributed else 0
+        assert 0 <= self.rank < self.num_replicas
+        self.p, self.k = p, k
+        self.batch_size = p * k
+        self.seed = seed
+        self.epoch = 0
+
+        by_label = GroupedIndex(np.asarray(labels))
+        videos = np.asarray(video_ids) if video_ids is not None else None
+        # NOTE: per identity, the sample indices of each of its videos (a single group without video ids)
+        self.identity_videos: list[list[np.ndarray]] = []
+        for group in range(len(by_label)):
+            rows = by_label.rows(group)
+            if len(rows) < 2:
+                continue
+            if videos is None:
+                self.identity_videos.append([rows])
+            else:
+                by_video = GroupedIndex(videos[rows])
+                self.identity_videos.append([rows[by_video.rows(v)] for v in range(len(by_video))])
+        assert len(self.identity_videos) >= p, f"Only {len(self.identity_videos)} identities with two samples, p={p}"
+
+        total_batches = len(labels) // self.batch_size
+        self.num_batches = max(1, total_batches // self.num_replicas)
+
+    def __len__(self) -> int:
+        return self.num_batches
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[list[int]]:
+        identities = self._identity_batches(np.random.default_rng([self.seed, self.epoch]))
+        for i in range(self.num_batches * self.num_replicas):
+            batch_identities = next(identities)
+            if i % self.num_replicas == self.rank:
+                # NOTE: a generator per batch, so replicas skip the batches of others without drawing their samples
+                rng = np.random.default_rng([self.seed, self.epoch, i])
+                yield [idx for identity in batch_identities for idx in self._draw_k(identity, rng)]
+
+    def _identity_batches(self, rng: np.random.Generator) -> Iterator[np.ndarray]:
+        n = len(self.identity_videos)
+        while True:
+            permutation = rng.permutation(n)
+            for start in range(0, n - self.p + 1, self.p):
+                yield permutation[start : start + self.p]
+
+    def _draw_k(self, identity: int, rng: np.random.Generator) -> list[int]:
+        videos = [rng.permutation(rows) for rows in self.identity_videos[identity]]
+        videos = [videos[v] for v in rng.permutation(len(videos))]
+        drawn: list[int] = []
+        for depth in range(max(len(rows) for rows in videos)):
+            drawn.extend(int(rows[depth]) for rows in videos if depth < len(rows))
+            if len(drawn) >= self.k:
+                return drawn[: self.k]
+        return drawn + rng.choice(drawn, self.k - len(drawn)).tolist()
@@ -3,6 +3,7 @@ from typing import Literal, Optional, Type, Union
 
 import gorillatracker.type_helper as gtypes
 from gorillatracker.data.combined import CombinedDataset
+from gorillatracker.data.loader_profiles import LoaderProfileName
 from gorillatracker.data.multispecies import MultiSpeciesSupervisedDataset
 from gorillatracker.data.nlet import (
     CrossEncounterSupervisedDataset,
@@ -11,6 +12,7 @@ from gorillatracker.data.nlet import (
     HardCrossEncounterSupervisedDataset,
     HardCrossEncounterSupervisedKFoldDataset,
     NletDataset,
+    ShardedSupervisedDataset,
     SupervisedDataset,
     SupervisedKFoldDataset,
     ValOnlyKFoldDataset,
@@ -20,8 +22,10 @@ from gorillatracker.data.nlet import (
     build_triplet,
 )
 from gorillatracker.data.nlet_dm import NletDataModule
+from gorillatracker.data.sample_cache import SampleCacheConfig
 from gorillatracker.data.ssl import SSLDataset
 from gorillatracker.ssl_pipeline.ssl_config import SSLConfig
+from gorillatracker.transform_utils import BatchAugmentation
 
 HardCrossEncounterSupervisedKFoldDatasetId = "gorillatracker.datasets.kfold_cxl.HardCrossEncounterKFoldCXLDataset"
 HardCrossEncounterSupervisedDatasetId = "gorillatracker.datasets.cxl.HardCrossEncounterCXLDataset"
@@ -29,6 +33,7 @@ CrossEncounterKFoldSupervisedDatasetId = "gorillatracker.datasets.kfold_cxl.Cros
 CrossEncounterSupervisedDatasetId = "gorillatracker.datasets.cxl.CrossEncounterCXLDataset"
 BristolDatasetId = "gorillatracker.datasets.bristol.BristolDataset"
 CXLDatasetId = "gorillatracker.datasets.cxl.CXLDataset"
+ShardedCXLDatasetId = "gorillatracker.datasets.cxl.ShardedCXLDataset"
 CZooDatasetId = "gorillatracker.datasets.chimp.CZooDataset"
 CTaiDatasetId = "gorillatracker.datasets.chimp.CTaiDataset"
 Cows2021DatasetId = "gorillatracker.datasets.cows2021.Cows2021Dataset"
@@ -48,6 +53,7 @@ MultiSpeciesDatasetId = "gorillatracker.datasets.multispecies.MultiSpeciesDatase
 dataset_registry: dict[str, Union[Type[NletDataset], Type[CombinedDataset]]] = {
     BristolDatasetId: SupervisedDataset,
     CXLDatasetId: SupervisedDataset,
+    ShardedCXLDatasetId: ShardedSupervisedDataset,
     KFoldCXLDatasetId: SupervisedKFoldDataset,
     HardCrossEncounterSupervisedKFoldDatasetId: HardCrossEncounterSupervisedKFoldDataset,
     HardCrossEncounterSupervisedDatasetId: HardCrossEncounterSupervisedDataset,
@@ -109,6 +115,14 @@ def build_data_module(
     additional_eval_data_dirs: list[Path] = [],
     dataset_names: list[str] = [],
     ssl_config: Optional[SSLConfig] = None,
+    sample_cache_config: Optional[SampleCacheConfig] = None,
+    train_batch_sampler: Literal["shuffle", "pk"] = "shuffle",
+    pk_identities: int = 4,
+    pk_video_diverse: bool = False,
+    seed: int = 0,
+    loader_profile: LoaderProfileName = "default",
+    loader_autotune_batches: int = 10,
+    device_augmentation: Optional[BatchAugmentation] = None,
 ) -> NletDataModule:
     assert dataset_class_id in dataset_registry, f"Dataset class {dataset_class_id} not found in registry"
     assert all(
@@ -147,4 +161,12 @@ def build_data_module(
         dataset_names=dataset_names,
         eval_data_dirs=additional_eval_data_dirs,
         ssl_config=ssl_config,
+        sample_cache_config=sample_cache_config,
+        train_batch_sampler=train_batch_sampler,
+        pk_identities=pk_identities,
+        pk_video_diverse=pk_video_diverse,
+        seed=seed,
+        loader_profile=loader_profile,
+        loader_autotune_batches=loader_autotune_batches,
+        device_augmentation=device_augmentation,
     )
@@ -0,0 +1,128 @@
+"""Row indices grouped by integer keys, for samplers that draw rows of large tables in constant time."""
+
+from __future__ import annotations
+
+import random
+from itertools import accumulate
+from typing import Optional, Sequence
+
+import numpy as np
+
+
+class GroupedIndex:
+    """Rows grouped by a key in CSR layout: the rows of group g are `order[offsets[g]:offsets[g + 1]]`.
+
+    Groups are the sorted unique keys, rows keep their relative order within a group.
+    """
+
+    def __init__(self, keys: np.ndarray) -> None:
+        self.keys, self.group_of = np.unique(np.asarray(keys), return_inverse=True)
+        self.group_of = self.group_of.reshape(-1)
+        self.order = np.argsort(self.group_of, kind="stable")
+        self.offsets = np.zeros(len(self.keys) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.group_of, minlength=len(self.keys)), out=self.offsets[1:])
+        # NOTE: python lists, scalar indexing of numpy arrays is several times slower per draw
+        self._order: list[int] = self.order.tolist()
+        self._offsets: list[int] = self.offsets.tolist()
+        self._group_of: list[int] = self.group_of.tolist()
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def group(self, row: int) -> int:
+        return self._group_of[row]
+
+    def size(self, group: int) -> int:
+        return self._offsets[group + 1] - self._offsets[group]
+
+    def rows(self, group: int) -> np.ndarray:
+        return self.order[self.offsets[group] : self.offsets[group + 1]]
+
+    def draw(self, group: int, rng: random.Random) -> int:
+        start = self._offsets[group]
+        return self._order[start + rng.randrange(self._offsets[group + 1] - start)]
+
+    def draw_other(self, row: int, rng: random.Random) -> int:
+        """A uniformly drawn other row of the group of `row`, `row` itself if it is alone in its group."""
+        group = self._group_of[row]
+        start, size = self._offsets[group], self.size(group)
+        if size == 1:
+            return row
+        other = self._order[start + rng.randrange(size - 1)]
+        # NOTE: the draw excludes the last row of the group, which stands in for `row`
+        return self._order[start + size - 1] if other == row else other
+
+
+class MultiSpeciesIndex:
+    """Constant time draws over a table of rows with a class label and a species (the dataset of origin).
+
+    - positives: another row with the same label,
+    - negatives: a uniformly drawn other label of the same species, then a row of that label and species,
+    - anchors: a species (by `species_weights`, proportional to the species size by default), then a row of it,
+      uniformly or, with `class_balanced`, first a uniformly drawn class of the species.
+    """
+
+    def __init__(
+        self,
+        labels: np.ndarray,
+        species: Sequence[str],
+        species_weights: Optional[dict[str, float]] = None,
+        class_balanced: bool = False,
+    ) -> None:
+        labels = np.asarray(labels)
+        self.species_names, species_codes = np.unique(np.asarray(species, dtype=object), return_inverse=True)
+        species_codes = species_codes.reshape(-1)
+        self.by_label = GroupedIndex(labels)
+        self.by_species = GroupedIndex(species_codes)
+        # NOTE: a cell is a (species, label) pair, cells are sorted by species so every species is a range of cells
+        self.by_cell = GroupedIndex(species_codes.astype(np.int64) * len(self.by_label) + self.by_label.group_of)
+        cell_species = self.by_cell.keys // len(self.by_label)
+        self.species_cell_offsets = np.searchsorted(cell_species, np.arange(len(self.species_names) + 1))
+        self._species_cell_offsets: list[int] = self.species_cell_offsets.tolist()
+        self._cell_label: list[int] = self.by_label.keys[self.by_cell.keys % len(self.by_label)].tolist()
+
+        self.class_balanced = class_balanced
+        species_sizes = np.diff(self.by_species.offsets)
+        if species_weights is None:
+            weights = species_sizes.astype(np.float64)
+        else:
+            unknown = set(species_weights) - set(self.species_names)
+            assert not unknown, f"Unknown species {sorted(unknown)}, expected some of {list(self.species_names)}"
+            weights = np.array([species_weights.get(name, 0.0) for name in self.species_names], dtype=np.float64)
+        assert (weights >= 0).all() and weights.sum() > 0, "Species weights must be non-negative and not all zero"
+        self.species_probabilities = weights / weights.sum()
+        self._species_cum_weights = list(accumulate(self.species_probabilities.tolist()))
+
+    def positive(self, row: int, rng: random.Random) -> int:
+        return self.by_label.draw_other(row, rng)
+
+    def negative(self, row: int, rng: random.Random) -> int:
+        cell = self.by_cell.group(row)
+        species = self.by_species.group(row)  # NOTE: species codes are 0..S-1, so groups and codes coincide
+        start, end = self._species_cell_offsets[species], self._species_cell_offsets[species + 1]
+        assert end - start > 1, f"Species {self.species_names[species]} has a single class, no negatives"
+        other = start + rng.randrange(end - start - 1)
+        return self.by_cell.draw(other + 1 if other >= cell else other, rng)
+
+    def negative_labels(self, row: int) -> list[int]:
+        cell = self.by_cell.group(row)
+        species = self.by_species.group(row)
+        start, end = self._species_cell_offsets[species], self._species_cell_offsets[species + 1]
+        return [self._cell_label[c] for c in range(start, end) if c != cell]
+
+    def anchor(self, rng: random.Random) -> int:
+        species = rng.choices(range(len(self.species_names)), cum_weights=self._species_cum_weights)[0]
+        if not self.class_balanced:
+            return self.by_species.draw(species, rng)
+        start, end = self._species_cell_offsets[species], self._species_cell_offsets[species + 1]
+        return self.by_cell.draw(start + rng.randrange(end - start), rng)
+
+    def anchor_weights(self) -> np.ndarray:
+        """Probability of every row under `anchor`, e.g. for a `WeightedRandomSampler`."""
+        species_of_row = self.by_species.group_of
+        if not self.class_balanced:
+            rows_in_species = np.diff(self.by_species.offsets)[self.by_species.group_of]
+            return self.species_probabilities[species_of_row] / rows_in_species
+        cells_in_species = np.diff(self.species_cell_offsets)[species_of_row]
+        rows_in_cell = np.diff(self.by_cell.offsets)[self.by_cell.group_of]
+        return self.species_probabilities[species_of_row] / cells_in_species / rows_in_cell
@@ -1,6 +1,5 @@
-from functools import lru_cache
 from pathlib import Path
-from typing import Any, Callable, Literal, Optional, Type, Union
+from typing import Any, Callable, Hashable, Literal, Optional, Type, Union
 
 import torch
 from PIL import Image
@@ -9,6 +8,7 @@ from torchvision import transforms
 from gorillatracker import type_helper as gtypes
 from gorillatracker.data.contrastive_sampler import ContrastiveImage, ContrastiveSampler, FlatNlet
 from gorillatracker.data.nlet import NletDataset, SupervisedDataset
+from gorillatracker.data.sample_cache import SampleCacheConfig, create_sample_cache, transform_fingerprint
 from gorillatracker.data.ssl import SSLDataset
 from gorillatracker.ssl_pipeline.ssl_config import SSLConfig
 from gorillatracker.transform_utils import SquarePad
@@ -35,6 +35,9 @@ class CombinedRandomSampler(ContrastiveSampler):
     def __len__(self) -> int:
         return len(self.sampler_1) + len(self.sampler_2) if self.sampler_2 is not None else len(self.sampler_1)
 
+    def _lookup_key(self) -> Hashable:
+        return id(self.sampler_1), id(self.sampler_2), len(self)
+
     @property
     def class_labels(self) -> list[gtypes.Label]:
         return (
@@ -66,12 +69,22 @@ class CombinedDataset:
         ssl_config: Optional[SSLConfig] = None,
         dataset1_cls: Type[NletDataset] = SSLDataset,
         dataset2_cls: Type[NletDataset] = SupervisedDataset,
+        sample_cache_config: Optional[SampleCacheConfig] = None,
         **kwargs: Any,
     ) -> None:
         """The first dataset will additionally be used for validation. base_dir format: Path1:Path2"""
         self.transform: Callable[[Image.Image], torch.Tensor] = transforms.Compose([self.get_transforms(), transform])
         self.partition = partition
         self.nlet_builder = nlet_builder
+        # NOTE: only this dataset caches, the wrapped datasets are never indexed directly
+        self.sample_cache = create_sample_cache(
+            sample_cache_config,
+            partition,
+            type(self).__name__,
+            base_dir,
+            getattr(nlet_builder, "__name__", nlet_builder),
+            transform_fingerprint(self.transform),
+        )
         path_1, path_2 = str(base_dir).split(":")
         if partition == "train":
             self.dataset_1 = dataset1_cls(
@@ -129,15 +142,11 @@ class CombinedDataset:
 
     def __getitem__(self, idx: int) -> Union[Nlet, NletWithDSID]:
         # NOTE(memben): We want to cache the nlets for the validation and test sets
-        if self.partition in {"val", "test"}:
-            return self._get_cached_item(idx)
+        if self.sample_cache is not None:
+            return self.sample_cache.get_or_compute(idx, lambda: self._get_item(idx))
         else:
             return self._get_item(idx)
 
-    @lru_cache(maxsize=None)
-    def _get_cached_item(self, idx: int) -> Union[Nlet, NletWithDSID]:
-        return self._get_item(idx)
-
     def _get_item(self, idx: int) -> Union[Nlet, NletWithDSID]:
         flat_nlet: Union[FlatNletWithDSID, FlatNlet] = self.nlet_builder(idx, self.contrastive_sampler)
         if self.partition in {"val", "test"}:
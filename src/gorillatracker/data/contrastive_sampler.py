@@ -1,15 +1,19 @@
 import logging
 import random
 from abc import ABC, abstractmethod
+from array import array
 from collections import defaultdict
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Iterator
+from typing import Hashable, Iterable, Iterator, Optional, Sequence
 
+import numpy as np
+import torch
 from PIL import Image
 
 import gorillatracker.type_helper as gtypes
-from gorillatracker.ssl_pipeline.data_structures import IndexedCliqueGraph
+from gorillatracker.data.columnar_index import GroupedIndex
+from gorillatracker.ssl_pipeline.data_structures import IndexedCliqueGraph, MultiLayerCliqueGraph
 from gorillatracker.type_helper import Id, Label
 
 logger = logging.getLogger(__name__)
@@ -38,7 +42,16 @@ def group_contrastive_images(
     return classes
 
 
+@dataclass
+class SamplerLookupIndex:
+    key: Hashable
+    id_to_index: dict[Id, int]
+    label_to_index: dict[Label, int]
+
+
 class ContrastiveSampler(ABC):
+    _lookup_index: Optional[SamplerLookupIndex] = None
+
     @abstractmethod
     def __getitem__(self, idx: int) -> ContrastiveImage:
         pass
@@ -72,21 +85,156 @@ class ContrastiveSampler(ABC):
         """Return all possible negative labels for a sample"""
         pass
 
-    # HACK(memben): ...
+    def _lookup_key(self) -> Hashable:
+        """Changes whenever the samples change, the lookup index is rebuilt then. Samplers mutated in a way this key
+        does not capture must call `invalidate_lookup_index`."""
+        return len(self)
+
+    @property
+    def lookup_index(self) -> SamplerLookupIndex:
+        """Lazily built id -> index and label -> first index of the samples, a single pass over the sampler."""
+        key = self._lookup_key()
+        lookup_index = self._lookup_index
+        if lookup_index is None or lookup_index.key != key:
+            lookup_index = SamplerLookupIndex(key, {}, {})
+            for idx, item in enumerate(self):
+                # NOTE: CombinedRandomSampler yields (image, dataset id) tuples
+                image = item[0] if isinstance(item, tuple) else item
+                lookup_index.id_to_index.setdefault(image.id, idx)
+                lookup_index.label_to_index.setdefault(image.class_label, idx)
+            self._lookup_index = lookup_index
+        return lookup_index
+
+    def invalidate_lookup_index(self) -> None:
+        self._lookup_index = None
+
+    def index_of(self, id: Id) -> int:
+        return self.lookup_index.id_to_index[id]
+
+    def indices_of(self, ids: Iterable[Id], device: torch.device | str = "cpu") -> torch.Tensor:
+        """Sample indices of the ids as a long tensor, raises a KeyError for unknown ids."""
+        id_to_index = self.lookup_index.id_to_index
+        return torch.tensor([id_to_index[id] for id in ids], dtype=torch.long, device=device)
+
+    def first_indices(self, labels: Iterable[Label], device: torch.device | str = "cpu") -> torch.Tensor:
+        """Index of the first sample of every label as a long tensor, raises a KeyError for unknown labels."""
+        label_to_index = self.lookup_index.label_to_index
+        return torch.tensor([label_to_index[label] for label in labels], dtype=torch.long, device=device)
+
     def find_any_image(self, label: Label) -> ContrastiveImage:
-        for image in self:
-            if image.class_label == label:
-                return image
-        raise ValueError(f"No image found for label {label}")
+        idx = self.lookup_index.label_to_index.get(label)
+        if idx is None:
+            raise ValueError(f"No image found for label {label}")
+        return self[idx]
+
+    def find_any_images(self, labels: Iterable[Label]) -> dict[Label, ContrastiveImage]:
+        """Like `find_any_image` for many labels at once."""
+        label_to_index = self.lookup_index.label_to_index
+        labels = list(labels)
+        missing = [label for label in labels if label not in label_to_index]
+        if missing:
+            raise ValueError(f"No image found for labels {sorted(missing)}")
+        return {label: self[label_to_index[label]] for label in labels}
+
+
+class ClassIndex:
+    """Integer index over the samples of a `ContrastiveClassSampler` for O(1) positive and negative draws.
+
+    All samples are laid out in `order`, grouped by class so every class is one contiguous range. With
+    `group_by_video`, the samples of a class are additionally grouped by individual video, so the cross-video positives
+    of a sample are its class range without its video range.
+    """
+
+    def __init__(self, classes: dict[gtypes.Label, list[ContrastiveImage]], group_by_video: bool = False) -> None:
+        self.labels = list(classes.keys())
+        self.order: list[ContrastiveImage] = []
+        self.class_start = array("q")
+        self.class_size = array("q")
+        self.video_start = array("q")  # NOTE: per position in `order`, only filled with `group_by_video`
+        self.video_size = array("q")
+        for samples in classes.values():
+            self.class_start.append(len(self.order))
+            self.class_size.append(len(samples))
+            if group_by_video:
+                self._add_videos(samples)
+            else:
+                self.order.extend(samples)
+        self.class_of = array("q", (c for c, size in enumerate(self.class_size) for _ in range(size)))
+        self.position = {sample: i for i, sample in enumerate(self.order)}
+
+    def _add_videos(self, samples: list[ContrastiveImage]) -> None:
+        videos: defaultdict[int, list[ContrastiveImage]] = defaultdict(list)
+        for sample in samples:
+            videos[video_id_encoder.encode(sample.id)[1]].append(sample)
+        for video_samples in videos.values():
+            start = len(self.order)
+            self.order.extend(video_samples)
+            self.video_start.extend([start] * len(video_samples))
+            self.video_size.extend([len(video_samples)] * len(video_samples))
+
+    def class_index(self, sample: ContrastiveImage) -> int:
+        return self.class_of[self.position[sample]]
+
+    def positive(self, sample: ContrastiveImage, rng: random.Random) -> ContrastiveImage:
+        """A uniformly drawn other sample of the class, the sample itself for single-sample classes."""
+        p = self.position[sample]
+        c = self.class_of[p]
+        size = self.class_size[c]
+        if size == 1:
+            return sample
+        i = self.class_start[c] + rng.randrange(size - 1)
+        return self.order[i + 1 if i >= p else i]  # NOTE: skips the sample itself
+
+    def cross_video_positive(self, sample: ContrastiveImage, rng: random.Random) -> ContrastiveImage:
+        """A uniformly drawn sample of the class from another video, falls back to `positive` for single-video classes."""
+        p = self.position[sample]
+        video_start, video_size = self.video_start[p], self.video_size[p]
+        c = self.class_of[p]
+        eligible = self.class_size[c] - video_size
+        if eligible == 0:
+            return self.positive(sample, rng)
+        i = self.class_start[c] + rng.randrange(eligible)
+        return self.order[i + video_size if i >= video_start else i]  # NOTE: skips the video range of the sample
+
+    def negative(self, sample: ContrastiveImage, rng: random.Random) -> ContrastiveImage:
+        """A uniformly drawn other class, then a uniformly drawn sample of that class."""
+        c = self.class_of[self.position[sample]]
+        n = rng.randrange(len(self.labels) - 1)
+        if n >= c:
+            n += 1
+        return self.order[self.class_start[n] + rng.randrange(self.class_size[n])]
+
+    def negative_classes(self, sample: ContrastiveImage) -> list[Label]:
+        c = self.class_index(sample)
+        return self.labels[:c] + self.labels[c + 1 :]
+
+
+class _ModuleRandom(random.Random):
+    """A `random.Random` that draws from the generator of the `random` module (all its methods build on these two)."""
+
+    def random(self) -> float:
+        return random.random()
+
+    def getrandbits(self, k: int) -> int:
+        return random.getrandbits(k)
+
+
+def sampler_rng(seed: Optional[int] = None) -> random.Random:
+    # NOTE: without a seed, use the generator of the `random` module, which `seed_everything` and every DataLoader
+    # worker (re)seed, a private generator would be copied into every worker and draw the same sequence there
+    return random.Random(seed) if seed is not None else _ModuleRandom()
 
 
 class ContrastiveClassSampler(ContrastiveSampler):
     """ContrastiveSampler that samples from a set of classes. Negatives are drawn from a uniformly sampled negative class"""
 
-    def __init__(self, classes: dict[gtypes.Label, list[ContrastiveImage]]) -> None:
+    group_by_video = False
+
+    def __init__(self, classes: dict[gtypes.Label, list[ContrastiveImage]], seed: Optional[int] = None) -> None:
         self.classes = classes
         self.samples = [sample for samples in classes.values() for sample in samples]
         self.sample_to_class = {sample: label for label, samples in classes.items() for sample in samples}
+        self.rng = sampler_rng(seed)
 
         # assert all([len(samples) > 1 for samples in classes.values()]), "Classes must have at least two samples" # TODO(memben)
         for label, samples in classes.items():
@@ -94,6 +242,7 @@ class ContrastiveClassSampler(ContrastiveSampler):
                 logger.warning(f"Class {label} has less than two samples (samples: {len(samples)}).")
 
         assert len(self.samples) == len(set(self.samples)), "Samples must be unique"
+        self.index = ClassIndex(classes, group_by_video=self.group_by_video)
 
     def __getitem__(self, idx: int) -> ContrastiveImage:
         return self.samples[idx]
@@ -101,37 +250,35 @@ class ContrastiveClassSampler(ContrastiveSampler):
     def __len__(self) -> int:
         return len(self.samples)
 
+    def _lookup_key(self) -> Hashable:
+        return id(self.samples), len(self.samples)
+
     @property
     def class_labels(self) -> list[gtypes.Label]:
-        return list(self.classes.keys())
+        return list(self.index.labels)
 
     def positive(self, sample: ContrastiveImage) -> ContrastiveImage:
-        positive_class = self.sample_to_class[sample]
-        if len(self.classes[positive_class]) == 1:
-            # logger.warning(f"Only one sample in class {positive_class}. Returning same sample as positive.")
-            return sample
-        positives = [s for s in self.classes[positive_class] if s != sample]
-        return random.choice(positives)
+        return self.index.positive(sample, self.rng)
 
     # NOTE(memben): First samples a negative class to ensure a more balanced distribution of negatives,
     # independent of the number of samples per class
     def negative(self, sample: ContrastiveImage) -> ContrastiveImage:
         """Different class is sampled uniformly at random and a random sample from that class is returned"""
-        negative_class = random.choice(self.negative_classes(sample))
-        negatives = self.classes[negative_class]
-        return random.choice(negatives)
+        if type(self).negative_classes is not ContrastiveClassSampler.negative_classes:
+            # NOTE: subclasses restricting the negative classes are respected, at O(#classes) per draw
+            negative_class = self.rng.choice(self.negative_classes(sample))
+            return self.rng.choice(self.classes[negative_class])
+        return self.index.negative(sample, self.rng)
 
     def negative_classes(self, sample: ContrastiveImage) -> list[Label]:
-        positive_class = self.sample_to_class[sample]
-        negative_classes = [c for c in self.class_labels if c != positive_class]
-        return negative_classes
+        return self.index.negative_classes(sample)
 
 
 class ContrastiveKFoldValSampler(ContrastiveClassSampler):
     k: int
 
-    def __init__(self, classes: dict[gtypes.Label, list[ContrastiveImage]], k: int) -> None:
-        super().__init__(classes)
+    def __init__(self, classes: dict[gtypes.Label, list[ContrastiveImage]], k: int, seed: Optional[int] = None) -> None:
+        super().__init__(classes, seed)
         self.k = k
 
     def get_fold(self, label: Label) -> int:
@@ -141,66 +288,39 @@ class ContrastiveKFoldValSampler(ContrastiveClassSampler):
 
 
 class SupervisedCrossEncounterSampler(ContrastiveClassSampler):
-    def __init__(self, classes: dict[gtypes.Label, list[ContrastiveImage]]) -> None:
-        super().__init__(classes)
+    """Positives are drawn from other individual videos of the class, if the class has more than one video."""
 
-        self.class_to_individual_video_id = defaultdict(set)
-        for label, samples in classes.items():
-            for sample in samples:
-                individual_video_id = get_individual_video_id(sample.id)
-                self.class_to_individual_video_id[label].add(individual_video_id)
+    group_by_video = True
 
     def positive(self, sample: ContrastiveImage) -> ContrastiveImage:
-        positive_class = self.sample_to_class[sample]
-        if len(self.classes[positive_class]) == 1:
-            return sample
-
-        if len(self.class_to_individual_video_id[positive_class]) == 1:
-            positives = [s for s in self.classes[positive_class] if s != sample]
-        else:
-            positives = [s for s in self.classes[positive_class] if s != sample]
-            positives = [s for s in positives if get_individual_video_id(s.id) != get_individual_video_id(sample.id)]
-        return random.choice(positives)
+        return self.index.cross_video_positive(sample, self.rng)
 
 
 class SupervisedHardCrossEncounterSampler(ContrastiveClassSampler):
-    def __init__(self, classes: dict[gtypes.Label, list[ContrastiveImage]]) -> None:
-        super().__init__(classes)
+    """Like `SupervisedCrossEncounterSampler`, but classes with a single individual video are dropped entirely."""
 
-        self.class_to_individual_video_id = defaultdict(set)
-        for label, samples in classes.items():
-            for sample in samples:
-                self.class_to_individual_video_id[label].add(get_individual_video_id(sample.id))
-
-        # NOTE: we overwrite sample, sample_to_class, and classes to only include samples with more than one individual video id
-        self.classes = {
-            label: samples
-            for label, samples in self.classes.items()
-            if len(self.class_to_individual_video_id[label]) > 1
+    group_by_video = True
+
+    def __init__(self, classes: dict[gtypes.Label, list[ContrastiveImage]], seed: Optional[int] = None) -> None:
+        individual_video_ids = {
+            label: {video_id_encoder.encode(sample.id)[1] for sample in samples} for label, samples in classes.items()
         }
-        self.samples = [sample for samples in self.classes.values() for sample in samples]
-        self.sample_to_class = {sample: label for label, samples in self.classes.items() for sample in samples}
+        super().__init__(
+            {label: samples for label, samples in classes.items() if len(individual_video_ids[label]) > 1}, seed
+        )
 
         logger.info(f"Number of classes: {len(self.classes)}")
         logger.info(f"Number of samples: {len(self.samples)}")
 
     def positive(self, sample: ContrastiveImage) -> ContrastiveImage:
-        positive_class = self.sample_to_class[sample]
-        if len(self.classes[positive_class]) == 1:
-            return sample
-
-        assert (
-            len(self.class_to_individual_video_id[positive_class]) > 1
-        ), "Positive class must have more than one individual video id"
-
-        positives = [s for s in self.classes[positive_class] if s != sample]
-        positives = [s for s in positives if get_individual_video_id(s.id) != get_individual_video_id(sample.id)]
-        return random.choice(positives)
+        return self.index.cross_video_positive(sample, self.rng)
 
 
 class CliqueGraphSampler(ContrastiveSampler):
     def __init__(self, graph: IndexedCliqueGraph[ContrastiveImage]):
         self.graph = graph
+        if isinstance(graph, MultiLayerCliqueGraph):
+            graph.adjacency()  # NOTE: built before the DataLoader workers fork, so they share it
 
     def __getitem__(self, idx: int) -> ContrastiveImage:
         return self.graph[idx]
@@ -208,6 +328,9 @@ class CliqueGraphSampler(ContrastiveSampler):
     def __len__(self) -> int:
         return len(self.graph)
 
+    def _lookup_key(self) -> Hashable:
+        return id(self.graph), len(self.graph)
+
     @property
     def class_labels(self) -> list[gtypes.Label]:
         raise NotImplementedError("No logic yet implemented")
@@ -225,6 +348,75 @@ class CliqueGraphSampler(ContrastiveSampler):
         return [root.class_label for root in adjacent_cliques.keys()]
 
 
+class CliqueGroupSampler(ContrastiveSampler):
+    """Cliques of images (positives) that belong to groups, e.g. the trackings of videos. Negatives of an image are the
+    images of the groups partitioned from its group, drawn uniformly over all those images.
+
+    This is the flat form of the two-layer (clique = group = tracking) and three-layer (clique = tracking, group =
+    video) clique graphs of the SSL pipeline, see `CliqueGraphBuilder`. All indices are numpy arrays, which forked
+    DataLoader workers share.
+    """
+
+    def __init__(
+        self,
+        images: Sequence[ContrastiveImage],
+        cliques: Sequence[int],
+        groups: Sequence[int],
+        negative_groups: Sequence[tuple[int, int]],
+        seed: Optional[int] = None,
+    ) -> None:
+        assert len(images) == len(cliques) == len(groups), "Every image needs a clique and a group"
+        self.images = list(images)
+        self.cliques, self.groups = np.asarray(cliques, dtype=np.int64), np.asarray(groups, dtype=np.int64)
+        self.negative_groups = negative_groups
+        self.rng = sampler_rng(seed)
+        self.by_clique = GroupedIndex(self.cliques)
+        self.by_group = GroupedIndex(self.groups)
+
+        # NOTE: the negative groups of group g are targets[offsets[g]:offsets[g + 1]], weighted by their image counts
+        group_of_key = {key: g for g, key in enumerate(self.by_group.keys.tolist())}
+        pairs = [
+            (group_of_key[a], group_of_key[b]) for a, b in negative_groups if a in group_of_key and b in group_of_key
+        ]
+        sources = np.array([p for a, b in pairs for p in (a, b)], dtype=np.int64)
+        targets = np.array([p for a, b in pairs for p in (b, a)], dtype=np.int64)
+        order = np.argsort(sources, kind="stable")
+        self.negative_targets = targets[order]
+        self.negative_offsets = np.zeros(len(self.by_group) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(self.by_group)), out=self.negative_offsets[1:])
+        self.negative_cum_sizes = np.cumsum(np.diff(self.by_group.offsets)[self.negative_targets])
+
+    def __getitem__(self, idx: int) -> ContrastiveImage:
+        return self.images[idx]
+
+    def __len__(self) -> int:
+        return len(self.images)
+
+    @property
+    def class_labels(self) -> list[gtypes.Label]:
+        return list(dict.fromkeys(image.class_label for image in self.images))
+
+    def positive(self, sample: ContrastiveImage) -> ContrastiveImage:
+        return self.images[self.by_clique.draw_other(self.index_of(sample.id), self.rng)]
+
+    def negative(self, sample: ContrastiveImage) -> ContrastiveImage:
+        group = self.by_group.group(self.index_of(sample.id))
+        start, end = int(self.negative_offsets[group]), int(self.negative_offsets[group + 1])
+        if start == end:
+            raise IndexError(f"{sample} has no negatives")
+        base = int(self.negative_cum_sizes[start - 1]) if start else 0
+        # NOTE: a uniformly drawn image of all negative groups, i.e. a group drawn proportional to its size
+        drawn = base + self.rng.randrange(int(self.negative_cum_sizes[end - 1]) - base)
+        target = start + int(np.searchsorted(self.negative_cum_sizes[start:end], drawn, side="right"))
+        return self.images[self.by_group.draw(int(self.negative_targets[target]), self.rng)]
+
+    def negative_classes(self, sample: ContrastiveImage) -> list[Label]:
+        group = self.by_group.group(self.index_of(sample.id))
+        targets = self.negative_targets[self.negative_offsets[group] : self.negative_offsets[group + 1]]
+        rows = [row for target in targets.tolist() for row in self.by_group.rows(target).tolist()]
+        return list(dict.fromkeys(self.images[row].class_label for row in rows))
+
+
 def get_individual(id: gtypes.Id) -> str:
     file_name = Path(id).name
     return file_name.split("_")[0].upper()
@@ -233,3 +425,37 @@ def get_individual(id: gtypes.Id) -> str:
 def get_individual_video_id(id: gtypes.Id) -> str:
     file_name = Path(id).stem
     return "".join(file_name.upper().split("_")[:3])  # <ID><CAMERA><DATE>
+
+
+class VideoIdEncoder:
+    """Maps ids to integer codes of their individual and individual video (see `get_individual_video_id`).
+
+    Every id is parsed only once, afterwards its codes are a dictionary lookup. Codes are assigned in order of first
+    appearance and stay stable for the lifetime of the encoder, so masks can be built with a single tensor comparison.
+    """
+
+    def __init__(self) -> None:
+        self.individuals: dict[str, int] = {}
+        self.videos: dict[str, int] = {}
+        self._codes: dict[Id, tuple[int, int]] = {}
+
+    def encode(self, id: Id) -> tuple[int, int]:
+        """Returns the (individual code, video code) of the id."""
+        codes = self._codes.get(id)
+        if codes is None:
+            individual = self.individuals.setdefault(get_individual(id), len(self.individuals))
+            video = self.videos.setdefault(get_individual_video_id(id), len(self.videos))
+            codes = self._codes[id] = (individual, video)
+        return codes
+
+    def encode_list(self, ids: Sequence[Id], device: torch.device | str = "cpu") -> tuple[torch.Tensor, torch.Tensor]:
+        """Returns the individual codes and the video codes of the ids as two long tensors of shape (len(ids),)."""
+        codes = [self.encode(id) for id in ids]
+        if not codes:
+            return torch.empty(0, dtype=torch.long, device=device), torch.empty(0, dtype=torch.long, device=device)
+        individual_codes, video_codes = torch.tensor(codes, dtype=torch.long, device=device).unbind(dim=1)
+        return individual_codes, video_codes
+
+
+# NOTE: shared between datasets, losses and metrics so every id is parsed once per process
+video_id_encoder = VideoIdEncoder()
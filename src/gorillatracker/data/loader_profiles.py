@@ -0,0 +1,114 @@
+"""Named DataLoader settings for the NletDataModule and a warmup based tuner for workers and prefetch depth.
+
+Profiles:
+- "default": the plain DataLoaders, `workers` worker processes that are restarted every epoch.
+- "throughput": pinned memory, persistent workers, deeper prefetching and auto-tuned worker count and prefetch depth.
+- "low-memory": at most two workers with a single prefetched batch each, no pinned memory.
+- "debug": loading in the main process, so breakpoints and stack traces work.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import time
+from dataclasses import dataclass, replace
+from itertools import islice
+from typing import Any, Callable, Literal, Optional
+
+import torch
+from lightning.fabric.utilities.seed import pl_worker_init_function
+from torch.utils.data import DataLoader
+
+logger = logging.getLogger(__name__)
+
+LoaderProfileName = Literal["default", "throughput", "low-memory", "debug"]
+
+
+@dataclass(frozen=True)
+class LoaderProfile:
+    workers: Optional[int] = None  # None: the `workers` of the data module
+    max_workers: Optional[int] = None
+    pin_memory: bool = False
+    persistent_workers: bool = False
+    prefetch_factor: Optional[int] = None  # batches per worker, None: the DataLoader default
+    autotune: bool = False
+
+    def resolve_workers(self, workers: int) -> int:
+        resolved = self.workers if self.workers is not None else workers
+        return min(resolved, self.max_workers) if self.max_workers is not None else resolved
+
+    def dataloader_kwargs(self, workers: int) -> dict[str, Any]:
+        num_workers = self.resolve_workers(workers)
+        kwargs: dict[str, Any] = {
+            "num_workers": num_workers,
+            "pin_memory": self.pin_memory and torch.cuda.is_available(),
+        }
+        if num_workers > 0:
+            kwargs["persistent_workers"] = self.persistent_workers
+            kwargs["prefetch_factor"] = self.prefetch_factor
+            if self.persistent_workers or self.prefetch_factor is not None:
+                kwargs["worker_init_fn"] = worker_init_fn
+        return kwargs
+
+
+LOADER_PROFILES: dict[str, LoaderProfile] = {
+    "default": LoaderProfile(),
+    "throughput": LoaderProfile(pin_memory=True, persistent_workers=True, prefetch_factor=4, autotune=True),
+    "low-memory": LoaderProfile(max_workers=2, prefetch_factor=1),
+    "debug": LoaderProfile(workers=0),
+}
+
+
+def get_loader_profile(name: str) -> LoaderProfile:
+    assert name in LOADER_PROFILES, f"Unknown loader profile {name}, expected one of {list(LOADER_PROFILES)}"
+    return LOADER_PROFILES[name]
+
+
+def worker_init_fn(worker_id: int) -> None:
+    # NOTE: every worker would otherwise use as many intra-op threads as there are cores
+    torch.set_num_threads(1)
+    pl_worker_init_function(worker_id)  # NOTE: replaces the seeding Lightning injects without a worker_init_fn
+
+
+def measure_batches_per_second(loader: DataLoader[Any], batches: int, skip: int = 1) -> float:
+    """Batches per second over `batches` batches, the first `skip` batches (worker startup) are not timed."""
+    iterator = iter(loader)
+    for _ in islice(iterator, skip):
+        pass
+    start = time.perf_counter()
+    measured = sum(1 for _ in islice(iterator, batches))
+    elapsed = time.perf_counter() - start
+    return measured / elapsed if measured and elapsed > 0 else 0.0
+
+
+def autotune_loader_profile(
+    profile: LoaderProfile,
+    make_loader: Callable[[dict[str, Any]], DataLoader[Any]],
+    max_workers: Optional[int] = None,
+    prefetch_factors: tuple[int, ...] = (2, 4),
+    warmup_batches: int = 10,
+) -> LoaderProfile:
+    """Picks the worker count (0 and powers of two up to the available cores) and prefetch depth with the highest
+    batches/s measured on loaders built by `make_loader` from DataLoader kwargs.
+
+    Worker counts are tried in increasing order, the search stops once more workers are not at least 5% faster.
+    """
+    if max_workers is None:
+        max_workers = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    candidates = [0] + [2**i for i in range(max_workers.bit_length()) if 2**i <= max_workers]
+    best, best_rate = replace(profile, workers=0, max_workers=None, autotune=False), 0.0
+    for workers in candidates:
+        improved = False
+        for prefetch_factor in prefetch_factors if workers > 0 else (None,):
+            candidate = replace(best, workers=workers, prefetch_factor=prefetch_factor)
+            # NOTE: persistent workers would outlive the measurement
+            loader = make_loader({**candidate.dataloader_kwargs(workers), "persistent_workers": False})
+            rate = measure_batches_per_second(loader, warmup_batches)
+            logger.info(f"Loader autotune: workers={workers} prefetch_factor={prefetch_factor}: {rate:.2f} batches/s")
+            if rate > best_rate * 1.05:
+                best, best_rate, improved = candidate, rate, True
+        if not improved and workers > 0:
+            break
+    logger.info(f"Loader autotune picked workers={best.workers} prefetch_factor={best.prefetch_factor}")
+    return best
@@ -1,14 +1,16 @@
 import logging
-import random
 from pathlib import Path
+from typing import Any, Optional
 
 import pandas as pd
+import torch
 from PIL import Image
 from torch import Tensor
 from wildlife_datasets import datasets, loader
 
 import gorillatracker.type_helper as gtypes
-from gorillatracker.data.contrastive_sampler import ContrastiveImage, ContrastiveSampler, FlatNlet
+from gorillatracker.data.columnar_index import MultiSpeciesIndex
+from gorillatracker.data.contrastive_sampler import ContrastiveImage, ContrastiveSampler, FlatNlet, sampler_rng
 from gorillatracker.data.nlet import NletDataset
 from gorillatracker.type_helper import Id, Label, Nlet
 from gorillatracker.utils.labelencoder import LabelEncoder
@@ -67,65 +69,58 @@ def get_ds_dfs() -> pd.DataFrame:
 
 
 class MultiSpeciesContrastiveSampler(ContrastiveSampler):
-    def __init__(self, base_dir: Path) -> None:
+    """Samples of the wildlife_datasets frames from `get_ds_dfs`, the frame is turned into arrays once (see
+    `MultiSpeciesIndex`) so no draw filters the frame. Negatives are always of the same species (origin)."""
+
+    def __init__(
+        self,
+        base_dir: Path,
+        species_weights: Optional[dict[str, float]] = None,
+        class_balanced: bool = False,
+        seed: Optional[int] = None,
+    ) -> None:
         self.base_dir = base_dir
         self.ds = get_ds_dfs()
+        self.paths: list[str] = self.ds["path"].tolist()
+        self.labels: list[Label] = self.ds["label"].tolist()
+        self._class_labels: list[Label] = self.ds["label"].unique().tolist()
+        self.bboxes: Optional[list[Any]] = self.ds["bbox"].tolist() if "bbox" in self.ds.columns else None
+        self.index = MultiSpeciesIndex(
+            self.ds["label"].to_numpy(), self.ds["origin"].tolist(), species_weights, class_balanced
+        )
+        self.rng = sampler_rng(seed)
 
     def __getitem__(self, idx: int) -> ContrastiveImage:
-        img = ContrastiveImage(
-            id=str(idx),
-            image_path=self.base_dir / self.ds.loc[idx, "path"],
-            class_label=self.ds.loc[idx, "label"],
-        )
-        return img
+        return ContrastiveImage(id=str(idx), image_path=self.base_dir / self.paths[idx], class_label=self.labels[idx])
 
     def __len__(self) -> int:
-        return len(self.ds)
+        return len(self.paths)
 
     @property
     def class_labels(self) -> list[gtypes.Label]:
-        return self.ds["label"].unique().tolist()
+        return list(self._class_labels)
+
+    def bbox(self, sample: ContrastiveImage) -> Optional[list[float]]:
+        bbox = self.bboxes[int(sample.id)] if self.bboxes is not None else None
+        return bbox if isinstance(bbox, list) else None
 
     def positive(
         self, sample: ContrastiveImage
     ) -> ContrastiveImage:  # must map whatever __getitem__ returns to another sample
-        positive_class = sample.class_label
-        if len(self.ds[self.ds["label"] == positive_class]) == 1:
-            # logger.warning(f"Only one sample in class {positive_class}. Returning same sample as positive.")
-            return sample
-        positive_indices = self.ds[self.ds["label"] == positive_class].index
-        positive_indices = positive_indices[positive_indices != sample.id]
-        positive_index = random.choice(positive_indices)
-        sample_row = self.ds.loc[positive_index]
-        sample = ContrastiveImage(
-            id=str(positive_index),
-            image_path=self.base_dir / sample_row["path"],
-            class_label=sample_row["label"],
-        )
-        return sample
+        return self[self.index.positive(int(sample.id), self.rng)]
 
     # NOTE(memben): First samples a negative class to ensure a more balanced distribution of negatives,
     # independent of the number of samples per class
     def negative(self, sample: ContrastiveImage) -> ContrastiveImage:
-        """Different class is sampled uniformly at random and a random sample from that class is returned"""
-        # filter for the same origin -> species
-        sample_origin = self.ds.loc[int(sample.id), "origin"]
-        same_ds = self.ds[self.ds["origin"] == sample_origin]
-        same_ds = same_ds[same_ds["label"] != sample.class_label]
-        negative_class = random.choice(same_ds["label"].unique())
-        negative_indices = same_ds[same_ds["label"] == negative_class].index
-        negative_index = random.choice(negative_indices)
-        sample_row = same_ds.loc[negative_index]
-        sample = ContrastiveImage(
-            id=str(negative_index),
-            image_path=self.base_dir / sample_row["path"],
-            class_label=sample_row["label"],
-        )
-        return sample
+        """Different class of the same species is sampled uniformly at random and a random sample of it is returned"""
+        return self[self.index.negative(int(sample.id), self.rng)]
 
     def negative_classes(self, img: ContrastiveImage) -> list[Label]:
-        class_label = img.class_label
-        return [label for label in self.contrastive_sampler.class_labels if label != class_label]  # type: ignore
+        return self.index.negative_labels(int(img.id))
+
+    def anchor_weights(self) -> Tensor:
+        """Per sample weights realizing the species weights and class balancing for a `WeightedRandomSampler`."""
+        return torch.from_numpy(self.index.anchor_weights())
 
 
 class MultiSpeciesSupervisedDataset(NletDataset):
@@ -139,8 +134,22 @@ class MultiSpeciesSupervisedDataset(NletDataset):
             test/
                 ...
     Each file is prefixed with the class label, e.g. "label1_1.jpg"
+
+    With `species_weights` or `class_balanced`, training samples are drawn with the weights of
+    `MultiSpeciesContrastiveSampler.anchor_weights` instead of uniformly.
     """
 
+    def __init__(
+        self,
+        *args: Any,
+        species_weights: Optional[dict[str, float]] = None,
+        class_balanced: bool = False,
+        **kwargs: Any,
+    ) -> None:
+        self.species_weights = species_weights
+        self.class_balanced = class_balanced
+        super().__init__(*args, **kwargs)
+
     def _get_item(self, idx: Label) -> tuple[tuple[Id, ...], tuple[Tensor, ...], tuple[Label, ...]]:
         return super()._get_item(idx)
 
@@ -163,7 +172,12 @@ class MultiSpeciesSupervisedDataset(NletDataset):
                 test/
                     ...
         """
-        return MultiSpeciesContrastiveSampler(base_dir)
+        return MultiSpeciesContrastiveSampler(base_dir, self.species_weights, self.class_balanced)
+
+    def sample_weights(self) -> Optional[Tensor]:
+        if self.species_weights is None and not self.class_balanced:
+            return None
+        return self.contrastive_sampler.anchor_weights()  # type: ignore
 
     def _stack_flat_nlet(self, flat_nlet: FlatNlet) -> Nlet:
         ids = tuple(str(img.image_path) for img in flat_nlet)
@@ -174,10 +188,8 @@ class MultiSpeciesSupervisedDataset(NletDataset):
 
     def _crop_if_necessary(self, img: ContrastiveImage) -> Image.Image:
         pilimg = Image.open(img.image_path)
-        if "bbox" in self.contrastive_sampler.ds.columns and isinstance(  # type: ignore
-            self.contrastive_sampler.ds.loc[int(img.id), "bbox"], list  # type: ignore
-        ):
-            bbox = self.contrastive_sampler.ds.loc[int(img.id), "bbox"]  # type: ignore
+        bbox = self.contrastive_sampler.bbox(img)  # type: ignore
+        if bbox is not None:
             x, y, w, h = bbox
             bbox = (x, y, x + w, y + h)
             pilimg = pilimg.crop(bbox)  # type: ignore
@@ -4,9 +4,8 @@ import logging
 import os
 from abc import ABC, abstractmethod
 from collections import defaultdict
-from functools import lru_cache
 from pathlib import Path
-from typing import Any, Callable, Literal, Protocol
+from typing import Any, Callable, Literal, Optional, Protocol
 
 import torch
 from PIL.Image import Image
@@ -25,6 +24,8 @@ from gorillatracker.data.contrastive_sampler import (
     get_individual,
     group_contrastive_images,
 )
+from gorillatracker.data.sample_cache import SampleCacheConfig, create_sample_cache, transform_fingerprint
+from gorillatracker.data.shards import ImageShard, ShardedContrastiveImage
 from gorillatracker.transform_utils import SquarePad
 from gorillatracker.type_helper import Label, Nlet
 from gorillatracker.utils.labelencoder import LabelEncoder
@@ -45,20 +46,30 @@ class NletDataset(Dataset[Nlet], ABC):
         nlet_builder: Callable[[int, ContrastiveSampler], FlatNlet],
         partition: Literal["train", "val", "test"],
         transform: gtypes.TensorTransform,
+        sample_cache_config: Optional[SampleCacheConfig] = None,
         **kwargs: Any,
     ):
         self.partition = partition
         self.contrastive_sampler = self.create_contrastive_sampler(base_dir)
         self.nlet_builder = nlet_builder
+        self.tensor_transform = transform
         self.transform: Callable[[Image], torch.Tensor] = transforms.Compose([self.get_transforms(), transform])
+        self.sample_cache = create_sample_cache(
+            sample_cache_config,
+            partition,
+            type(self).__name__,
+            Path(base_dir).resolve(),
+            getattr(nlet_builder, "__name__", nlet_builder),
+            transform_fingerprint(self.transform),
+        )
 
     def __len__(self) -> int:
         return len(self.contrastive_sampler)
 
     def __getitem__(self, idx: int) -> Nlet:
         # NOTE(memben): We want to cache the nlets for the validation and test sets
-        if self.partition in {"val", "test"}:
-            return self._get_cached_item(idx)
+        if self.sample_cache is not None:
+            return self.sample_cache.get_or_compute(idx, lambda: self._get_item(idx))
         else:
             return self._get_item(idx)
 
@@ -76,9 +87,9 @@ class NletDataset(Dataset[Nlet], ABC):
     def create_contrastive_sampler(self, base_dir: Path) -> ContrastiveSampler:
         pass
 
-    @lru_cache(maxsize=None)
-    def _get_cached_item(self, idx: int) -> Nlet:
-        return self._get_item(idx)
+    def sample_weights(self) -> Optional[torch.Tensor]:
+        """Per sample weights to draw the training samples with, None to shuffle uniformly."""
+        return None
 
     def _get_item(self, idx: int) -> Nlet:
         flat_nlet = self.nlet_builder(idx, self.contrastive_sampler)
@@ -87,9 +98,15 @@ class NletDataset(Dataset[Nlet], ABC):
     def _stack_flat_nlet(self, flat_nlet: FlatNlet) -> Nlet:
         ids = tuple(str(img.image_path) for img in flat_nlet)
         labels = tuple(img.class_label for img in flat_nlet)
-        values = tuple(self.transform(img.image) for img in flat_nlet)
+        values = tuple(self._load_image(img) for img in flat_nlet)
         return ids, values, labels
 
+    def _load_image(self, img: ContrastiveImage) -> torch.Tensor:
+        if isinstance(img, ShardedContrastiveImage):
+            # NOTE: shard images are already square padded, only the ToTensor scaling is left
+            return self.tensor_transform(img.tensor.float().div(255))
+        return self.transform(img.image)
+
     @classmethod
     def get_transforms(cls) -> gtypes.Transform:
         return transforms.Compose(
@@ -114,7 +131,7 @@ class KFoldNletDataset(NletDataset):
         assert val_i < k, "val_i must be less than k"
         self.k = k
         self.val_i = val_i
-        super().__init__(base_dir, nlet_builder, partition, transform)
+        super().__init__(base_dir, nlet_builder, partition, transform, **kwargs)
 
 
 def group_images_by_label(dirpath: Path) -> defaultdict[Label, list[ContrastiveImage]]:
@@ -204,6 +221,31 @@ class SupervisedDataset(NletDataset):
         return sampler_class(self.classes)
 
 
+class ShardedSupervisedDataset(SupervisedDataset):
+    """
+    A SupervisedDataset that reads its images from image shards (see `gorillatracker.data.shards`) instead of
+    individual files. Build the shards with `gorillatracker.scripts.build_image_shards`:
+        base_dir/
+            train/
+                images.npy
+                labels.npy
+                index.json
+            val/
+                ...
+            test/
+                ...
+    """
+
+    def create_contrastive_sampler(
+        self, base_dir: Path, sampler_class: type = ContrastiveClassSampler
+    ) -> ContrastiveClassSampler:
+        dirpath = base_dir / Path(self.partition) if os.path.exists(base_dir / Path(self.partition)) else base_dir
+        assert os.path.exists(dirpath / "index.json"), f"No image shard in {dirpath}"
+        self.shard = ImageShard(dirpath)
+        self.classes = group_contrastive_images(self.shard.contrastive_images())  # type: ignore
+        return sampler_class(self.classes)
+
+
 class SupervisedKFoldDataset(KFoldNletDataset):
     @property
     def num_classes(self) -> int:
@@ -2,16 +2,19 @@ from __future__ import annotations
 
 import logging
 from pathlib import Path
-from typing import Any, Literal, Protocol, Type, Union
+from typing import Any, Literal, Optional, Protocol, Type, Union
 
 import lightning as L
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, WeightedRandomSampler
 from torchvision import transforms
 
 import gorillatracker.type_helper as gtypes
+from gorillatracker.data.batch_sampler import PKBatchSampler
 from gorillatracker.data.combined import CombinedDataset
-from gorillatracker.data.contrastive_sampler import ContrastiveSampler, FlatNlet
+from gorillatracker.data.contrastive_sampler import ContrastiveSampler, FlatNlet, video_id_encoder
+from gorillatracker.data.loader_profiles import LoaderProfileName, autotune_loader_profile, get_loader_profile
 from gorillatracker.data.nlet import NletDataset
+from gorillatracker.transform_utils import BatchAugmentation
 
 
 class FlatNletBuilder(Protocol):
@@ -36,10 +39,22 @@ class NletDataModule(L.LightningDataModule):
         eval_data_dirs: list[Path] = [],
         dataset_ids: list[str] = [],
         dataset_names: list[str] = [],
+        train_batch_sampler: Literal["shuffle", "pk"] = "shuffle",
+        pk_identities: int = 4,
+        pk_video_diverse: bool = False,
+        seed: int = 0,
+        loader_profile: LoaderProfileName = "default",
+        loader_autotune_batches: int = 10,
+        device_augmentation: Optional[BatchAugmentation] = None,
         **kwargs: Any,  # SSLConfig, etc.
     ) -> None:
         """
         The `eval_datasets` are used for evaluation purposes and are additional to the primary `dataset_class`.
+        With `train_batch_sampler="pk"`, training batches hold `pk_identities` identities with
+        `batch_size // pk_identities` samples each (see `PKBatchSampler`).
+        `loader_profile` names the DataLoader settings, see `gorillatracker.data.loader_profiles`.
+        With a `device_augmentation`, the training workers only run its `worker_transform` and the augmentation and
+        `model_transforms` are applied to whole training batches after the transfer to the device.
         """
         super().__init__()
         assert len(eval_datasets) == len(eval_data_dirs), "eval_datasets and eval_data_dirs must have the same length"
@@ -58,6 +73,18 @@ class NletDataModule(L.LightningDataModule):
         self.eval_data_dirs = [data_dir] + eval_data_dirs
         self.dataset_ids = dataset_ids
         self.dataset_names = dataset_names
+        assert train_batch_sampler in ("shuffle", "pk"), f"Unknown train batch sampler {train_batch_sampler}"
+        assert (
+            train_batch_sampler != "pk" or batch_size % pk_identities == 0
+        ), "batch_size must be a multiple of pk_identities"
+        self.train_batch_sampler = train_batch_sampler
+        self.pk_identities = pk_identities
+        self.pk_video_diverse = pk_video_diverse
+        self.seed = seed
+        self.loader_profile = get_loader_profile(loader_profile)
+        self.loader_autotune_batches = loader_autotune_batches
+        self.device_augmentation = device_augmentation
+        self._eval_loaders: dict[int, tuple[list[Any], list[DataLoader[gtypes.Nlet]]]] = {}
         self.kwargs = kwargs
 
     def setup(self, stage: str) -> None:
@@ -67,7 +94,11 @@ class NletDataModule(L.LightningDataModule):
                 self.data_dir,
                 nlet_builder=self.nlet_builder,
                 partition="train",
-                transform=transforms.Compose([self.training_transforms, self.model_transforms]),
+                transform=(
+                    self.device_augmentation.worker_transform()
+                    if self.device_augmentation is not None
+                    else transforms.Compose([self.training_transforms, self.model_transforms])
+                ),
                 **self.kwargs,
             )
 
@@ -107,20 +138,57 @@ class NletDataModule(L.LightningDataModule):
             self, "train"
         ):  # HACK(rob2u): we enforce setup to be called (somehow it's not always called, problem in val_before_training)
             self.setup("fit")
+        if self.loader_profile.autotune:
+            self.loader_profile = autotune_loader_profile(
+                self.loader_profile, self._train_dataloader, warmup_batches=self.loader_autotune_batches
+            )
+        return self._train_dataloader(self.loader_profile.dataloader_kwargs(self.workers))
+
+    def _train_dataloader(self, loader_kwargs: dict[str, Any]) -> DataLoader[gtypes.Nlet]:
+        if self.train_batch_sampler == "pk":
+            return DataLoader(self.train, batch_sampler=self.pk_batch_sampler(), **loader_kwargs)  # type: ignore
+        if isinstance(self.train, NletDataset):
+            sample_weights = self.train.sample_weights()
+            if sample_weights is not None:
+                sampler = WeightedRandomSampler(sample_weights.tolist(), num_samples=len(self.train), replacement=True)
+                return DataLoader(
+                    self.train, batch_size=self.batch_size, sampler=sampler, drop_last=True, **loader_kwargs
+                )
         # NOTE(rob2u): the type ignores are necessary because these types would be incorrect for the combined Dataset, yet we don't want to change it (cascade of changes)
-        return DataLoader(self.train, batch_size=self.batch_size, shuffle=True, num_workers=self.workers, drop_last=True)  # type: ignore
+        return DataLoader(self.train, batch_size=self.batch_size, shuffle=True, drop_last=True, **loader_kwargs)  # type: ignore
+
+    def on_after_batch_transfer(self, batch: Any, dataloader_idx: int) -> Any:
+        if self.device_augmentation is None or self.trainer is None or not self.trainer.training:
+            return batch
+        ids, images, *rest = batch
+        return ids, tuple(self.model_transforms(self.device_augmentation(x)) for x in images), *rest
+
+    def pk_batch_sampler(self) -> PKBatchSampler:
+        assert isinstance(self.train, NletDataset), "P x K batches need the anchor labels of a NletDataset"
+        anchors = list(self.train.contrastive_sampler)
+        video_ids = [video_id_encoder.encode(anchor.id)[1] for anchor in anchors] if self.pk_video_diverse else None
+        return PKBatchSampler(
+            [anchor.class_label for anchor in anchors],
+            p=self.pk_identities,
+            k=self.batch_size // self.pk_identities,
+            video_ids=video_ids,
+            seed=self.seed,
+        )
 
     def val_dataloader(self) -> list[DataLoader[gtypes.Nlet]]:
-        # NOTE(rob2u): the type ignores are necessary because these types would be incorrect for the combined Dataset, yet we don't want to change it (cascade of changes)
-        return [
-            DataLoader(val, batch_size=self.batch_size, shuffle=False, num_workers=self.workers) for val in self.val  # type: ignore
-        ]
+        return self._eval_dataloaders(self.val)
 
     def test_dataloader(self) -> list[DataLoader[gtypes.Nlet]]:
-        # NOTE(rob2u): the type ignores are necessary because these types would be incorrect for the combined Dataset, yet we don't want to change it (cascade of changes)
-        return [
-            DataLoader(test, batch_size=self.batch_size, shuffle=False, num_workers=self.workers) for test in self.test  # type: ignore
-        ]
+        return self._eval_dataloaders(self.test)
+
+    def _eval_dataloaders(self, datasets: list[Any]) -> list[DataLoader[gtypes.Nlet]]:
+        # NOTE: reused while the datasets are the same, rebuilding would also restart persistent workers
+        cached = self._eval_loaders.get(id(datasets))
+        if cached is None or cached[0] is not datasets:
+            loader_kwargs = self.loader_profile.dataloader_kwargs(self.workers)
+            loaders = [DataLoader(ds, batch_size=self.batch_size, shuffle=False, **loader_kwargs) for ds in datasets]
+            cached = self._eval_loaders[id(datasets)] = (datasets, loaders)
+        return cached[1]
 
     def predict_dataloader(self) -> list[DataLoader[gtypes.Nlet]]:  # TODO(memben)
         raise NotImplementedError
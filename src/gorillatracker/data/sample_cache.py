@@ -0,0 +1,224 @@
+"""Bounded caches for the deterministic samples of the val and test partitions.
+
+Two levels:
+- a per-process LRU with a byte budget (`max_memory_mb`), and
+- optionally a `TensorFileStore` every DataLoader worker can read: "shared" keeps the files in shared memory
+  (/dev/shm, removed when the creating process exits), "disk" keeps them in `disk_dir` across runs.
+
+Validation workers are not persistent, every epoch forks fresh workers from the main process whose in-memory cache
+is empty. Only the store therefore makes the epochs after the first one fast with `workers > 0`.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import uuid
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Literal, Optional, TypeVar
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+SampleCacheStore = Literal["none", "shared", "disk"]
+SHARED_MEMORY_DIR = Path("/dev/shm")
+
+
+@dataclass(frozen=True)
+class SampleCacheConfig:
+    max_memory_mb: float = 1024.0  # NOTE: per process, i.e. per DataLoader worker
+    store: SampleCacheStore = "none"
+    store_max_mb: float = 8192.0  # NOTE: shared by all processes
+    disk_dir: Optional[Path] = None  # required for store="disk"
+
+
+@dataclass
+class SampleCacheStats:
+    memory_hits: int = 0
+    store_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    memory_items: int = 0
+    memory_bytes: int = 0
+    store_bytes: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.memory_hits + self.store_hits + self.misses
+        return (self.memory_hits + self.store_hits) / lookups if lookups else 0.0
+
+
+def sample_nbytes(value: Any) -> int:
+    """Bytes held by the tensors of a (nested) sample, e.g. an Nlet (ids, values, labels)."""
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, (tuple, list)):
+        return sum(sample_nbytes(v) for v in value)
+    return 0
+
+
+class LRUSampleCache:
+    """In-process LRU over sample indices, evicting the least recently used samples beyond `max_bytes`."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[int, tuple[Any, int]] = OrderedDict()
+        self.nbytes = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: int) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: int, value: Any) -> None:
+        nbytes = sample_nbytes(value)
+        if nbytes > self.max_bytes or key in self._entries:
+            return
+        self._entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= evicted_nbytes
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.nbytes = 0
+
+
+class TensorFileStore:
+    """One `torch.save` file per sample below `root`, visible to every process that knows `root`.
+
+    Writes are atomic (write to a temporary file, then rename), so concurrent workers never read partial samples.
+    The budget is admission only: once `max_bytes` (file sizes) are used, new samples are no longer stored. The used
+    bytes are shared through the file system and re-counted every `recount_every` writes.
+    """
+
+    def __init__(self, root: Path, max_bytes: int, recount_every: int = 64) -> None:
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.recount_every = recount_every
+        self._writes_since_recount = 0
+        self.nbytes = self._count_bytes()
+
+    def _path(self, key: int) -> Path:
+        return self.root / f"{key}.pt"
+
+    def _count_bytes(self) -> int:
+        with os.scandir(self.root) as entries:
+            return sum(entry.stat().st_size for entry in entries if entry.name.endswith(".pt"))
+
+    def get(self, key: int) -> Optional[Any]:
+        try:
+            return torch.load(self._path(key))
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: int, value: Any) -> None:
+        if self._writes_since_recount >= self.recount_every:
+            self.nbytes, self._writes_since_recount = self._count_bytes(), 0
+        if self.nbytes >= self.max_bytes or self._path(key).exists():
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            torch.save(value, f)
+            self.nbytes += f.tell()
+        os.replace(tmp_path, self._path(key))
+        self._writes_since_recount += 1
+
+
+def _remove_shared_store(root: Path, owner_pid: int) -> None:
+    if os.getpid() == owner_pid:  # NOTE: forked workers inherit the finalizer but must not delete the store
+        shutil.rmtree(root, ignore_errors=True)
+
+
+class SampleCache:
+    """The sample cache of one dataset (partition), see the module docstring.
+
+    `namespace` identifies the dataset in the store, it must change whenever the samples would change (e.g. other
+    transforms) for a persistent "disk" store.
+    """
+
+    def __init__(self, config: SampleCacheConfig, namespace: str) -> None:
+        self.config = config
+        self.memory = LRUSampleCache(int(config.max_memory_mb * 2**20))
+        self.store: Optional[TensorFileStore] = None
+        self._stats = SampleCacheStats()
+
+        safe_namespace = hashlib.sha1(namespace.encode()).hexdigest()[:16]
+        if config.store == "shared":
+            root = SHARED_MEMORY_DIR / f"gorillatracker-sample-cache-{uuid.uuid4().hex}" / safe_namespace
+            self.store = TensorFileStore(root, int(config.store_max_mb * 2**20))
+            weakref.finalize(self, _remove_shared_store, root.parent, os.getpid())
+        elif config.store == "disk":
+            assert config.disk_dir is not None, "disk_dir must be set for the disk sample cache"
+            self.store = TensorFileStore(Path(config.disk_dir) / safe_namespace, int(config.store_max_mb * 2**20))
+        else:
+            assert config.store == "none", f"Unknown sample cache store {config.store}"
+        logger.info(f"Sample cache for {namespace}: {config}, store at {self.store.root if self.store else None}")
+
+    def __getstate__(self) -> dict[str, Any]:
+        # NOTE: (spawned) workers start with an empty in-memory level instead of a pickled copy
+        state = self.__dict__.copy()
+        state["memory"] = LRUSampleCache(self.memory.max_bytes)
+        state["_stats"] = SampleCacheStats()
+        return state
+
+    def get_or_compute(self, key: int, compute: Callable[[], T]) -> T:
+        value = self.memory.get(key)
+        if value is not None:
+            self._stats.memory_hits += 1
+            return value
+        value = self.store.get(key) if self.store is not None else None
+        if value is not None:
+            self._stats.store_hits += 1
+        else:
+            self._stats.misses += 1
+            value = compute()
+            if self.store is not None:
+                self.store.put(key, value)
+        self.memory.put(key, value)
+        return value
+
+    def stats(self) -> SampleCacheStats:
+        """Statistics of this process, the store size is shared by all processes."""
+        self._stats.evictions = self.memory.evictions
+        self._stats.memory_items = len(self.memory)
+        self._stats.memory_bytes = self.memory.nbytes
+        self._stats.store_bytes = self.store.nbytes if self.store is not None else 0
+        return self._stats
+
+    def clear(self) -> None:
+        """Clears the in-memory level, the store is kept."""
+        self.memory.clear()
+
+
+def transform_fingerprint(transform: object) -> str:
+    """A stable hash of `repr(transform)` for the cache namespace, memory addresses (e.g. of lambdas) are dropped."""
+    return hashlib.sha1(re.sub(r" at 0x[0-9a-fA-F]+", "", repr(transform)).encode()).hexdigest()[:16]
+
+
+def create_sample_cache(
+    config: Optional[SampleCacheConfig], partition: str, *namespace: object
+) -> Optional[SampleCache]:
+    """The sample cache of a dataset, only val and test samples are deterministic and therefore cached."""
+    if partition not in {"val", "test"}:
+        return None
+    return SampleCache(config or SampleCacheConfig(), ":".join(str(part) for part in (*namespace, partition)))
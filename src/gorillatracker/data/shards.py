@@ -0,0 +1,132 @@
+"""Packed image shards: pre-padded, pre-resized uint8 images in one memory-mappable file per partition.
+
+Layout of a shard directory:
+    shard_dir/
+        images.npy  uint8 (N x S x S x 3), already square padded (`SquarePad`) and resized to S x S
+        labels.npy  int32 (N,), index into "label_names" of index.json
+        index.json  {"version": 1, "image_size": S, "label_names": [...], "ids": [...]}
+
+Label names are stored instead of encoded labels, as `LabelEncoder` codes depend on the order of encoding in a
+process. Ids are the original image paths, so everything parsed from file names keeps working.
+"""
+
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Optional, Sequence
+
+import numpy as np
+import torch
+from PIL import Image
+from tqdm import tqdm
+
+from gorillatracker.data.contrastive_sampler import ContrastiveImage
+from gorillatracker.transform_utils import SquarePad
+from gorillatracker.utils.labelencoder import LabelEncoder
+
+SHARD_FORMAT_VERSION = 1
+
+
+@dataclass(frozen=True, order=True, slots=True)
+class ShardedContrastiveImage(ContrastiveImage):
+    """A `ContrastiveImage` whose pixels live in a row of an `ImageShard` instead of a file."""
+
+    shard: ImageShard = field(compare=False, repr=False)
+    row: int = field(compare=False, repr=False)
+
+    @property
+    def image(self) -> Image.Image:
+        return Image.fromarray(self.shard.array(self.row))
+
+    @property
+    def tensor(self) -> torch.Tensor:
+        """uint8 (3 x S x S) view into the memory map, no decode and no copy."""
+        return self.shard.tensor(self.row)
+
+
+class ImageShard:
+    """Read side of the shard format, the image file is memory-mapped lazily (also after unpickling in workers)."""
+
+    def __init__(self, shard_dir: Path) -> None:
+        self.shard_dir = Path(shard_dir)
+        with open(self.shard_dir / "index.json") as f:
+            index = json.load(f)
+        assert index["version"] == SHARD_FORMAT_VERSION, f"Unsupported shard version {index['version']}"
+        self.image_size: int = index["image_size"]
+        self.label_names: list[str] = index["label_names"]
+        self.ids: list[str] = index["ids"]
+        self.label_indices = np.load(self.shard_dir / "labels.npy")
+        assert len(self.label_indices) == len(self.ids), "labels.npy and index.json are out of sync"
+        self._images: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getstate__(self) -> dict[str, Any]:
+        # NOTE: never pickle the memory map, that would copy the whole shard into every worker
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
+
+    @property
+    def images(self) -> np.ndarray:
+        if self._images is None:
+            # NOTE: copy-on-write keeps the file read-only while giving torch a writable buffer
+            self._images = np.load(self.shard_dir / "images.npy", mmap_mode="c")
+        return self._images
+
+    def array(self, row: int) -> np.ndarray:
+        return self.images[row]
+
+    def tensor(self, row: int) -> torch.Tensor:
+        return torch.from_numpy(self.images[row]).permute(2, 0, 1)
+
+    def contrastive_images(self) -> list[ShardedContrastiveImage]:
+        """Encodes the label names with the global `LabelEncoder`, like `group_images_by_label` does."""
+        labels = LabelEncoder.encode_list(self.label_names)
+        return [
+            ShardedContrastiveImage(id, Path(id), labels[label_index], self, row)
+            for row, (id, label_index) in enumerate(zip(self.ids, self.label_indices.tolist()))
+        ]
+
+
+def load_padded_image(image_path: Path, image_size: int) -> np.ndarray:
+    """The per-file loading path (`SquarePad`) followed by a resize to `image_size` x `image_size`."""
+    with Image.open(image_path) as image:
+        padded = SquarePad()(image.convert("RGB"))
+    return np.asarray(padded.resize((image_size, image_size), Image.Resampling.BILINEAR), dtype=np.uint8)
+
+
+def write_image_shard(
+    images: Sequence[ContrastiveImage], label_names: Sequence[str], shard_dir: Path, image_size: int
+) -> ImageShard:
+    """Writes `images` (with the label name of every image in `label_names`) as a shard, streaming into the file."""
+    assert len(images) == len(label_names), "Every image needs a label name"
+    shard_dir = Path(shard_dir)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+
+    unique_label_names = list(dict.fromkeys(label_names))
+    label_index = {name: i for i, name in enumerate(unique_label_names)}
+    np.save(shard_dir / "labels.npy", np.array([label_index[name] for name in label_names], dtype=np.int32))
+
+    pixels = np.lib.format.open_memmap(
+        shard_dir / "images.npy", mode="w+", dtype=np.uint8, shape=(len(images), image_size, image_size, 3)
+    )
+    for row, image in enumerate(tqdm(images, desc=f"Writing {shard_dir}", unit="image")):
+        pixels[row] = load_padded_image(image.image_path, image_size)
+    pixels.flush()
+    del pixels
+
+    with open(shard_dir / "index.json", "w") as f:
+        json.dump(
+            {
+                "version": SHARD_FORMAT_VERSION,
+                "image_size": image_size,
+                "label_names": unique_label_names,
+                "ids": [str(image.image_path) for image in images],
+            },
+            f,
+        )
+    return ImageShard(shard_dir)
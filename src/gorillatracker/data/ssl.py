@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 from pathlib import Path
-from typing import Any, Callable, Literal
+from typing import Any, Callable, Literal, Optional
 
 import torch
 from PIL.Image import Image
@@ -10,6 +10,7 @@ from torchvision import transforms
 import gorillatracker.type_helper as gtypes
 from gorillatracker.data.contrastive_sampler import ContrastiveSampler, FlatNlet
 from gorillatracker.data.nlet import NletDataset
+from gorillatracker.data.sample_cache import SampleCacheConfig, create_sample_cache, transform_fingerprint
 from gorillatracker.ssl_pipeline.ssl_config import SSLConfig
 
 
@@ -21,6 +22,7 @@ class SSLDataset(NletDataset):
         partition: Literal["train", "val", "test"],
         transform: gtypes.TensorTransform,
         ssl_config: SSLConfig,
+        sample_cache_config: Optional[SampleCacheConfig] = None,
         **kwargs: Any,
     ):
         self.ssl_config = ssl_config
@@ -28,6 +30,15 @@ class SSLDataset(NletDataset):
         self.transform: Callable[[Image], torch.Tensor] = transforms.Compose([self.get_transforms(), transform])
         self.partition: Literal["train", "val", "test"] = partition
         self.contrastive_sampler = self.create_contrastive_sampler(base_dir)
+        self.sample_cache = create_sample_cache(
+            sample_cache_config,
+            partition,
+            type(self).__name__,
+            base_dir,
+            ssl_config,
+            getattr(nlet_builder, "__name__", nlet_builder),
+            transform_fingerprint(self.transform),
+        )
 
     @property
     def num_classes(self) -> int:
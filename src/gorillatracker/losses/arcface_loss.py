@@ -1,9 +1,9 @@
-from typing import Any, Dict, List, Literal, Optional, Union
+from typing import Any, Dict, Literal, Optional, Union
 
 import torch
 
 import gorillatracker.type_helper as gtypes
-from gorillatracker.utils.labelencoder import LinearSequenceEncoder
+from gorillatracker.utils.labelencoder import LinearSequenceEncoder, TensorLabelEncoder, sorted_lookup
 
 eps = 1e-8  # an arbitrary small value to be used for numerical stability
 
@@ -17,12 +17,14 @@ class FocalLoss(torch.nn.Module):
         self.gamma = gamma
         self.ce = torch.nn.CrossEntropyLoss(reduction="none", label_smoothing=label_smoothing)
 
-    def forward(self, input: torch.Tensor, target: torch.Tensor) -> torch.Tensor:
+    def forward(
+        self, input: torch.Tensor, target: torch.Tensor, reduction: Literal["mean", "none"] = "mean"
+    ) -> torch.Tensor:
         # assert len(alphas) == len(target), "Alphas must be the same length as the target"
         logpt = -self.ce(input, target)
         pt = torch.exp(logpt)
         loss = -((1 - pt) ** self.gamma) * logpt
-        return loss.mean()
+        return loss.mean() if reduction == "mean" else loss
 
 
 class ArcFaceLoss(torch.nn.Module):
@@ -64,6 +66,15 @@ class ArcFaceLoss(torch.nn.Module):
         self.purpose = purpose
         self.accelerator = accelerator
 
+        # NOTE: the clamped relative frequencies of the (not encoded) labels, sorted by label for `sorted_lookup`
+        class_freq_labels = torch.tensor(sorted(class_distribution.keys()), dtype=torch.long)
+        class_freqs = torch.tensor([class_distribution[label] for label in class_freq_labels.tolist()])
+        class_freqs = (class_freqs.float() / self.num_samples).clamp(eps, 1.0)
+        self.class_freq_labels: torch.Tensor
+        self.class_freqs: torch.Tensor
+        self.register_buffer("class_freq_labels", class_freq_labels.to(accelerator), persistent=False)
+        self.register_buffer("class_freqs", class_freqs.to(accelerator), persistent=False)
+
         self.prototypes: Union[torch.nn.Parameter, torch.Tensor]
         if self.purpose == "train":
             self.prototypes = torch.nn.Parameter(
@@ -87,32 +98,30 @@ class ArcFaceLoss(torch.nn.Module):
         else:
             self.ce = torch.nn.CrossEntropyLoss(reduction="none", label_smoothing=label_smoothing)
 
-        self.le = LinearSequenceEncoder()  # NOTE: new instance (range 0:num_classes-1)
+        self.le = TensorLabelEncoder(capacity=num_classes)  # NOTE: new instance (range 0:num_classes-1)
 
     def forward(
         self,
         embeddings: torch.Tensor,
         labels: torch.Tensor,
         labels_onehot: Optional[torch.Tensor] = None,
+        reduction: Literal["mean", "none"] = "mean",
         **kwargs: Any,
     ) -> gtypes.LossPosNegDist:
-        """Forward pass of the ArcFace loss function"""
+        """Forward pass of the ArcFace loss function, `reduction="none"` returns one loss per embedding"""
         embeddings = embeddings.to(self.accelerator)
         assert self.prototypes.device == embeddings.device, "Prototypes and embeddings must be on the same device"
-        assert not any(torch.flatten(torch.isnan(embeddings))), "NaNs in embeddings"
+        assert not torch.isnan(embeddings).any(), "NaNs in embeddings"
+        labels = labels.to(embeddings.device)
 
         # NOTE(rob2u): necessary for range 0:n-1
         # get class frequencies
         class_freqs = torch.ones_like(labels, device=embeddings.device)
         if self.use_class_weights and self.purpose == "train":
-            class_freqs = torch.tensor([self.class_distribution[label.item()] for label in labels]).to(
-                embeddings.device
-            )
-            class_freqs = class_freqs.float() / self.num_samples
-            class_freqs = class_freqs.clamp(eps, 1.0)
+            class_freq_labels = self.class_freq_labels.to(embeddings.device)
+            class_freqs = sorted_lookup(class_freq_labels, self.class_freqs.to(embeddings.device), labels, float("nan"))
 
-        labels_transformed: List[int] = self.le.encode_list(labels.tolist())
-        labels = torch.tensor(labels_transformed).to(embeddings.device)
+        labels = self.le.encode_tensor(labels)
 
         cos_theta = torch.einsum(
             "bj,knj->bnk",
@@ -141,19 +150,26 @@ class ArcFaceLoss(torch.nn.Module):
         mask = torch.zeros(
             (cos_theta.shape[0], self.num_classes, self.k_subcenters), device=cos_theta.device
         )  # batch x num_classes x k_subcenters
-        mask.scatter_(1, labels.view(1, -1, 1).long(), 1)
+        # NOTE: with reduction="none" every embedding gets the mask it would get in a batch of its own, so the
+        # per-embedding losses equal one forward call per embedding (the batched mask is kept as is for training)
+        index = labels.view(-1, 1, 1) if reduction == "none" else labels.view(1, -1, 1)
+        mask.scatter_(1, index.long(), 1)
 
         output = (mask * phi) + ((1.0 - mask) * cos_theta)  # NOTE: the margin is only added to the correct class
         output *= self.s
         output = torch.mean(output, dim=2)  # batch x num_classes
 
-        assert not any(torch.flatten(torch.isnan(output))), "NaNs in output"
-        loss = self.ce(output, labels) if labels_onehot is None else self.ce(output, labels_onehot)
+        assert not torch.isnan(output).any(), "NaNs in output"
+        target = labels if labels_onehot is None else labels_onehot
+        loss = (
+            self.ce(output, target, reduction=reduction) if isinstance(self.ce, FocalLoss) else self.ce(output, target)
+        )
 
         loss = loss * (1 / class_freqs)  # NOTE: class_freqs is a tensor of class frequencies
-        loss = torch.mean(loss)
+        if reduction == "mean":
+            loss = torch.mean(loss)
 
-        assert not any(torch.flatten(torch.isnan(loss))), "NaNs in loss"
+        assert not torch.isnan(loss).any(), "NaNs in loss"
         return loss, torch.Tensor([-1.0]), torch.Tensor([-1.0])  # dummy values for pos/neg distances
 
     def update(self, weights: torch.Tensor, num_classes: int, le: LinearSequenceEncoder) -> None:
@@ -162,7 +178,7 @@ class ArcFaceLoss(torch.nn.Module):
         assert self.purpose == "val", "Manually setting the prototypes is only allowed for validation"
 
         self.num_classes = num_classes
-        self.le = le
+        self.le = TensorLabelEncoder.from_encoder(le, capacity=num_classes)
 
         weights = weights.unsqueeze(0)
 
@@ -190,10 +206,11 @@ class ElasticArcFaceLoss(ArcFaceLoss):
         embeddings: torch.Tensor,
         labels: torch.Tensor,
         labels_onehot: Optional[torch.Tensor] = None,
+        reduction: Literal["mean", "none"] = "mean",
         **kwargs: Any,
     ) -> gtypes.LossPosNegDist:
-        angle_margin = torch.tensor([self.angle_margin], device=embeddings.device)
-        self.margin_sigma = torch.tensor([self.margin_sigma], device=embeddings.device)
+        angle_margin = self.angle_margin.to(embeddings.device)
+        self.margin_sigma = self.margin_sigma.to(embeddings.device)
 
         if not self.is_eval:
             angle_margin = (
@@ -203,11 +220,7 @@ class ElasticArcFaceLoss(ArcFaceLoss):
 
         self.cos_m = torch.cos(angle_margin)
         self.sin_m = torch.sin(angle_margin)
-        return super().forward(
-            embeddings,
-            labels,
-            labels_onehot=labels_onehot,
-        )
+        return super().forward(embeddings, labels, labels_onehot=labels_onehot, reduction=reduction, **kwargs)
 
     def eval(self) -> Any:
         self.is_eval = True
@@ -228,6 +241,7 @@ class AdaFaceLoss(ArcFaceLoss):
         embeddings: torch.Tensor,
         labels: torch.Tensor,
         labels_onehot: Optional[torch.Tensor] = None,
+        reduction: Literal["mean", "none"] = "mean",
         **kwargs: Any,
     ) -> gtypes.LossPosNegDist:
         if self.norm.running_mean.device != embeddings.device:  # type: ignore
@@ -248,7 +262,7 @@ class AdaFaceLoss(ArcFaceLoss):
             self.cos_m = torch.cos(g_angle)
             self.sin_m = torch.sin(g_angle)
             self.additive_margin = g_additive
-        return super().forward(embeddings, labels, labels_onehot=labels_onehot, **kwargs)
+        return super().forward(embeddings, labels, labels_onehot=labels_onehot, reduction=reduction, **kwargs)
 
     def eval(self) -> Any:
         self.is_eval = True
@@ -126,6 +126,7 @@ def get_loss(
             path_to_pretrained_weights=kw_args["path_to_pretrained_weights"],
             alpha=kw_args["l2_alpha"],
             beta=kw_args["l2_beta"],
+            exclude=kw_args.get("l2sp_exclude", ()),
             log_func=log_func,
         )
 
@@ -1,4 +1,4 @@
-from typing import Any, Callable, Dict, List
+from typing import Any, Callable, Dict, List, Sequence
 
 import torch
 import torch.nn as nn
@@ -17,13 +17,14 @@ class L2SPRegularization_Wrapper(nn.Module):
         path_to_pretrained_weights: str,
         alpha: float,
         beta: float,
+        exclude: Sequence[str] = (),
         log_func: Callable[[str, float], None] = lambda x, y: None,
     ):
         super().__init__()
         assert path_to_pretrained_weights is not None, "Path to pretrained weights must be provided"
         self.loss = loss
         self.model = model
-        self.l2sp_loss = L2_SP(model, path_to_pretrained_weights, alpha, beta)
+        self.l2sp_loss = L2_SP(model, path_to_pretrained_weights, alpha, beta, exclude=exclude)
         self.log = log_func
 
     def forward(self, *args: List[Any], **kwargs: Dict[str, Any]) -> gtypes.LossPosNegDist:
@@ -6,7 +6,7 @@ import torch.nn.functional as F
 from torch import nn
 
 import gorillatracker.type_helper as gtypes
-from gorillatracker.data.contrastive_sampler import get_individual_video_id
+from gorillatracker.data.contrastive_sampler import video_id_encoder
 
 eps = 1e-16  # an arbitrary small value to be used for numerical stability tricks
 
@@ -25,43 +25,18 @@ def get_triplet_mask(labels: torch.Tensor) -> torch.Tensor:
         `labels[i] == labels[j] and labels[i] != labels[k]`
         and `i`, `j`, `k` are different.
     """
-    # step 1 - get a mask for distinct indices
+    # NOTE: labels[i] != labels[k] already implies i != k and j != k, so the valid triplets are exactly the valid
+    # anchor-positive pairs times the valid anchor-negative pairs, broadcast instead of repeated.
+    pos_mask = get_distance_mask(labels, valid="pos")
+    neg_mask = get_distance_mask(labels, valid="neg")
+    return torch.logical_and(pos_mask.unsqueeze(2), neg_mask.unsqueeze(1))
 
-    # shape: (batch_size, batch_size)
-
-    batch_size = labels.size()[0]
-    indices_equal = torch.eye(batch_size, dtype=torch.bool)
-    indices_not_equal = torch.logical_not(indices_equal)
-    # shape: (batch_size, batch_size, 1)
-    i_not_equal_j = indices_not_equal.unsqueeze(2).repeat(1, 1, batch_size)
-    # shape: (batch_size, 1, batch_size)
-    i_not_equal_k = indices_not_equal.unsqueeze(1).repeat(1, batch_size, 1)
-    # shape: (1, batch_size, batch_size)
-    j_not_equal_k = indices_not_equal.unsqueeze(0).repeat(batch_size, 1, 1)
-    # Shape: (batch_size, batch_size, batch_size)
-    distinct_indices = torch.logical_and(
-        torch.logical_and(i_not_equal_j, i_not_equal_k),
-        j_not_equal_k,
-    )
-
-    # step 2 - get a mask for valid anchor-positive-negative triplets
 
-    # shape: (batch_size, batch_size)
-    labels_equal = labels.unsqueeze(0) == labels.unsqueeze(1)
-    labels_equal = labels_equal.to(distinct_indices.device)
-    # shape: (batch_size, batch_size, 1)
-    i_equal_j = labels_equal.unsqueeze(2).repeat(1, 1, batch_size)
-    # shape: (batch_size, 1, batch_size)
-    i_equal_k = labels_equal.unsqueeze(1).repeat(1, batch_size, 1)
-    # shape: (batch_size, batch_size, batch_size)
-
-    valid_indices = torch.logical_and(i_equal_j, torch.logical_not(i_equal_k))
-
-    # step 3 - combine two masks
-
-    mask = torch.logical_and(distinct_indices, valid_indices)
-
-    return mask
+def count_valid_triplets(labels: torch.Tensor) -> torch.Tensor:
+    """Number of valid triplets (see `get_triplet_mask`) without materializing the mask."""
+    pos_mask = get_distance_mask(labels, valid="pos")
+    neg_mask = get_distance_mask(labels, valid="neg")
+    return (pos_mask.sum(dim=1) * neg_mask.sum(dim=1)).sum()
 
 
 def get_distance_mask(labels: torch.Tensor, valid: Literal["pos", "neg"] = "neg") -> torch.Tensor:
@@ -78,7 +53,7 @@ def get_distance_mask(labels: torch.Tensor, valid: Literal["pos", "neg"] = "neg"
         A negative distance is valid if:
         `labels[i] != labels[j] and i != j`
     """
-    tensor_labels = labels.detach().clone()
+    tensor_labels = labels.detach()
     batch_size = tensor_labels.size()[0]
     indices_equal = torch.eye(batch_size, dtype=torch.bool, device=tensor_labels.device)
     indices_not_equal = torch.logical_not(indices_equal)
@@ -109,32 +84,11 @@ def get_semi_hard_mask(
         A distance is semi-hard if:
         `labels[i] == labels[j] and labels[i] != labels[k] and 0 < distance_matrix[i][k] - distance_matrix[i][j] < margin`
     """
-    # filter out all where the distance to a negative is smaller than the max distance to a positive
-    device = distance_matrix.device
-    tensor_labels = labels.detach().clone()
-    tensor_labels = tensor_labels.to(device)
-    batch_size = tensor_labels.size()[0]
-    indices_equal = torch.eye(batch_size, dtype=torch.bool, device=device)
-    indices_not_equal = torch.logical_not(
-        indices_equal,
-    )
-    labels_equal = (tensor_labels.unsqueeze(0) == tensor_labels.unsqueeze(1)).to(device)
-    labels_not_equal = torch.logical_not(labels_equal)
-    distance_matrix_pos = distance_matrix * torch.logical_and(labels_equal, indices_not_equal).float()
-    distance_matrix_neg = distance_matrix * torch.logical_and(labels_not_equal, indices_not_equal).float()
-    # filter out all points where the distance to a negative is smaller than the max distance to a positive
-    distance_difference = distance_matrix_neg.unsqueeze(1).repeat(1, batch_size, 1) - distance_matrix_pos.unsqueeze(
-        2
-    ).repeat(
-        1, 1, batch_size
-    )  # shape: (anchor: batch_size,positive: batch_size, negative: batch_size)
-    # filter out all points where the distance to a negative is smaller than distance to a positive
-    # now only the triplets where dist_pos < dist_neg are left
-    mask = get_triplet_mask(labels)
+    labels = labels.to(distance_matrix.device)
+    # shape: (anchor: batch_size, positive: batch_size, negative: batch_size)
+    distance_difference = distance_matrix.detach().unsqueeze(1) - distance_matrix.detach().unsqueeze(2)
     semi_hard_mask = torch.logical_and(distance_difference < margin, distance_difference > 0.0)
-    semi_hard_mask = semi_hard_mask.to(mask.device)
-
-    return torch.logical_and(mask, semi_hard_mask)
+    return torch.logical_and(get_triplet_mask(labels), semi_hard_mask)
 
 
 def euclidean_distance_matrix(embeddings: torch.Tensor) -> torch.Tensor:
@@ -183,16 +137,81 @@ def angular_distance_matrix(embeddings: torch.Tensor) -> torch.Tensor:
     return angular_distance
 
 
-def get_cross_video_mask(ids: gtypes.FlatNletBatchIds) -> torch.Tensor:
-    """Returns a len(ids) x len(ids) x len(ids) mask where mask[i, j] is 1 if the two samples are from different videos and 0 otherwise."""
-    vids = [get_individual_video_id(id) for id in ids]
-    vids_matrix_list = []
-    for _, vid in enumerate(vids):
-        vids_matrix_list.append([vid != v for v in vids])
+def get_cross_video_mask(ids: gtypes.FlatNletBatchIds, device: torch.device | str = "cpu") -> torch.Tensor:
+    """Returns a len(ids) x len(ids) x 1 mask where mask[i, j] is 1 if the two samples are from different videos and 0 otherwise.
+
+    The last dimension broadcasts against (anchor, positive, negative) triplet masks.
+    """
+    _, video_codes = video_id_encoder.encode_list(ids, device=device)
+    return (video_codes.unsqueeze(0) != video_codes.unsqueeze(1)).unsqueeze(2)
 
-    vids_matrix = torch.tensor(vids_matrix_list, dtype=torch.bool)
-    vids_tensor = (vids_matrix.unsqueeze(2) * torch.ones((1, 1, len(ids)), dtype=torch.bool)).to(torch.bool)
-    return vids_tensor
+
+def get_hard_mask(labels: torch.Tensor, distance_matrix: torch.Tensor) -> torch.Tensor:
+    """Compute mask for the calculation of the hard triplet loss
+
+    Args:
+        labels: Batch of labels. shape: (batch_size,)
+        distance_matrix: Batch of distances. shape: (batch_size, batch_size)
+
+    Returns:
+        Mask tensor with at most one triplet per anchor, its farthest positive and its closest negative.
+        Shape: (batch_size, batch_size, batch_size)
+    """
+    labels = labels.to(distance_matrix.device)
+    batch_size = labels.size()[0]
+    positive_indices, negative_indices = _hardest_indices(distance_matrix, labels)
+    hard_mask = torch.zeros(batch_size, batch_size, batch_size, dtype=torch.bool, device=distance_matrix.device)
+    hard_mask[torch.arange(batch_size, device=distance_matrix.device), positive_indices, negative_indices] = True
+    return torch.logical_and(get_triplet_mask(labels), hard_mask)
+
+
+def _hardest_indices(distance_matrix: torch.Tensor, labels: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+    """Per anchor the index of the farthest positive and of the closest negative. shape: (batch_size,) each"""
+    pos_mask = get_distance_mask(labels, valid="pos")
+    neg_mask = get_distance_mask(labels, valid="neg")
+    distances = distance_matrix.detach()
+    positive_indices = distances.masked_fill(~pos_mask, float("-inf")).argmax(dim=1)
+    negative_indices = distances.masked_fill(~neg_mask, float("inf")).argmin(dim=1)
+    return positive_indices, negative_indices
+
+
+def masked_triplet_loss(
+    distance_matrix: torch.Tensor, triplet_mask: torch.Tensor, margin: float, chunk_size: Optional[int] = None
+) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Sums of the triplet loss and of the positive and negative distances over an explicit triplet mask.
+
+    This is the (batch_size, batch_size, batch_size) formulation, kept for mining strategies that do not reduce to
+    anchor-positive pairs and as the reference of `TripletLossOnline`. With `chunk_size` only that many anchors are
+    expanded at once, so apart from the boolean mask the memory stays at chunk_size x batch_size x batch_size.
+
+    Returns:
+        (loss sum, positive distance sum, negative distance sum, number of triplets)
+    """
+    batch_size = distance_matrix.size()[0]
+    chunk_size = chunk_size or batch_size
+    triplet_mask = triplet_mask.to(distance_matrix.device)
+    sums = [distance_matrix.new_zeros(()) for _ in range(3)]
+    for start in range(0, batch_size, chunk_size):
+        distances = distance_matrix[start : start + chunk_size]
+        mask = triplet_mask[start : start + chunk_size].float()
+        # shape: (chunk_size, batch_size, batch_size)
+        triplet_loss = F.relu((distances.unsqueeze(2) - distances.unsqueeze(1) + margin) * mask)
+        sums[0] = sums[0] + triplet_loss.sum()
+        sums[1] = sums[1] + (distances * mask.sum(dim=2)).sum()
+        sums[2] = sums[2] + (distances * mask.sum(dim=1)).sum()
+    return sums[0], sums[1], sums[2], triplet_mask.sum()
+
+
+def _sorted_negative_distances(
+    distance_matrix: torch.Tensor, neg_mask: torch.Tensor
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """Per anchor the ascending negative distances (invalid ones last as inf) and their prefix sums.
+
+    shapes: (batch_size, batch_size) and (batch_size, batch_size + 1)
+    """
+    sorted_distances, _ = distance_matrix.masked_fill(~neg_mask, float("inf")).sort(dim=1)
+    prefix_sums = F.pad(sorted_distances.masked_fill(~torch.isfinite(sorted_distances), 0.0).cumsum(dim=1), (1, 0))
+    return sorted_distances.contiguous(), prefix_sums
 
 
 class TripletLossOnline(nn.Module):
@@ -202,6 +221,12 @@ class TripletLossOnline(nn.Module):
         https://arxiv.org/pdf/1503.03832.pdf
         https://towardsdatascience.com/triplet-loss-advanced-intro-49a07b7d8905
 
+    All modes are computed from (batch_size, batch_size) matrices: the loss of an anchor-positive pair over all its
+    negatives (soft) or the negatives within the margin (semi-hard) only needs the count and the sum of the negative
+    distances in a distance interval, which a sort and prefix sums of every anchor's negative distances give.
+    `masked_triplet_loss` with `get_triplet_mask`, `get_semi_hard_mask` and `get_hard_mask` is the equivalent
+    (batch_size, batch_size, batch_size) formulation.
+
     Args:
       margin: Margin value in the Triplet Loss equation
     """
@@ -244,83 +269,86 @@ class TripletLossOnline(nn.Module):
         # step 1 - get distance matrix
         # shape: (batch_size, batch_size)
         distance_matrix = self.dist_calc(embeddings)
+        labels = labels.to(distance_matrix.device)
 
-        # step 2 - compute loss values for all triplets by applying broadcasting to distance matrix
-
-        # shape: (batch_size, batch_size, 1)
-        anchor_positive_dists = distance_matrix.unsqueeze(2)
-        # shape: (batch_size, 1, batch_size)
-        anchor_negative_dists = distance_matrix.unsqueeze(1)
-        # get loss values for all possible n^3 triplets
-        # shape: (batch_size, batch_size, batch_size)
-        triplet_loss = anchor_positive_dists - anchor_negative_dists + self.margin
-
-        # step 3 - filter out invalid or easy triplets by setting their loss values to 0
-
-        # shape: (batch_size, batch_size, batch_size)
-        # we only want to keep correct and depending on the mode the hardest or semi-hard triplets
-        # therefore we create a mask that is 1 for all valid triplets and 0 for all invalid triplets
-        mask = self.get_mask(distance_matrix, anchor_positive_dists, anchor_negative_dists, labels)
+        # step 2 - get the valid anchor-positive and anchor-negative pairs
+        # shape: (batch_size, batch_size)
+        pos_mask = get_distance_mask(labels, valid="pos")
+        neg_mask = get_distance_mask(labels, valid="neg")
+        cross_video_mask = None
         if self.cross_video_masking:
-            mask = torch.logical_and(mask, get_cross_video_mask(ids))  # type: ignore
-        mask = mask.to(triplet_loss.device)  # ensure mask is on the same device as triplet_loss
-        triplet_loss *= mask
+            cross_video_mask = get_cross_video_mask(ids, device=distance_matrix.device).squeeze(2)  # type: ignore
 
-        triplet_loss = F.relu(triplet_loss)
+        # step 3 - sum the losses and distances of the mined triplets
+        if self.mode == "hard":
+            sums = self.hard_triplet_sums(distance_matrix, labels, pos_mask, neg_mask, cross_video_mask)
+        else:
+            if cross_video_mask is not None:
+                pos_mask = torch.logical_and(pos_mask, cross_video_mask)
+            sums = self.interval_triplet_sums(distance_matrix, pos_mask, neg_mask)
+        triplet_loss_sum, anchor_positive_dist_sum, anchor_negative_dist_sum, num_losses = sums
 
         # step 4 - compute scalar loss value by averaging
-        num_losses = torch.sum(mask)
-        triplet_loss = triplet_loss.sum() / (num_losses + eps)
-
-        # calculate the average positive and negative distance
-        anchor_positive_dist_sum = (anchor_positive_dists.repeat(1, 1, len(labels)) * mask).sum()
-        anchor_negative_dist_sum = (anchor_negative_dists.repeat(1, len(labels), 1) * mask).sum()
+        triplet_loss = triplet_loss_sum / (num_losses + eps)
         anchor_positive_dist_mean = anchor_positive_dist_sum / (num_losses + eps)
         anchor_negative_dist_mean = anchor_negative_dist_sum / (num_losses + eps)
 
         return triplet_loss, anchor_positive_dist_mean, anchor_negative_dist_mean
 
-    def get_mask(
+    def hard_triplet_sums(
         self,
         distance_matrix: torch.Tensor,
-        anchor_positive_dists: torch.Tensor,
-        anchor_negative_dists: torch.Tensor,
         labels: torch.Tensor,
-    ) -> torch.Tensor:
-
-        mask = get_triplet_mask(labels)
-        if self.mode == "hard":  # take only the hardest negative as a negative per anchor
-            neg_mask = get_distance_mask(labels, valid="neg")  # get all valid negatives
-
-            # for each anchor compute the min distance to a negative
-            masked_anchor_negative_dists = anchor_negative_dists.squeeze(1).masked_fill(
-                neg_mask == 0, float("inf")
-            )  # fill all invalid negatives with inf so they are not considered in the min
-            _, neg_min_indices = torch.min(masked_anchor_negative_dists, dim=1)
-            # print(neg_min_indices)
-
-            pos_mask = get_distance_mask(labels, valid="pos")  # get all valid positives
-            masked_anchor_positive_dists = anchor_positive_dists.squeeze(2).masked_fill(
-                pos_mask == 0, float("-inf")
-            )  # fill all invalid positives with inf so they are not considered in the min
-            _, pos_max_indices = torch.max(masked_anchor_positive_dists, dim=1)
-            # print(pos_max_indices)
-
-            hard_mask = torch.zeros(len(labels), len(labels), len(labels))
-            hard_mask[torch.arange(len(labels)), pos_max_indices, neg_min_indices] = 1
-            hard_mask = hard_mask.to(mask.device)
-            # combine with base mask
-            mask = torch.logical_and(mask, hard_mask)
-
-        elif (
-            self.mode == "semi-hard"
-        ):  # select the negatives with a bigger distance than the positive but a difference smaller than the margin
-            semi_hard_mask = get_semi_hard_mask(labels, distance_matrix, self.margin)
-            # combine with base mask
-            semi_hard_mask = semi_hard_mask.to(mask.device)
-            mask = torch.logical_and(mask, semi_hard_mask)
-
-        return mask.float()
+        pos_mask: torch.Tensor,
+        neg_mask: torch.Tensor,
+        cross_video_mask: Optional[torch.Tensor],
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """One triplet per anchor: its farthest positive and its closest negative."""
+        positive_indices, negative_indices = _hardest_indices(distance_matrix, labels)
+        positive_indices, negative_indices = positive_indices.unsqueeze(1), negative_indices.unsqueeze(1)
+        valid = torch.logical_and(pos_mask.gather(1, positive_indices), neg_mask.gather(1, negative_indices))
+        if cross_video_mask is not None:
+            # NOTE: the hardest positive is mined among all positives, the triplet is dropped if it is from the same video
+            valid = torch.logical_and(valid, cross_video_mask.gather(1, positive_indices))
+        valid = valid.squeeze(1).float()
+        anchor_positive_dists = distance_matrix.gather(1, positive_indices).squeeze(1)
+        anchor_negative_dists = distance_matrix.gather(1, negative_indices).squeeze(1)
+        triplet_loss = F.relu((anchor_positive_dists - anchor_negative_dists + self.margin) * valid)
+        return (
+            triplet_loss.sum(),
+            (anchor_positive_dists * valid).sum(),
+            (anchor_negative_dists * valid).sum(),
+            valid.sum(),
+        )
+
+    def interval_triplet_sums(
+        self, distance_matrix: torch.Tensor, pos_mask: torch.Tensor, neg_mask: torch.Tensor
+    ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Per anchor-positive pair the triplets whose negative distance lies in an interval of the sorted negatives.
+
+        soft: all negatives count, the loss is non-zero for negative distances below d(a, p) + margin.
+        semi-hard: only negatives with d(a, p) < d(a, n) < d(a, p) + margin count.
+        """
+        sorted_negatives, prefix_sums = _sorted_negative_distances(distance_matrix, neg_mask)
+        pos_mask = pos_mask.float()
+        upper = torch.searchsorted(sorted_negatives, (distance_matrix + self.margin).detach().contiguous())
+        if self.mode == "semi-hard":
+            lower = torch.searchsorted(sorted_negatives, distance_matrix.detach().contiguous(), right=True)
+            upper = torch.maximum(upper, lower)
+        else:
+            lower = torch.zeros_like(upper)
+        # shape: (batch_size, batch_size), number and distance sum of the negatives in the interval per (a, p)
+        interval_count = (upper - lower).to(distance_matrix.dtype) * pos_mask
+        interval_negative_sum = (prefix_sums.gather(1, upper) - prefix_sums.gather(1, lower)) * pos_mask
+        triplet_loss_sum = (interval_count * (distance_matrix + self.margin) - interval_negative_sum).sum()
+
+        if self.mode == "semi-hard":
+            triplet_count = interval_count
+            negative_dist_sum = interval_negative_sum.sum()
+        else:
+            triplet_count = pos_mask * neg_mask.sum(dim=1, keepdim=True)
+            negative_dist_sum = ((distance_matrix * neg_mask).sum(dim=1) * pos_mask.sum(dim=1)).sum()
+        return triplet_loss_sum, (distance_matrix * triplet_count).sum(), negative_dist_sum, triplet_count.sum()
 
 
 class TripletLossOffline(nn.Module):
@@ -1,4 +1,3 @@
-from collections import defaultdict
 from itertools import islice
 from typing import Any, Dict, List, Literal, Optional
 
@@ -16,14 +15,13 @@ from pytorch_grad_cam import GradCAM
 from pytorch_grad_cam.utils.image import show_cam_on_image
 from sklearn.manifold import TSNE
 from sklearn.metrics import accuracy_score, f1_score, precision_score
-from sklearn.neighbors import NearestNeighbors
 from torch.utils.data import DataLoader as Dataloader
-from torchmetrics.functional import pairwise_euclidean_distance
 from torchvision.transforms import ToPILImage
 
 import gorillatracker.type_helper as gtypes
-from gorillatracker.data.contrastive_sampler import ContrastiveKFoldValSampler, get_individual, get_individual_video_id
+from gorillatracker.data.contrastive_sampler import ContrastiveKFoldValSampler, video_id_encoder
 from gorillatracker.data.nlet_dm import NletDataModule
+from gorillatracker.utils.knn import DEFAULT_MEMORY_BUDGET_MB, BlockBackend, MaskFn, NeighborBackend
 from gorillatracker.utils.labelencoder import LinearSequenceEncoder
 
 # TODO: What is the wandb run type?
@@ -124,8 +122,12 @@ def evaluate_embeddings(
     metrics: Dict[str, Any],
     kfold_k: Optional[int] = None,
     dataloader_name: str = "Unknown",
+    backends: Optional[Dict[str, NeighborBackend]] = None,
 ) -> Dict[str, Any]:
+    """Evaluates all metrics on the embeddings table.
 
+    `backends` selects the nearest-neighbour backend per metric name, it is passed as `backend` to the metric.
+    """
     assert (
         all([column in data.columns for column in ["label", "embedding", "id", "partition", "dataset"]])
         and len(data.columns) == 5
@@ -136,7 +138,11 @@ def evaluate_embeddings(
     data["label"] = data["label"].astype(int)
     data["encoded_label"] = le.encode_list(data["label"].tolist())
 
-    results = {metric_name: metric(data) for metric_name, metric in metrics.items()}
+    backends = backends or {}
+    results = {
+        metric_name: metric(data, backend=backends[metric_name]) if metric_name in backends else metric(data)
+        for metric_name, metric in metrics.items()
+    }
 
     kfold_str_prefix = f"fold-{kfold_k}/" if kfold_k is not None else ""
     results_parsed = {}
@@ -152,36 +158,227 @@ def evaluate_embeddings(
     return results_parsed
 
 
-def _get_crossvideo_masks(
-    labels: torch.Tensor, ids: list[gtypes.Id], min_samples: int = 3
-) -> tuple[torch.Tensor, torch.Tensor]:
-    distance_mask = torch.zeros((len(labels), len(labels)))
-    classification_mask = torch.zeros(len(labels))
+def _get_crossvideo_codes(ids: list[gtypes.Id], min_samples: int = 3) -> tuple[torch.Tensor, torch.Tensor]:
+    """Returns the video code of every id and the classification mask.
+
+    A sample is classified if its individual has at least `min_samples` images in other videos.
+    """
+    individual_codes, video_codes = video_id_encoder.encode_list(ids)
+    _, individual_codes = torch.unique(individual_codes, return_inverse=True)
+    _, dense_video_codes = torch.unique(video_codes, return_inverse=True)
+    images_per_individual = torch.bincount(individual_codes)
+    images_per_video = torch.bincount(dense_video_codes)
+    classification_mask = images_per_individual[individual_codes] - images_per_video[dense_video_codes] >= min_samples
+    return video_codes, classification_mask
+
+
+NeighborKey = tuple[str, bool, str, bool]  # (backend, use_train_embeddings, distance_metric, use_crossvideo_positives)
+
+
+class NeighborCache:
+    """Shares the expensive parts of `knn` between all kNN variants evaluated on the same embeddings table.
+
+    Partitions and cross-video masks are extracted once per table. Neighbors are searched once per
+    (backend, embedding set, distance metric) and kept as a sorted neighbor list of length `k_max`, smaller k are
+    slices of that list. The default backend is the streaming engine in `gorillatracker.utils.knn`, which never
+    materializes the full distance matrix, `memory_budget_mb` bounds the size of one distance tile. With
+    `crossvideo=True` the cross-video neighbor list is derived from the same search, otherwise it is computed on demand.
+    """
+
+    def __init__(
+        self,
+        k_max: int = 5,
+        crossvideo: bool = False,
+        memory_budget_mb: float = DEFAULT_MEMORY_BUDGET_MB,
+        device: Optional[torch.device] = None,
+        backend: Optional[NeighborBackend] = None,
+    ) -> None:
+        self.k_max = k_max
+        self.crossvideo = crossvideo
+        self.backend = (
+            backend if backend is not None else BlockBackend(memory_budget_mb=memory_budget_mb, device=device)
+        )
+        self._data_id: Optional[int] = None
+        self._partitions: dict[str, tuple[pd.DataFrame, torch.Tensor, torch.Tensor, list[gtypes.Id], torch.Tensor]] = {}
+        self._crossvideo_codes: Optional[tuple[torch.Tensor, torch.Tensor]] = None
+        self._val_folds: Optional[torch.Tensor] = None
+        self._neighbors: dict[NeighborKey, tuple[torch.Tensor, torch.Tensor]] = {}
+
+    def _bind(self, data: pd.DataFrame) -> None:
+        if self._data_id != id(data):
+            self._data_id = id(data)
+            self._partitions.clear()
+            self._crossvideo_codes = None
+            self._val_folds = None
+            self._neighbors.clear()
+
+    def set_val_folds(self, data: pd.DataFrame, val_folds: Optional[torch.Tensor]) -> None:
+        """Restricts the neighbors of every val embedding to the val embeddings of the same fold (and all train
+        embeddings), so the neighbor lists of all folds come out of one search. `None` removes the restriction."""
+        self._bind(data)
+        unchanged = (
+            val_folds is None
+            if self._val_folds is None
+            else val_folds is not None and torch.equal(self._val_folds, val_folds)
+        )
+        if not unchanged:
+            self._val_folds = val_folds
+            self._neighbors.clear()
+
+    def partition(
+        self, data: pd.DataFrame, partition: Literal["val", "train", "test"] = "val"
+    ) -> tuple[pd.DataFrame, torch.Tensor, torch.Tensor, list[gtypes.Id], torch.Tensor]:
+        self._bind(data)
+        if partition not in self._partitions:
+            self._partitions[partition] = get_partition_from_dataframe(data, partition=partition)
+        return self._partitions[partition]
+
+    def crossvideo_codes(self, data: pd.DataFrame) -> tuple[torch.Tensor, torch.Tensor]:
+        """Returns the val video codes and the val classification mask for cross-video evaluation."""
+        self._bind(data)
+        if self._crossvideo_codes is None:
+            _, _, _, val_ids, _ = self.partition(data, "val")
+            self._crossvideo_codes = _get_crossvideo_codes(val_ids)
+        return self._crossvideo_codes
+
+    def neighbors(
+        self,
+        data: pd.DataFrame,
+        k: int,
+        use_train_embeddings: bool = False,
+        distance_metric: Literal["euclidean", "cosine"] = "euclidean",
+        use_crossvideo_positives: bool = False,
+        backend: Optional[NeighborBackend] = None,
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """Returns the distances and indices of the k closest neighbors of all (train + val) embeddings, sorted by distance."""
+        self._bind(data)
+        backend = backend if backend is not None else self.backend
+        key = (backend.name, use_train_embeddings, distance_metric, use_crossvideo_positives)
+        if key not in self._neighbors or self._neighbors[key][1].shape[1] < k:
+            self._compute_neighbors(
+                data, max(k, self.k_max), use_train_embeddings, distance_metric, use_crossvideo_positives, backend
+            )
+        closest_distances, closest_indices = self._neighbors[key]
+        return closest_distances[:, :k], closest_indices[:, :k]
+
+    def _compute_neighbors(
+        self,
+        data: pd.DataFrame,
+        k: int,
+        use_train_embeddings: bool,
+        distance_metric: Literal["euclidean", "cosine"],
+        use_crossvideo_positives: bool,
+        backend: NeighborBackend,
+    ) -> None:
+        _, _, val_embeddings, _, _ = self.partition(data, "val")
+        train_embeddings = torch.Tensor([])
+        if use_train_embeddings:
+            _, _, train_embeddings, _, _ = self.partition(data, "train")
+        combined_embeddings = torch.cat([train_embeddings, val_embeddings], dim=0)
+        k = min(k, len(combined_embeddings))
+
+        # NOTE: train embeddings get code -1 and are never masked
+        def code_mask_fn(val_codes: torch.Tensor, same_code: bool) -> MaskFn:
+            codes_per_device = {torch.device("cpu"): torch.cat([torch.full((len(train_embeddings),), -1), val_codes])}
+
+            def mask_fn(q_idx: torch.Tensor, g_idx: torch.Tensor) -> torch.Tensor:
+                if q_idx.device not in codes_per_device:
+                    codes_per_device[q_idx.device] = codes_per_device[torch.device("cpu")].to(q_idx.device)
+                codes = codes_per_device[q_idx.device]
+                q_codes, g_codes = codes[q_idx].unsqueeze(1), codes[g_idx].unsqueeze(0)
+                return ((q_codes == g_codes) == same_code) | (q_codes < 0) | (g_codes < 0)
+
+            return mask_fn
+
+        fold_mask_fn = code_mask_fn(self._val_folds, same_code=True) if self._val_folds is not None else None
+        crossvideo_mask_fn: Optional[MaskFn] = None
+        if use_crossvideo_positives or self.crossvideo:
+            val_video_codes, _ = self.crossvideo_codes(data)
+            crossvideo_mask_fn = code_mask_fn(val_video_codes, same_code=False)
+
+        variants = sorted({use_crossvideo_positives, use_crossvideo_positives or self.crossvideo})
+        mask_fns = [crossvideo_mask_fn if crossvideo else None for crossvideo in variants]
+        if fold_mask_fn is not None:
+            # NOTE: masks are applied cumulatively, a leading fold-only list that was not requested is dropped below
+            mask_fns = [fold_mask_fn, *[mask_fn for mask_fn in mask_fns if mask_fn is not None]]
+        results = backend.search(
+            combined_embeddings,
+            combined_embeddings,
+            k,
+            distance_metric=distance_metric,
+            mask_fns=mask_fns,
+            exclude_self=True,
+        )[len(mask_fns) - len(variants) :]
+        for crossvideo, (closest_distances, closest_indices) in zip(variants, results):
+            self._neighbors[(backend.name, use_train_embeddings, distance_metric, crossvideo)] = (
+                closest_distances.cpu(),
+                closest_indices.cpu(),
+            )
+
 
-    vids_per_id: defaultdict[str, defaultdict[str, int]] = defaultdict(
-        lambda: defaultdict(lambda: 0)
-    )  # NOTE: individual_id -> (individual_video_id -> num_images))
-    idx_per_vid: defaultdict[str, list[int]] = defaultdict(list)
-    for i, id in enumerate(ids):
-        individual_video_id = get_individual_video_id(id)
-        vids_per_id[get_individual(id)][individual_video_id] += 1
-        idx_per_vid[individual_video_id].append(i)
+TiePolicy = Literal["legacy", "nearest", "distance", "random"]
 
-    for i, id in enumerate(ids):
-        individual_video_id = get_individual_video_id(id)
 
-        distance_mask_ = [True] * len(ids)
-        for idx in idx_per_vid[individual_video_id]:
-            distance_mask_[idx] = False
-        distance_mask[i] = torch.tensor(distance_mask_)  # 1 if not same video, 0 if same video
+def knn_classification_matrix(
+    closest_labels: torch.Tensor,
+    closest_distances: torch.Tensor,
+    num_classes: int,
+    tie_policy: TiePolicy = "legacy",
+    seed: int = 0,
+    closest_indices: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """Builds the (len(closest_labels) x num_classes) vote matrix of the k nearest neighbors, ties broken in place.
 
-        if (
-            sum(vids_per_id[get_individual(id)].values()) - vids_per_id[get_individual(id)][individual_video_id]
-            >= min_samples
-        ):
-            classification_mask[i] = True
+    Every row holds the fraction of the k neighbors voting for each class. If several classes share the highest
+    fraction, all of them are raised by 1e-6 / num_tied and the winner by another 1e-6, so argmax picks the winner:
+    - "legacy": reproduces the original per-row loop bit for bit (needs `closest_indices`). It bumps the label of the
+      first neighbor whose *sample index* equals one of the tied class ids, which is only sometimes a tied class.
+      Kept as the default so metrics stay comparable with earlier runs.
+    - "nearest": the class of the closest neighbor among the tied classes wins.
+    - "distance": the tied class with the largest summed inverse distance wins.
+    - "random": a uniformly random tied class wins, reproducible through `seed`.
+    """
+    n, k = closest_labels.shape
+    ones = torch.ones_like(closest_labels, dtype=torch.float32)
+    classification_matrix = torch.zeros((n, num_classes), device=closest_labels.device).scatter_add_(
+        1, closest_labels, ones
+    )
+    classification_matrix /= k
+
+    max_prob = classification_matrix.max(dim=1, keepdim=True).values
+    is_max = max_prob - classification_matrix < 1e-6
+    num_tied = is_max.sum(dim=1)
+    tied_rows = num_tied > 1
+    if not tied_rows.any():
+        return classification_matrix
+
+    winner_rows = tied_rows
+    if tie_policy == "legacy":
+        assert closest_indices is not None, "legacy tie policy needs the neighbor indices"
+        is_class_id = closest_indices < num_classes
+        neighbor_is_tied = is_max.gather(1, closest_indices.clamp(max=num_classes - 1)) & is_class_id
+        first_tied = neighbor_is_tied.to(torch.uint8).argmax(dim=1, keepdim=True)
+        winner = closest_labels.gather(1, first_tied).squeeze(1)
+        winner_rows = tied_rows & neighbor_is_tied.any(dim=1)  # NOTE: rows without a match get no winner
+    elif tie_policy == "nearest":
+        neighbor_is_tied = is_max.gather(1, closest_labels)
+        first_tied = neighbor_is_tied.to(torch.uint8).argmax(dim=1, keepdim=True)  # NOTE: argmax returns the first max
+        winner = closest_labels.gather(1, first_tied).squeeze(1)
+    elif tie_policy == "distance":
+        weights = 1.0 / (closest_distances.to(classification_matrix.device) + 1e-8)
+        class_weights = torch.zeros_like(classification_matrix).scatter_add_(1, closest_labels, weights)
+        winner = class_weights.masked_fill(~is_max, -1.0).argmax(dim=1)
+    elif tie_policy == "random":
+        generator = torch.Generator(device=classification_matrix.device).manual_seed(seed)
+        scores = torch.rand(classification_matrix.shape, generator=generator, device=classification_matrix.device)
+        winner = scores.masked_fill(~is_max, -1.0).argmax(dim=1)
+    else:
+        raise ValueError(f"Unknown tie policy: {tie_policy}")
 
-    return distance_mask.to(torch.bool), classification_mask.to(torch.bool)
+    classification_matrix += tied_rows.unsqueeze(1) * is_max * (1e-6 / num_tied.unsqueeze(1))
+    rows = winner_rows.nonzero().squeeze(1)
+    classification_matrix[rows, winner[rows]] += 1e-6
+    return classification_matrix
 
 
 def knn(
@@ -192,6 +389,10 @@ def knn(
     use_crossvideo_positives: bool = False,
     distance_metric: Literal["euclidean", "cosine"] = "euclidean",
     use_filter: bool = False,
+    cache: Optional[NeighborCache] = None,
+    tie_policy: TiePolicy = "legacy",
+    tie_seed: int = 0,
+    backend: Optional[NeighborBackend] = None,
 ) -> Dict[str, Any]:
     """
     Algorithmic Description:
@@ -200,15 +401,20 @@ def knn(
     2. For each embedding find the k closest [smallest distances] embeddings (len(embeddings) x k)
        First find the indexes, the map to the labels (numbers).
     3. Create classification matrix where every embedding has a row with the probability for each class in it's top k surroundings (len(embeddings) x num_classes)
+       Ties between the most probable classes are broken according to `tie_policy` (see `knn_classification_matrix`)
     4. Select only the validation part of the classification matrix (len(val_embeddings) x num_classes)
     5. Calculate the accuracy, accuracy_top5, auroc and f1 score: Either choose highest probability as class as matched class or check if any of the top 5 classes matches.
+
+    Steps 1. and 2. are done by `backend` (defaults to the backend of the cache) and shared between calls that are
+    passed the same `cache`.
     """
+    cache = cache if cache is not None else NeighborCache(k_max=k)
 
     # convert embeddings and labels to tensors
-    _, _, val_embeddings, val_ids, val_labels = get_partition_from_dataframe(data, partition="val")
+    _, _, val_embeddings, val_ids, val_labels = cache.partition(data, partition="val")
     train_labels, train_embeddings = torch.Tensor([]), torch.Tensor([])
     if use_train_embeddings:
-        _, _, train_embeddings, _, train_labels = get_partition_from_dataframe(data, partition="train")
+        _, _, train_embeddings, _, train_labels = cache.partition(data, partition="train")
 
     # NOTE(rob2u): k // 2 + 1 for majority +1 because one is classified
     min_amount = k // 2 + 2 if use_filter else 0
@@ -224,76 +430,67 @@ def knn(
             classification_mask[val_labels == label] = False
 
     combined_embeddings = torch.cat([train_embeddings, val_embeddings], dim=0)
-    combined_labels = torch.cat([train_labels, val_labels], dim=0)
+    combined_labels = torch.cat([train_labels, val_labels], dim=0).long()
 
     num_classes: int = int(torch.max(combined_labels).item() + 1)
     assert num_classes == len(np.unique(combined_labels))
     if num_classes < k:
         k = num_classes
 
-    distance_matrix: torch.Tensor
-    if distance_metric == "cosine":
-        distance_matrix = (
-            torch.nn.functional.cosine_similarity(
-                combined_embeddings.unsqueeze(0), combined_embeddings.unsqueeze(1), dim=-1
-            )
-            * -1.0
-            + 1.0
-        )  # range [0, 2]
-    elif distance_metric == "euclidean":
-        distance_matrix = pairwise_euclidean_distance(combined_embeddings)  # range [0, inf]
-    else:
-        raise ValueError(f"Unknown distance metric: {distance_metric}")
-
-    distance_matrix.fill_diagonal_(float("inf"))
-
-    distance_mask: torch.Tensor  # NOTE(rob2u): mask to filter for distance calculation
     if use_crossvideo_positives:
-        distance_mask, classification_mask_cv = _get_crossvideo_masks(val_labels, val_ids)
+        _, classification_mask_cv = cache.crossvideo_codes(data)
         classification_mask = classification_mask & classification_mask_cv
-        if use_train_embeddings:  # add train embeddings to the distance mask (shapes would not match otherwise)
-            train_distance_mask = torch.ones((len(train_labels), len(train_labels) + len(val_labels)))
-            distance_mask = torch.cat([torch.ones((len(val_labels), len(train_labels))), distance_mask], dim=1)
-            distance_mask = torch.cat([train_distance_mask, distance_mask], dim=0)
-            distance_mask = distance_mask.to(torch.bool)
-        distance_matrix[~distance_mask] = float("inf")
-
-    _, closest_indices = torch.topk(
-        distance_matrix,
+
+    closest_distances, closest_indices = cache.neighbors(
+        data,
         k,
-        largest=False,
-        sorted=True,
+        use_train_embeddings=use_train_embeddings,
+        distance_metric=distance_metric,
+        use_crossvideo_positives=use_crossvideo_positives,
+        backend=backend,
     )
     assert closest_indices.shape == (len(combined_embeddings), k)
 
-    closest_labels = combined_labels[closest_indices]
-    assert closest_labels.shape == closest_indices.shape
-
-    classification_matrix = torch.zeros((len(combined_embeddings), num_classes))
-    for i in range(num_classes):
-        classification_matrix[:, i] = torch.sum(closest_labels == i, dim=1) / k
-
-    # NOTE(rob2u): break ties by using the nearest neighbor (tie is when the the two closest neighbors have the same label)
-    for i in range(len(combined_embeddings)):
-        max_prob = torch.max(classification_matrix[i])
-        max_prob_indices = torch.where(max_prob - classification_matrix[i] < 1e-6)[0]
-
-        if len(max_prob_indices) == 1:
-            continue
-            # add 1e-6 to the closest indice of the max_prob_indices substract elsewhere (in max_prob_indices)
-
-        classification_matrix[i, max_prob_indices] += (1e-6) / len(max_prob_indices)
-        for j in range(k):
-            if closest_indices[i][j] in max_prob_indices:
-                classification_matrix[i][closest_labels[i][j].to(torch.int)] += 1e-6
-                break
+    # Select only the validation part of the neighbor lists
+    val_rows = slice(len(train_embeddings), None)
+    return _knn_scores(
+        combined_labels[closest_indices[val_rows]],
+        closest_distances[val_rows],
+        closest_indices[val_rows],
+        val_labels,
+        classification_mask,
+        num_classes,
+        k,
+        average,
+        tie_policy,
+        tie_seed,
+    )
 
-    assert classification_matrix.shape == (len(combined_embeddings), num_classes)
 
-    # Select only the validation part of the classification matrix
-    val_classification_matrix = classification_matrix[-len(val_embeddings) :]
+def _knn_scores(
+    closest_labels: torch.Tensor,
+    closest_distances: torch.Tensor,
+    closest_indices: torch.Tensor,
+    val_labels: torch.Tensor,
+    classification_mask: torch.Tensor,
+    num_classes: int,
+    k: int,
+    average: Literal["micro", "macro", "weighted", "none"],
+    tie_policy: TiePolicy,
+    tie_seed: int,
+) -> Dict[str, Any]:
+    """Steps 3. to 5. of `knn`, given the neighbor lists of the val embeddings."""
+    classification_matrix = knn_classification_matrix(
+        closest_labels,
+        closest_distances,
+        num_classes,
+        tie_policy=tie_policy,
+        seed=tie_seed,
+        closest_indices=closest_indices,
+    )
+    assert classification_matrix.shape == (len(val_labels), num_classes)
 
-    val_classification_matrix = val_classification_matrix[classification_mask]
+    val_classification_matrix = classification_matrix[classification_mask]
     val_labels = val_labels[classification_mask]
 
     accuracy = tm.functional.accuracy(
@@ -327,12 +524,50 @@ def knn(
     }
 
 
+def _allowed_label_pairs_mask_fn(
+    labels: torch.Tensor,
+    query_rows: torch.Tensor,
+    allowed_label_rows: torch.Tensor,
+    allowed_label_cols: torch.Tensor,
+    max_dense_labels: int = 8192,
+) -> MaskFn:
+    """Mask for queries `labels[query_rows]` that allows gallery samples with an allowed label, never the query itself."""
+    num_labels = int(labels.max().item()) + 1
+    dense: Optional[torch.Tensor] = None
+    pair_codes: Optional[torch.Tensor] = None
+    if num_labels <= max_dense_labels:
+        dense = torch.zeros((num_labels, num_labels), dtype=torch.bool)
+        dense[allowed_label_rows, allowed_label_cols] = True
+    else:  # NOTE: sparse lookup of label pairs to bound memory for many labels
+        pair_codes = torch.unique(allowed_label_rows * num_labels + allowed_label_cols)
+
+    def mask_fn(q_idx: torch.Tensor, g_idx: torch.Tensor) -> torch.Tensor:
+        q_samples = query_rows[q_idx.cpu()]
+        q_labels, g_labels = labels[q_samples].unsqueeze(1), labels[g_idx.cpu()].unsqueeze(0)
+        if dense is not None:
+            allowed = dense[q_labels, g_labels]
+        else:
+            assert pair_codes is not None
+            allowed = torch.isin(q_labels * num_labels + g_labels, pair_codes)
+        return (allowed & (q_samples.unsqueeze(1) != g_idx.cpu().unsqueeze(0))).to(q_idx.device)
+
+    return mask_fn
+
+
+def _row_mode(values: torch.Tensor) -> torch.Tensor:
+    """Most frequent value per row, the smallest one on ties (like `torch.mode`)."""
+    counts = (values.unsqueeze(2) == values.unsqueeze(1)).sum(dim=2)
+    is_mode = counts == counts.max(dim=1, keepdim=True).values
+    return values.masked_fill(~is_mode, torch.iinfo(values.dtype).max).min(dim=1).values
+
+
 def knn_ssl(
     data: pd.DataFrame,
     dm: NletDataModule,
     average: Literal["micro", "macro", "weighted", "none"] = "weighted",
     k: int = 5,
     use_filter: bool = False,
+    backend: Optional[NeighborBackend] = None,
 ) -> Dict[str, Any]:
     # TODO(memben): add use_filter option for ssl
     if use_filter:
@@ -341,62 +576,46 @@ def knn_ssl(
     # TODO: add true label
     _, labels, embeddings, _, _ = get_partition_from_dataframe(data, partition="val")
 
-    negatives = {}
-    true_labels = []
-    pred_labels = []
-    pred_labels_top5 = []
-
     en = LinearSequenceEncoder()
     labels = torch.tensor(en.encode_list(labels.tolist()))
+    num_labels = len(en.mapping)
     current_val_index = 0
-    for label in labels.unique():  # type: ignore
-        decoded_label = en.decode(label.item())
-        image = dm.val[current_val_index].contrastive_sampler.find_any_image(decoded_label)
-        negative_labels = dm.val[current_val_index].contrastive_sampler.negative_classes(image)
-        negatives[label.item()] = en.encode_list(negative_labels)
-
-    for label in labels.unique():  # type: ignore
-        subset_labels = negatives[label.item()] + [label.item()]
-        if len(subset_labels) < 2:
-            continue
-        subset_mask = torch.isin(labels, torch.tensor(subset_labels))
-        subset_embeddings = embeddings[subset_mask]
-        subset_label_values = labels[subset_mask]
-
-        n_samples = len(subset_embeddings)
-        if n_samples <= k:
-            continue
-
-        n_neighbors = k + 1  # We need k+1 neighbors because the first one is the sample itself
-
-        knn = NearestNeighbors(n_neighbors=n_neighbors, algorithm="auto").fit(subset_embeddings.numpy())
-        current_label_mask = subset_label_values == label.item()
-        current_label_embeddings = subset_embeddings[current_label_mask]
-        _, indices = knn.kneighbors(current_label_embeddings.numpy())
-
-        indices = indices[:, 1:]  # Remove the first column (self)
-        for idx_list in indices:
-            neighbor_labels = subset_label_values[idx_list]
-            most_common = torch.mode(neighbor_labels).values.item()
-            true_labels.append(label.item())
-            pred_labels.append(most_common)
-            pred_labels_top5.append(neighbor_labels[: min(5, len(neighbor_labels))].numpy())
-
-    if len(true_labels) == 0:
+    contrastive_sampler = dm.val[current_val_index].contrastive_sampler
+
+    # label -> allowed gallery labels (itself and its negatives) as (label, allowed label) index arrays
+    representatives = contrastive_sampler.find_any_images(en.mapping.keys())
+    has_negatives = torch.zeros(num_labels, dtype=torch.bool)
+    allowed_rows: list[int] = []
+    allowed_cols: list[int] = []
+    for decoded_label, label in en.mapping.items():
+        negative_labels = contrastive_sampler.negative_classes(representatives[decoded_label])
+        has_negatives[label] = len(negative_labels) > 0
+        # NOTE: negatives without validation samples do not change the subset
+        subset_labels = {en.mapping[n] for n in negative_labels if n in en.mapping} | {label}
+        allowed_rows.extend([label] * len(subset_labels))
+        allowed_cols.extend(subset_labels)
+    allowed_label_rows, allowed_label_cols = torch.tensor(allowed_rows), torch.tensor(allowed_cols)
+
+    # a label is evaluated if it has negatives and its subset holds more than k samples
+    samples_per_label = torch.bincount(labels, minlength=num_labels)
+    subset_sizes = torch.zeros(num_labels, dtype=torch.long).index_add_(
+        0, allowed_label_rows, samples_per_label[allowed_label_cols]
+    )
+    evaluated_labels = has_negatives & (subset_sizes > k)
+    query_rows = evaluated_labels[labels].nonzero().squeeze(1)
+    if len(query_rows) == 0:
         return {"accuracy": -1, "accuracy_top5": -1, "f1": -1, "precision": -1}
 
-    true_labels_tensor = torch.tensor(true_labels)
-    pred_labels_tensor = torch.tensor(pred_labels)
+    allowed_mask_fn = _allowed_label_pairs_mask_fn(labels, query_rows, allowed_label_rows, allowed_label_cols)
+    backend = backend if backend is not None else BlockBackend()
+    ((_, indices),) = backend.search(embeddings[query_rows], embeddings, k, mask_fns=[allowed_mask_fn])
 
-    pred_labels_top5_nparray = np.array(pred_labels_top5)
-    pred_labels_top5_tensor = torch.tensor(pred_labels_top5_nparray)
-    top5_correct = []
-    for i, true_label in enumerate(true_labels_tensor):
-        if true_label in pred_labels_top5_tensor[i]:
-            top5_correct.append(1)
-        else:
-            top5_correct.append(0)
-    top5_accuracy = sum(top5_correct) / len(top5_correct)
+    neighbor_labels = labels[indices]
+    true_labels_tensor = labels[query_rows]
+    pred_labels_tensor = _row_mode(neighbor_labels)
+    top5_accuracy = (neighbor_labels[:, :5] == true_labels_tensor.unsqueeze(1)).any(dim=1).sum().item() / len(
+        query_rows
+    )
 
     accuracy = accuracy_score(true_labels_tensor, pred_labels_tensor)
     f1 = f1_score(true_labels_tensor, pred_labels_tensor, average=average)
@@ -412,42 +631,95 @@ def knn_kfold_val(
     average: Literal["micro", "macro", "weighted", "none"] = "weighted",
     distance_metric: Literal["euclidean", "cosine"] = "euclidean",
     k: int = 5,
+    use_train_embeddings: bool = False,
     use_crossvideo_positives: bool = False,
-    **kwargs: Any,
+    use_filter: bool = False,
+    cache: Optional[NeighborCache] = None,
+    tie_policy: TiePolicy = "legacy",
+    tie_seed: int = 0,
+    backend: Optional[NeighborBackend] = None,
 ) -> Dict[str, Any]:
-    """Calculate knn metrics for each fold and average them to have compareable results to kfold training"""
+    """Calculate knn metrics for each fold and average them to have compareable results to kfold training
+
+    Every val embedding is only classified by the val embeddings of its own fold, `use_train_embeddings` is ignored
+    like before (the train embeddings were never part of a fold). The neighbors of all folds come from one search
+    with a same-fold mask, see `NeighborCache.set_val_folds`. Labels are encoded per fold, as if `knn` was called on
+    the rows of the fold only. Returns the averaged metrics and the metrics of every fold as "val-fold-{i}/{metric}".
+    """
     contrastive_sampler = dm.val[current_val_index].contrastive_sampler
     assert isinstance(contrastive_sampler, ContrastiveKFoldValSampler), "Expected a ContrastiveKFoldValSampler instance"
     num_folds = contrastive_sampler.k
-    _, labels, _, _, _ = get_partition_from_dataframe(data, partition="val")
-    fold: Dict[Any, int] = {}
-    for label in labels.unique():  # type: ignore
-        fold[label.item()] = contrastive_sampler.get_fold(label.item())
+    cache = cache if cache is not None else NeighborCache(k_max=k)
+
+    use_train_embeddings = False
+    _, val_labels, _, _, val_encoded_labels = cache.partition(data, partition="val")
+    n_val = len(val_labels)
+
+    unique_labels, label_inverse = torch.unique(val_labels, return_inverse=True)
+    label_folds = torch.tensor([contrastive_sampler.get_fold(label) for label in unique_labels.tolist()])
+    val_folds = label_folds[label_inverse]
+    cache.set_val_folds(data, val_folds)
+
+    # NOTE(rob2u): k // 2 + 1 for majority +1 because one is classified (classes never span folds)
+    min_amount = k // 2 + 2 if use_filter else 0
+    label_counts = torch.bincount(label_inverse)
+    classification_mask = label_counts[label_inverse] >= min_amount
+    if use_crossvideo_positives:
+        _, classification_mask_cv = cache.crossvideo_codes(data)
+        classification_mask = classification_mask & classification_mask_cv
+
+    closest_distances, closest_indices = cache.neighbors(
+        data,
+        k,
+        use_train_embeddings=use_train_embeddings,
+        distance_metric=distance_metric,
+        use_crossvideo_positives=use_crossvideo_positives,
+        backend=backend,
+    )
+
     fold_metrics = []
-    for i in range(num_folds):
-        fold_indices = [index for index, label in enumerate(labels) if fold[label.item()] == i]
-        fold_dataframe = data.iloc[fold_indices]
+    for fold in range(num_folds):
+        fold_rows = (val_folds == fold).nonzero().squeeze(1)
+        # NOTE: fold-local labels and indices, like in `knn` on the val rows of this fold only
         en = LinearSequenceEncoder()
-        fold_dataframe.loc[:, "encoded_label"] = fold_dataframe["encoded_label"].apply(en.encode)
-        metrics = knn(
-            data=fold_dataframe,
-            average=average,
-            k=k,
-            distance_metric=distance_metric,
-            use_crossvideo_positives=use_crossvideo_positives,
-            **kwargs,
+        fold_labels = torch.tensor(en.encode_list(val_encoded_labels[fold_rows].tolist()), dtype=torch.long)
+        local_labels = torch.full((n_val,), -1, dtype=torch.long)
+        local_labels[fold_rows] = fold_labels
+        local_indices = torch.full((n_val,), -1, dtype=torch.long)
+        local_indices[fold_rows] = torch.arange(len(fold_rows))
+
+        num_classes = len(en.mapping)
+        fold_k = min(k, num_classes)
+        fold_closest_indices = closest_indices[fold_rows, :fold_k]
+        fold_closest_distances = closest_distances[fold_rows, :fold_k]
+        # NOTE: a fold with at most fold_k val rows has masked (out-of-fold) neighbors, the top-k over the fold's
+        # own rows returned the query itself there (distance inf)
+        out_of_fold = local_indices[fold_closest_indices] < 0
+        self_rows = fold_rows.unsqueeze(1).expand_as(fold_closest_indices)
+        fold_closest_indices = torch.where(out_of_fold, self_rows, fold_closest_indices)
+        fold_closest_distances = fold_closest_distances.masked_fill(out_of_fold, float("inf"))
+        fold_metrics.append(
+            _knn_scores(
+                local_labels[fold_closest_indices],
+                fold_closest_distances,
+                local_indices[fold_closest_indices],
+                fold_labels,
+                classification_mask[fold_rows],
+                num_classes,
+                fold_k,
+                average,
+                tie_policy,
+                tie_seed,
+            )
         )
-        fold_metrics.append(metrics)
     assert len(fold_metrics) == num_folds
-    accumulated_metrics = {}
-    for metrics in fold_metrics:
-        for metric_name, value in metrics.items():
-            if metric_name not in accumulated_metrics:
-                accumulated_metrics[metric_name] = value
-            else:
-                accumulated_metrics[metric_name] += value
-    averaged_metrics = {metric_name: value / num_folds for metric_name, value in accumulated_metrics.items()}
 
+    averaged_metrics = {
+        metric_name: sum(metrics[metric_name] for metrics in fold_metrics) / num_folds
+        for metric_name in fold_metrics[0]
+    }
+    for fold, metrics in enumerate(fold_metrics):
+        averaged_metrics |= {f"val-fold-{fold}/{metric_name}": value for metric_name, value in metrics.items()}
     return averaged_metrics
 
 
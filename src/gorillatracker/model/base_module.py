@@ -14,9 +14,22 @@ from torch.optim.adamw import AdamW
 import gorillatracker.type_helper as gtypes
 from gorillatracker.data.nlet_dm import NletDataModule
 from gorillatracker.data.utils import flatten_batch, lazy_batch_size
+from gorillatracker.losses.arcface_loss import ArcFaceLoss
 from gorillatracker.losses.get_loss import get_loss
-from gorillatracker.metrics import evaluate_embeddings, knn, knn_kfold_val, knn_ssl, log_train_images_to_wandb, tsne
-from gorillatracker.utils.labelencoder import LinearSequenceEncoder
+from gorillatracker.metrics import (
+    NeighborCache,
+    evaluate_embeddings,
+    knn,
+    knn_kfold_val,
+    knn_ssl,
+    log_train_images_to_wandb,
+    tsne,
+)
+from gorillatracker.transform_utils import BatchAugmentation
+from gorillatracker.utils.embedding_accumulator import EMBEDDINGS_TABLE_COLUMNS, EmbeddingAccumulator
+from gorillatracker.utils.knn import get_neighbor_backend
+from gorillatracker.utils.labelencoder import TensorLabelEncoder
+from gorillatracker.utils.train_embedding_cache import RefreshPolicy, TrainEmbeddingCache
 
 
 def warmup_lr(
@@ -142,6 +155,12 @@ class BaseModule(L.LightningModule):
         use_inbatch_mixup: bool = False,
         kfold_k: Optional[int] = None,
         knn_with_train: bool = False,
+        knn_backend: str = "block",
+        val_loss_chunk_size: int = 4096,
+        train_embedding_cache_policy: RefreshPolicy = "every_n_epochs",
+        train_embedding_cache_refresh_interval: int = 1,
+        train_embedding_cache_momentum: float = 0.9,
+        train_embedding_cache_max_size: Optional[int] = None,
         use_quantization_aware_training: bool = False,
         every_n_val_epochs: int = 1,
         fast_dev_run: bool = False,
@@ -184,22 +203,24 @@ class BaseModule(L.LightningModule):
         self.kfold_k = kfold_k
         self.use_quantization_aware_training = use_quantization_aware_training
         self.knn_with_train = knn_with_train
+        self.knn_backend = knn_backend
+        self.val_loss_chunk_size = val_loss_chunk_size
+        self.train_embedding_cache = TrainEmbeddingCache(
+            policy=train_embedding_cache_policy,
+            refresh_every_n_epochs=train_embedding_cache_refresh_interval,
+            momentum=train_embedding_cache_momentum,
+            max_size=train_embedding_cache_max_size,
+        )
         self.wandb_run = wandb_run
         self.fast_dev_run = fast_dev_run
         self.every_n_val_epochs = every_n_val_epochs
         self.dm = data_module
 
-        ##### Create List of embeddings_tables
-        self.embeddings_table_columns = [
-            "label",
-            "embedding",
-            "id",
-            "partition",  # val for validation, train for training
-            "dataset",
-        ]  # note that the dataloader usually returns the order (id, embedding, label)
+        ##### Create List of embedding accumulators, one per validation dataloader
+        self.embeddings_table_columns = EMBEDDINGS_TABLE_COLUMNS
         self.dataset_names = dataset_names
-        self.embeddings_table_list = [
-            pd.DataFrame(columns=self.embeddings_table_columns) for _ in range(len(self.dataset_names))
+        self.embedding_accumulators = [
+            EmbeddingAccumulator(self.embedding_size, self.dataset_names) for _ in range(len(self.dataset_names))
         ]
         self.accelerator = accelerator
 
@@ -241,6 +262,7 @@ class BaseModule(L.LightningModule):
             l2_alpha=l2_alpha,
             l2_beta=l2_beta,
             path_to_pretrained_weights=path_to_pretrained_weights,
+            l2sp_exclude=kwargs.get("l2sp_exclude", ()),
             use_focal_loss=use_focal_loss,
             label_smoothing=label_smoothing,
             model=model,
@@ -268,6 +290,7 @@ class BaseModule(L.LightningModule):
             l2_alpha=l2_alpha,
             l2_beta=l2_beta,
             path_to_pretrained_weights=path_to_pretrained_weights,
+            l2sp_exclude=kwargs.get("l2sp_exclude", ()),
             use_focal_loss=use_focal_loss,
             label_smoothing=label_smoothing,
             model=model,
@@ -290,20 +313,20 @@ class BaseModule(L.LightningModule):
 
     def perform_mixup(self, flat_images: torch.Tensor, flat_labels: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
         num_classes: int
+        flat_labels = flat_labels.to(flat_images.device)
         if "l2sp" in self.loss_mode and not self.use_dist_term:
             num_classes = self.loss_module_train.loss.num_classes  # type: ignore
-            flat_labels = self.loss_module_train.loss.le.encode_list(flat_labels.tolist())  # type: ignore
+            flat_labels = self.loss_module_train.loss.le.encode_tensor(flat_labels)  # type: ignore
         elif "l2sp" in self.loss_mode and self.use_dist_term:
             num_classes = self.loss_module_train.loss.arcface.num_classes  # type: ignore
-            flat_labels = self.loss_module_train.loss.arcface.le.encode_list(flat_labels.tolist())  # type: ignore
+            flat_labels = self.loss_module_train.loss.arcface.le.encode_tensor(flat_labels)  # type: ignore
         elif "l2sp" not in self.loss_mode and self.use_dist_term:
             num_classes = self.loss_module_train.arcface.num_classes  # type: ignore
-            flat_labels = self.loss_module_train.arcface.le.encode_list(flat_labels.tolist())  # type: ignore
+            flat_labels = self.loss_module_train.arcface.le.encode_tensor(flat_labels)  # type: ignore
         else:
             num_classes = self.loss_module_train.num_classes  # type: ignore
-            flat_labels = self.loss_module_train.le.encode_list(flat_labels.tolist())  # type: ignore
+            flat_labels = self.loss_module_train.le.encode_tensor(flat_labels)  # type: ignore
 
-        flat_labels = torch.tensor(flat_labels).to(flat_images.device)
         flat_labels_onehot = torch.nn.functional.one_hot(flat_labels, num_classes).float()
         flat_images, flat_labels_onehot = in_batch_mixup(flat_images, flat_labels_onehot)
 
@@ -332,6 +355,9 @@ class BaseModule(L.LightningModule):
         embeddings = self.forward(flat_images)
 
         assert not torch.isnan(embeddings).any(), f"Embeddings are NaN: {embeddings}"
+        if self.knn_with_train and not self.use_inbatch_mixup:  # NOTE: reuse the anchor embeddings for kNN with train
+            batch_size = lazy_batch_size(batch)
+            self.train_embedding_cache.update(embeddings[:batch_size], flat_labels[:batch_size], flat_ids[:batch_size])
         loss, pos_dist, neg_dist = self.loss_module_train(embeddings=embeddings, labels=flat_labels, images=flat_images, labels_onehot=flat_labels_onehot, ids=flat_ids)  # type: ignore
 
         log_str_prefix = f"fold-{self.kfold_k}/" if self.kfold_k is not None else ""
@@ -349,22 +375,8 @@ class BaseModule(L.LightningModule):
         dataloader_idx: int,
     ) -> None:
         # save anchor embeddings of validation step for later analysis in W&B
-        embeddings = torch.reshape(anchor_embeddings, (-1, self.embedding_size))
-        embeddings = embeddings.cpu()
-
-        assert len(self.embeddings_table_columns) == 5, "Embeddings table columns are not set correctly."
-        anchor_labels_list = anchor_labels.tolist()
-        data = {
-            self.embeddings_table_columns[0]: [int(x) for x in anchor_labels_list],
-            self.embeddings_table_columns[1]: [embedding.numpy() for embedding in embeddings],
-            self.embeddings_table_columns[2]: anchor_ids,
-            self.embeddings_table_columns[3]: "val",
-            self.embeddings_table_columns[4]: self.dataset_names[dataloader_idx],
-        }
-
-        df = pd.DataFrame(data)
-        self.embeddings_table_list[dataloader_idx] = pd.concat(
-            [df, self.embeddings_table_list[dataloader_idx]], ignore_index=True
+        self.embedding_accumulators[dataloader_idx].add(
+            anchor_ids, anchor_embeddings, anchor_labels, dataloader_idx=dataloader_idx, partition="val"
         )
         # NOTE(rob2u): will get flushed by W&B Callback on val epoch end.
 
@@ -411,10 +423,11 @@ class BaseModule(L.LightningModule):
         dataloader_name = self.dataset_names[dataloader_idx]
         kfold_prefix = f"fold-{self.kfold_k}/" if self.kfold_k is not None else ""
 
-        if "softmax" in self.loss_mode:
-            self.validation_loss_softmax(dataloader_name, kfold_prefix)
+        # NOTE: the DataFrame view is only built here, gathered from all processes when running distributed
+        embeddings_table_list = [accumulator.all_gather().to_dataframe() for accumulator in self.embedding_accumulators]
 
-        embeddings_table_list = self.embeddings_table_list
+        if "softmax" in self.loss_mode:
+            self.validation_loss_softmax(dataloader_name, kfold_prefix, embeddings_table_list)
 
         assert self.trainer.max_epochs is not None
         for dataloader_idx, embeddings_table in enumerate(embeddings_table_list):
@@ -424,10 +437,9 @@ class BaseModule(L.LightningModule):
                 else:
                     self.wandb_run.log({key: val})
 
-        # clear the table where the embeddings are stored
-        self.embeddings_table_list = [
-            pd.DataFrame(columns=self.embeddings_table_columns) for _ in range(len(self.dataset_names))
-        ]  # reset embeddings table
+        # clear the accumulators where the embeddings are stored
+        for accumulator in self.embedding_accumulators:
+            accumulator.reset()
 
     def lambda_schedule(self, epoch: int) -> float:
         if self.stepwise_schedule:
@@ -505,12 +517,28 @@ class BaseModule(L.LightningModule):
             )
             return {"optimizer": optimizer, "lr_scheduler": plateau_scheduler}
 
+    def on_save_checkpoint(self, checkpoint: Dict[str, Any]) -> None:
+        self.train_embedding_cache.mark_stale()
+
     def _get_train_embeddings_for_knn(self, trainer: L.Trainer) -> Tuple[torch.Tensor, torch.Tensor, list[gtypes.Id]]:
+        """Returns the training-set gallery, recomputed only when the train embedding cache policy asks for it."""
+        epoch, global_step = self.current_epoch, trainer.global_step
+        if self.train_embedding_cache.needs_refresh(epoch, global_step):
+            train_embeddings, train_labels, train_ids = self._compute_train_embeddings_for_knn(trainer)
+            self.train_embedding_cache.refresh(train_embeddings, train_labels, train_ids, epoch, global_step)
+        return self.train_embedding_cache.get()
+
+    def _compute_train_embeddings_for_knn(
+        self, trainer: L.Trainer
+    ) -> Tuple[torch.Tensor, torch.Tensor, list[gtypes.Id]]:
         assert trainer.model is not None, "Model must be initalized before validation phase."
         train_embedding_batches = []
         train_labels = torch.tensor([])
         train_ids: list[gtypes.Id] = []
+        max_size = self.train_embedding_cache.max_size
         for batch in self.dm.train_dataloader():
+            if max_size is not None and len(train_ids) >= max_size:
+                break
             batch_size = lazy_batch_size(batch)
             flat_ids, flat_images, flat_labels = flatten_batch(batch)
             anchor_labels = flat_labels[:batch_size]
@@ -546,6 +574,7 @@ class BaseModule(L.LightningModule):
                 ],
                 ignore_index=True,
             )
+        use_crossvideo = "cxl" in dataset_id.lower() or "bristol" in dataset_id.lower()
         knn_func = knn
         if dataset_id == "SSLDataset":
             knn_func = knn_ssl  # type: ignore
@@ -619,7 +648,7 @@ class BaseModule(L.LightningModule):
                     knn_func, k=5, use_crossvideo_positives=True, average="macro", distance_metric="cosine"
                 ),
             }
-            if ("cxl" in dataset_id.lower() or "bristol" in dataset_id.lower()) and knn_func is not knn_ssl
+            if use_crossvideo and knn_func is not knn_ssl
             else {}
         )
         metrics |= (
@@ -637,17 +666,23 @@ class BaseModule(L.LightningModule):
                     knn_func, k=5, use_crossvideo_positives=True, use_train_embeddings=True, distance_metric="cosine"
                 ),
             }
-            if self.knn_with_train
-            and dataloader_idx == 0
-            and knn_func is knn
-            and ("cxl" in dataset_id.lower() or "bristol" in dataset_id.lower())
+            if self.knn_with_train and dataloader_idx == 0 and knn_func is knn and use_crossvideo
             else {}
         )
+        # NOTE: all knn variants of this table share one distance matrix and neighbor list per embedding set and metric
+        backend = get_neighbor_backend(
+            self.knn_backend, **({} if "faiss" in self.knn_backend else {"device": self.device})
+        )
+        neighbor_cache = NeighborCache(k_max=5, crossvideo=use_crossvideo, backend=backend)
         for metric_name, metric_func in metrics.items():
+            if knn_func is knn:
+                metrics[metric_name] = partial(metric_func, cache=neighbor_cache)
             if knn_func is knn_ssl:
                 metrics[metric_name] = partial(metric_func, dm=self.dm)
             if knn_func is knn_kfold_val:
-                metrics[metric_name] = partial(metric_func, dm=self.dm, current_val_index=dataloader_idx)
+                metrics[metric_name] = partial(
+                    metric_func, dm=self.dm, current_val_index=dataloader_idx, cache=neighbor_cache
+                )
         if knn_func is knn:
             metrics |= {
                 "tsne": tsne,  # type: ignore
@@ -665,56 +700,66 @@ class BaseModule(L.LightningModule):
             metrics=metrics,
             kfold_k=self.kfold_k if hasattr(self, "kfold_k") else None,  # TODO(memben)
             dataloader_name=dataloader_name,
+            backends={metric_name: backend for metric_name in metrics} if knn_func is knn_ssl else None,
         )
         return results
 
-    def validation_loss_softmax(self, dataloader_name: str, kfold_prefix: str) -> None:
-        for i, table in enumerate(self.embeddings_table_list):
-            logger.info(f"Calculating loss for all embeddings from dataloader {i}: {len(table)}")
+    def validation_loss_softmax(
+        self, dataloader_name: str, kfold_prefix: str, embeddings_table_list: list[pd.DataFrame]
+    ) -> list[torch.Tensor]:
+        """Logs the mean softmax loss per dataloader, prototypes are the class means of the validation embeddings.
 
-            # get weights for all classes by averaging over all embeddings
-            loss_module_val = (
-                self.loss_module_val if not self.loss_mode.endswith("l2sp") else self.loss_module_val.loss  # type: ignore
-            )
-            if self.use_dist_term:
-                loss_module_val = loss_module_val.arcface
+        Returns the per-embedding losses (in table order) for every dataloader. The tables are not modified.
+        """
+        loss_module_val = (
+            self.loss_module_val if not self.loss_mode.endswith("l2sp") else self.loss_module_val.loss  # type: ignore
+        )
+        if self.use_dist_term:
+            loss_module_val = loss_module_val.arcface
+        assert isinstance(loss_module_val, ArcFaceLoss), "The softmax validation loss needs an ArcFace loss module"
 
-            num_classes = table["label"].nunique()  # TODO(memben + rob2u)
+        per_row_losses = []
+        for i, table in enumerate(embeddings_table_list):
+            logger.info(f"Calculating loss for all embeddings from dataloader {i}: {len(table)}")
             assert len(table) > 0, f"Empty table for dataloader {i}"
 
-            # get weights for all classes by averaging over all embeddings
-            class_weights = torch.zeros(num_classes, self.embedding_size).to(self.device)
-            lse = LinearSequenceEncoder()
-            table["label"] = table["label"].apply(lse.encode)
-
-            for label in range(num_classes):
-                class_embeddings = table[table["label"] == label]["embedding"].tolist()
-                class_embeddings = (
-                    np.stack(class_embeddings) if len(class_embeddings) > 0 else np.zeros((0, self.embedding_size))
-                )
-                class_weights[label] = torch.tensor(class_embeddings).mean(dim=0)
-                if torch.isnan(class_weights[label]).any():
-                    class_weights[label] = 0.0
+            embeddings = torch.tensor(np.stack(table["embedding"].tolist()), dtype=torch.float32, device=self.device)
+            labels = torch.tensor(table["label"].tolist(), device=self.device)
+            lse = TensorLabelEncoder()
+            encoded_labels = lse.encode_tensor(labels)
+            num_classes = len(lse.mapping)  # TODO(memben + rob2u)
 
-            # calculate loss for all embeddings
+            # get weights for all classes by averaging over all embeddings
+            class_weights = torch.zeros(num_classes, self.embedding_size, device=self.device)
+            class_weights.index_add_(0, encoded_labels, embeddings)
+            class_counts = torch.bincount(encoded_labels, minlength=num_classes).unsqueeze(1)
+            class_weights = class_weights / class_counts
             loss_module_val.update(class_weights, num_classes, lse)
 
-            losses = []
-            for _, row in table.iterrows():
-                loss, _, _ = loss_module_val(
-                    torch.tensor(row["embedding"]).unsqueeze(0),
-                    torch.tensor(lse.decode(row["label"])).unsqueeze(0),
-                )
-                losses.append(loss)
-            loss = torch.tensor(losses).mean()
+            # calculate loss for all embeddings, chunked to bound the memory of the batch x classes logits
+            chunk_losses = []
+            for start in range(0, len(labels), self.val_loss_chunk_size):
+                end = start + self.val_loss_chunk_size
+                chunk_loss, _, _ = loss_module_val(embeddings[start:end], labels[start:end], reduction="none")
+                chunk_losses.append(chunk_loss)
+            losses = torch.cat(chunk_losses)
+            loss = losses.mean()
             assert not torch.isnan(loss).any(), f"Loss is NaN: {losses}"
             self.log(f"{dataloader_name}/{kfold_prefix}val/loss", loss, sync_dist=True)
+            per_row_losses.append(losses)
+        return per_row_losses
 
     @classmethod
     def get_training_transforms(cls) -> Callable[[torch.Tensor], torch.Tensor]:
         """Add your data augmentations here. Function will be called after in the training loop"""
         return lambda x: x
 
+    @classmethod
+    def get_batch_augmentation(cls, seed: Optional[int] = None) -> Optional[BatchAugmentation]:
+        """Batched on-device equivalent of `get_training_transforms` (see `TrainingArgs.device_augmentation`), None
+        if the model has none."""
+        return None
+
     @classmethod
     def get_tensor_transforms(cls) -> None:
         raise NotImplementedError(
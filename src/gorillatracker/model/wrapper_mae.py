@@ -105,6 +105,7 @@ class MaskedVisionTransformer(BaseModule):
                 # kwargs["l2_alpha"],
                 0.0,
                 kwargs["l2_beta"],
+                exclude=kwargs.get("l2sp_exclude", ()),
             )
 
             self.l2_decoder = L2(
@@ -1,5 +1,5 @@
 import copy
-from typing import Callable
+from typing import Callable, Optional
 
 import timm
 import torch
@@ -13,7 +13,7 @@ from torchvision import transforms
 import gorillatracker.type_helper as gtypes
 from gorillatracker.data.utils import flatten_batch
 from gorillatracker.model.base_module import BaseModule
-from gorillatracker.transform_utils import PlanckianJitter
+from gorillatracker.transform_utils import BatchAugmentation, PlanckianJitter
 
 
 class SimCLRWrapper(BaseModule):
@@ -53,6 +53,10 @@ class SimCLRWrapper(BaseModule):
             ]
         )
 
+    @classmethod
+    def get_batch_augmentation(cls, seed: Optional[int] = None) -> Optional[BatchAugmentation]:
+        return BatchAugmentation(size=224, erase_scale=(0.02, 0.13), degrees=60, crop_scale=(0.75, 1.0), seed=seed)
+
 
 # TODO: MoCoWrapper is not fully tested yet.
 class MoCoWrapper(BaseModule):
@@ -118,6 +122,10 @@ class MoCoWrapper(BaseModule):
             ]
         )
 
+    @classmethod
+    def get_batch_augmentation(cls, seed: Optional[int] = None) -> Optional[BatchAugmentation]:
+        return BatchAugmentation(size=224, erase_scale=(0.02, 0.13), degrees=60, crop_scale=(0.75, 1.0), seed=seed)
+
 
 class BYOLWrapper(BaseModule):
     def __init__(  # type: ignore
@@ -183,3 +191,7 @@ class BYOLWrapper(BaseModule):
                 transforms_v2.RandomResizedCrop(224, scale=(0.75, 1.0)),
             ]
         )
+
+    @classmethod
+    def get_batch_augmentation(cls, seed: Optional[int] = None) -> Optional[BatchAugmentation]:
+        return BatchAugmentation(size=224, erase_scale=(0.02, 0.13), degrees=60, crop_scale=(0.75, 1.0), seed=seed)
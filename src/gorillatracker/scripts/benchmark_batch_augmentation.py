@@ -0,0 +1,57 @@
+"""Images/s of the per-image worker augmentation of the SSL wrappers vs. `BatchAugmentation` on whole batches.
+
+The worker pipeline runs single threaded like inside a DataLoader worker, the batched pipeline runs on the GPU if
+available and on the CPU otherwise.
+"""
+
+import time
+
+import pandas as pd
+import torch
+
+from gorillatracker.model.wrappers_ssl import SimCLRWrapper
+
+
+def benchmark_batch_augmentation(
+    batch_sizes: tuple[int, ...] = (32, 128), input_size: int = 256, repeats: int = 3
+) -> pd.DataFrame:
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    worker_transforms = SimCLRWrapper.get_training_transforms()
+    batch_augmentation = SimCLRWrapper.get_batch_augmentation(seed=0)
+    assert batch_augmentation is not None
+    rows = []
+    for batch_size in batch_sizes:
+        images = torch.randint(0, 256, (batch_size, 3, input_size, input_size), dtype=torch.uint8)
+
+        threads = torch.get_num_threads()
+        torch.set_num_threads(1)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            torch.stack([worker_transforms(image.float() / 255) for image in images])
+        worker_rate = repeats * batch_size / (time.perf_counter() - start)
+        torch.set_num_threads(threads)
+
+        device_images = images.to(device)
+        batch_augmentation(device_images)  # NOTE: warmup
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            batch_augmentation(device_images)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        batched_rate = repeats * batch_size / (time.perf_counter() - start)
+
+        rows.append(
+            {
+                "batch_size": batch_size,
+                "worker_images_per_s": round(worker_rate, 1),
+                f"batched_{device.type}_images_per_s": round(batched_rate, 1),
+            }
+        )
+        print(rows[-1])
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    print(benchmark_batch_augmentation().to_string(index=False))
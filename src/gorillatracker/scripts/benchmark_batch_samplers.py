@@ -0,0 +1,64 @@
+"""Valid online triplets per batch with plain shuffling vs. P x K batches on a synthetic long-tailed dataset.
+
+The class sizes follow a Zipf distribution like the individuals of CXL, every individual appears in a few videos.
+"""
+
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+import torch
+
+from gorillatracker.data.batch_sampler import PKBatchSampler
+from gorillatracker.losses.triplet_loss import count_valid_triplets
+
+
+def make_long_tailed_labels(
+    n_classes: int = 150, max_class_size: int = 200, videos_per_class: int = 5, seed: int = 0
+) -> tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    sizes = np.maximum(1, (max_class_size / np.arange(1, n_classes + 1)).astype(int))
+    labels = np.repeat(np.arange(n_classes), sizes)
+    video_ids = labels * videos_per_class + rng.integers(0, videos_per_class, len(labels))
+    return labels, video_ids
+
+
+def shuffled_batches(n_samples: int, batch_size: int, seed: int = 0) -> Iterator[list[int]]:
+    permutation = np.random.default_rng(seed).permutation(n_samples)
+    for start in range(0, n_samples - batch_size + 1, batch_size):
+        yield permutation[start : start + batch_size].tolist()
+
+
+def batch_statistics(batch: list[int], labels: np.ndarray, video_ids: np.ndarray) -> dict[str, float]:
+    batch_labels = torch.from_numpy(labels[batch])
+    has_positive = (batch_labels.unsqueeze(0) == batch_labels.unsqueeze(1)).sum(dim=1) > 1
+    identities = np.unique(labels[batch])
+    videos = [len(np.unique(video_ids[batch][labels[batch] == identity])) for identity in identities]
+    return {
+        "valid_triplets": count_valid_triplets(batch_labels).item(),
+        "anchors_with_positive": has_positive.float().mean().item(),
+        "videos_per_identity": float(np.mean(videos)),
+    }
+
+
+def benchmark_batch_samplers(
+    batch_sizes: tuple[int, ...] = (32, 64), p_values: tuple[int, ...] = (4, 8)
+) -> pd.DataFrame:
+    labels, video_ids = make_long_tailed_labels()
+    rows = []
+    for batch_size in batch_sizes:
+        strategies: dict[str, Iterator[list[int]]] = {"shuffle": shuffled_batches(len(labels), batch_size)}
+        for p in p_values:
+            strategies[f"pk-{p}x{batch_size // p}"] = iter(PKBatchSampler(labels, p, batch_size // p))
+            strategies[f"pk-{p}x{batch_size // p}-video"] = iter(
+                PKBatchSampler(labels, p, batch_size // p, video_ids=video_ids)
+            )
+        for name, batches in strategies.items():
+            stats = pd.DataFrame([batch_statistics(batch, labels, video_ids) for batch in batches]).mean()
+            rows.append({"batch_size": batch_size, "sampler": name, **stats.round(3).to_dict()})
+            print(rows[-1])
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    print(benchmark_batch_samplers().to_string(index=False))
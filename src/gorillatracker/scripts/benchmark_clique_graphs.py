@@ -0,0 +1,70 @@
+"""Scaling of the dict based and the array based clique graph engines on synthetic cliques.
+
+Every clique is a chain of `clique_size` merges, consecutive cliques are partitioned. Large sizes are only run with the
+array engine on `range(n)` vertices (no vertex to index map), the dict engine stops at `max_dict_vertices`.
+"""
+
+import argparse
+import random
+import time
+from typing import Any, Callable, Sequence
+
+import pandas as pd
+
+from gorillatracker.ssl_pipeline.data_structures import ArrayCliqueGraph, CliqueGraph
+
+ENGINES: dict[str, Callable[[Sequence[int]], Any]] = {
+    "dict": lambda vertices: CliqueGraph(list(vertices)),
+    "array": ArrayCliqueGraph,
+}
+
+
+def benchmark_clique_graphs(
+    n_vertices: tuple[int, ...] = (10_000, 100_000, 1_000_000, 10_000_000),
+    clique_size: int = 10,
+    draws: int = 100_000,
+    max_dict_vertices: int = 1_000_000,
+) -> pd.DataFrame:
+    rows = []
+    for n in n_vertices:
+        for name, engine in ENGINES.items():
+            if name == "dict" and n > max_dict_vertices:
+                continue
+            row: dict[str, object] = {"engine": name, "n_vertices": n}
+            start = time.perf_counter()
+            graph = engine(range(n))
+            row["init_s"] = round(time.perf_counter() - start, 3)
+
+            start = time.perf_counter()
+            for v in range(n):
+                if v % clique_size:
+                    graph.merge(v - 1, v)
+                elif v:
+                    graph.partition(v - 1, v)
+            row["build_s"] = round(time.perf_counter() - start, 3)
+
+            anchors = [random.randrange(n) for _ in range(draws)]
+            start = time.perf_counter()
+            for anchor in anchors:
+                graph.get_random_clique_member(anchor, exclude=[anchor])
+            row["positive_per_s"] = round(draws / (time.perf_counter() - start))
+            start = time.perf_counter()
+            for anchor in anchors:
+                graph.get_random_clique_member(graph.get_random_adjacent_clique(anchor))
+            row["negative_per_s"] = round(draws / (time.perf_counter() - start))
+            rows.append(row)
+            print(row)
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n_vertices", type=int, nargs="+", default=[10_000, 100_000, 1_000_000, 10_000_000])
+    parser.add_argument("--clique_size", type=int, default=10)
+    parser.add_argument("--max_dict_vertices", type=int, default=1_000_000)
+    args = parser.parse_args()
+    print(
+        benchmark_clique_graphs(
+            tuple(args.n_vertices), args.clique_size, max_dict_vertices=args.max_dict_vertices
+        ).to_string(index=False)
+    )
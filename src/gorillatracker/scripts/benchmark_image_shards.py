@@ -0,0 +1,48 @@
+"""Samples/sec of `SupervisedDataset` (one image file per sample) vs. `ShardedSupervisedDataset` (memory-mapped shard).
+
+Build the shards first with `gorillatracker.scripts.build_image_shards`.
+"""
+
+import time
+from pathlib import Path
+
+import pandas as pd
+from torch.utils.data import DataLoader
+from torchvision import transforms
+
+from gorillatracker.data.nlet import ShardedSupervisedDataset, SupervisedDataset, build_onelet
+
+
+def benchmark_image_shards(
+    data_dir: Path,
+    shard_dir: Path,
+    partition: str = "train",
+    image_size: int = 224,
+    n_samples: int = 2_000,
+    workers: tuple[int, ...] = (0, 4),
+    batch_size: int = 64,
+) -> pd.DataFrame:
+    rows = []
+    transform = transforms.Resize((image_size, image_size), antialias=True)
+    for name, dataset_class, base_dir in (
+        ("per-file", SupervisedDataset, data_dir),
+        ("shard", ShardedSupervisedDataset, shard_dir),
+    ):
+        dataset = dataset_class(base_dir, build_onelet, partition, transform)  # type: ignore
+        n = min(n_samples, len(dataset))
+        for num_workers in workers:
+            loader = DataLoader(dataset, batch_size=batch_size, sampler=range(n), num_workers=num_workers)
+            start = time.perf_counter()
+            for _ in loader:
+                pass
+            elapsed = time.perf_counter() - start
+            rows.append({"format": name, "workers": num_workers, "samples_per_s": round(n / elapsed, 1)})
+            print(rows[-1])
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    data_dir = Path(
+        "/workspaces/gorillatracker/data/splits/ground_truth-cxl-face_images-openset-reid-val-0-test-0-mintraincount-3-seed-42-train-50-val-25-test-25"
+    )
+    print(benchmark_image_shards(data_dir, data_dir.parent / f"{data_dir.name}_shards").to_string(index=False))
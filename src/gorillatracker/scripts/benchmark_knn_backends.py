@@ -0,0 +1,60 @@
+"""Recall vs. latency of the nearest-neighbour backends used by the kNN metrics on synthetic clustered embeddings.
+
+The exact block backend serves as reference, recall@k is the fraction of the exact k neighbors that are found.
+"""
+
+import time
+from typing import Literal
+
+import pandas as pd
+import torch
+
+from gorillatracker.utils.knn import NEIGHBOR_BACKENDS, get_neighbor_backend
+
+
+def make_clustered_embeddings(n_samples: int, dim: int, n_classes: int, seed: int = 0) -> torch.Tensor:
+    generator = torch.Generator().manual_seed(seed)
+    centers = torch.randn(n_classes, dim, generator=generator)
+    labels = torch.randint(0, n_classes, (n_samples,), generator=generator)
+    return centers[labels] + 0.5 * torch.randn(n_samples, dim, generator=generator)
+
+
+def benchmark_knn_backends(
+    sizes: tuple[int, ...] = (2_000, 20_000, 100_000),
+    dim: int = 256,
+    n_classes: int = 500,
+    k: int = 5,
+    distance_metric: Literal["euclidean", "cosine"] = "cosine",
+    backends: tuple[str, ...] = NEIGHBOR_BACKENDS,
+    brute_force_max_size: int = 10_000,
+) -> pd.DataFrame:
+    rows = []
+    for n_samples in sizes:
+        embeddings = make_clustered_embeddings(n_samples, dim, n_classes)
+        reference = None
+        for name in ("block", *[b for b in backends if b != "block"]):
+            if name == "brute-force" and n_samples > brute_force_max_size:
+                continue  # NOTE: the full distance matrix would not fit into memory
+            backend = get_neighbor_backend(name)
+            start = time.perf_counter()
+            ((_, indices),) = backend.search(
+                embeddings, embeddings, k, distance_metric=distance_metric, exclude_self=True
+            )
+            latency = time.perf_counter() - start
+            if reference is None:
+                reference = indices
+            hits = (indices.unsqueeze(2) == reference.unsqueeze(1)).any(dim=2).sum().item()
+            rows.append(
+                {
+                    "backend": name,
+                    "n_samples": n_samples,
+                    "latency_s": round(latency, 3),
+                    f"recall@{k}": round(hits / reference.numel(), 4),
+                }
+            )
+            print(rows[-1])
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    print(benchmark_knn_backends().to_string(index=False))
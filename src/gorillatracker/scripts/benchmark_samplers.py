@@ -0,0 +1,61 @@
+"""Positive and negative draws per second of the contrastive class samplers on synthetic classes.
+
+Ids follow the CXL naming <ID>_<CAMERA>_<DATE>_..., so every class spreads over several individual videos.
+"""
+
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from gorillatracker.data.contrastive_sampler import (
+    ContrastiveClassSampler,
+    ContrastiveImage,
+    SupervisedCrossEncounterSampler,
+    SupervisedHardCrossEncounterSampler,
+)
+
+SAMPLERS: tuple[type[ContrastiveClassSampler], ...] = (
+    ContrastiveClassSampler,
+    SupervisedCrossEncounterSampler,
+    SupervisedHardCrossEncounterSampler,
+)
+
+
+def make_classes(n_classes: int, samples_per_class: int, videos_per_class: int) -> dict[int, list[ContrastiveImage]]:
+    classes = {}
+    for label in range(n_classes):
+        ids = [f"G{label}_R{i % videos_per_class}_20240101_{i}.png" for i in range(samples_per_class)]
+        classes[label] = [ContrastiveImage(id, Path(id), label) for id in ids]
+    return classes
+
+
+def benchmark_samplers(
+    n_classes: tuple[int, ...] = (100, 1_000, 10_000),
+    samples_per_class: int = 20,
+    videos_per_class: int = 4,
+    draws: int = 100_000,
+) -> pd.DataFrame:
+    rows = []
+    for n in n_classes:
+        classes = make_classes(n, samples_per_class, videos_per_class)
+        for sampler_class in SAMPLERS:
+            start = time.perf_counter()
+            sampler = sampler_class(classes, seed=0)
+            build_s = time.perf_counter() - start
+            anchors = [sampler[i % len(sampler)] for i in range(0, draws * 7919, 7919)]
+            row: dict[str, object] = {"sampler": sampler_class.__name__, "n_samples": len(sampler)}
+            row["build_s"] = round(build_s, 3)
+            for draw in ("positive", "negative"):
+                draw_fn = getattr(sampler, draw)
+                start = time.perf_counter()
+                for anchor in anchors:
+                    draw_fn(anchor)
+                row[f"{draw}_per_s"] = round(draws / (time.perf_counter() - start))
+            rows.append(row)
+            print(row)
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    print(benchmark_samplers().to_string(index=False))
@@ -0,0 +1,134 @@
+"""Step time and peak memory of `TripletLossOnline` vs. the (batch_size, batch_size, batch_size) triplet mask losses.
+
+A step is the forward and backward pass of the loss on random embeddings with P x K labels. On CUDA the peak is the
+allocator peak, on the CPU every measurement runs in a forked process and the peak is the growth of its max RSS. The
+triplet mask formulation stops at `max_mask_batch_size`.
+"""
+
+import argparse
+import multiprocessing as mp
+import resource
+import time
+from typing import Callable
+
+import pandas as pd
+import torch
+
+from gorillatracker.losses.triplet_loss import (
+    TripletLossOnline,
+    euclidean_distance_matrix,
+    get_hard_mask,
+    get_semi_hard_mask,
+    get_triplet_mask,
+    masked_triplet_loss,
+)
+
+MODES = ("hard", "semi-hard", "soft")
+TRIPLET_MASKS: dict[str, Callable[[torch.Tensor, torch.Tensor, float], torch.Tensor]] = {
+    "hard": lambda labels, distance_matrix, margin: get_hard_mask(labels, distance_matrix),
+    "semi-hard": get_semi_hard_mask,
+    "soft": lambda labels, distance_matrix, margin: get_triplet_mask(labels),
+}
+
+
+def triplet_mask_loss(embeddings: torch.Tensor, labels: torch.Tensor, mode: str, margin: float) -> torch.Tensor:
+    distance_matrix = euclidean_distance_matrix(embeddings)
+    triplet_mask = TRIPLET_MASKS[mode](labels, distance_matrix, margin)
+    loss_sum, _, _, count = masked_triplet_loss(distance_matrix, triplet_mask, margin)
+    return loss_sum / count
+
+
+def time_steps(
+    implementation: str, mode: str, batch_size: int, embedding_dim: int, repeats: int, device: str
+) -> tuple[float, float]:
+    """Mean step time in ms of `repeats` steps after one warmup step and the peak memory in MiB of all steps."""
+    if device == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    else:
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    labels = torch.arange(batch_size, device=device) // 4  # NOTE: 4 images per individual like P x K batches
+    embeddings = torch.randn(batch_size, embedding_dim, device=device, requires_grad=True)
+    loss_module = TripletLossOnline(margin=1.0, mode=mode)  # type: ignore
+
+    def step() -> None:
+        if implementation == "pairwise":
+            loss = loss_module(embeddings, labels)[0]
+        else:
+            loss = triplet_mask_loss(embeddings, labels, mode, margin=1.0)
+        loss.backward()
+
+    step()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        step()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    step_ms = (time.perf_counter() - start) / repeats * 1000
+    if device == "cuda":
+        peak = torch.cuda.max_memory_allocated() - base
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - base
+    return step_ms, peak / 2**20
+
+
+def _time_steps_in_child(queue: "mp.Queue[tuple[float, float]]", *args: object) -> None:
+    queue.put(time_steps(*args))  # type: ignore
+
+
+def measure(
+    implementation: str, mode: str, batch_size: int, embedding_dim: int, repeats: int, device: str
+) -> tuple[float, float]:
+    if device == "cuda":
+        return time_steps(implementation, mode, batch_size, embedding_dim, repeats, device)
+    # NOTE: a fresh process per measurement, the max RSS of this process only ever grows
+    context = mp.get_context("fork")
+    queue: "mp.Queue[tuple[float, float]]" = context.Queue()
+    args = (queue, implementation, mode, batch_size, embedding_dim, repeats, device)
+    process = context.Process(target=_time_steps_in_child, args=args)
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def benchmark_triplet_loss(
+    batch_sizes: tuple[int, ...] = (32, 64, 128, 256, 512, 1024),
+    embedding_dim: int = 256,
+    repeats: int = 5,
+    max_mask_batch_size: int = 256,
+    device: str = "cuda" if torch.cuda.is_available() else "cpu",
+) -> pd.DataFrame:
+    rows = []
+    for batch_size in batch_sizes:
+        for mode in MODES:
+            for implementation in ("pairwise", "triplet-mask"):
+                if implementation == "triplet-mask" and batch_size > max_mask_batch_size:
+                    continue
+                step_ms, peak_mib = measure(implementation, mode, batch_size, embedding_dim, repeats, device)
+                row = {
+                    "batch_size": batch_size,
+                    "mode": mode,
+                    "implementation": implementation,
+                    "step_ms": round(step_ms, 2),
+                    "peak_mib": round(peak_mib, 1),
+                }
+                rows.append(row)
+                print(row)
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[32, 64, 128, 256, 512, 1024])
+    parser.add_argument("--embedding_dim", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--max_mask_batch_size", type=int, default=256)
+    args = parser.parse_args()
+    print(
+        benchmark_triplet_loss(
+            tuple(args.batch_sizes), args.embedding_dim, args.repeats, args.max_mask_batch_size
+        ).to_string(index=False)
+    )
@@ -0,0 +1,28 @@
+"""Converts a supervised dataset directory (see `SupervisedDataset`) into image shards for `ShardedSupervisedDataset`."""
+
+import os
+from pathlib import Path
+
+from gorillatracker.data.nlet import group_images_by_label
+from gorillatracker.data.shards import write_image_shard
+from gorillatracker.utils.labelencoder import LabelEncoder
+
+
+def build_image_shards(
+    data_dir: Path, shard_dir: Path, image_size: int = 224, partitions: tuple[str, ...] = ("train", "val", "test")
+) -> None:
+    """Writes one shard per partition directory, or a single shard if `data_dir` has no partition directories."""
+    partition_dirs = {p: data_dir / p for p in partitions if os.path.isdir(data_dir / p)}
+    if not partition_dirs:
+        partition_dirs = {"": data_dir}
+    for partition, partition_dir in partition_dirs.items():
+        images = [image for samples in group_images_by_label(partition_dir).values() for image in samples]
+        label_names = LabelEncoder.decode_list([image.class_label for image in images])
+        write_image_shard(images, label_names, shard_dir / partition, image_size)
+
+
+if __name__ == "__main__":
+    data_dir = Path(
+        "/workspaces/gorillatracker/data/splits/ground_truth-cxl-face_images-openset-reid-val-0-test-0-mintraincount-3-seed-42-train-50-val-25-test-25"
+    )
+    build_image_shards(data_dir, data_dir.parent / f"{data_dir.name}_shards", image_size=224)
@@ -0,0 +1,85 @@
+"""Incremental construction of the SSL clique graphs from streamed rows, e.g. straight from a DB cursor.
+
+The images of a tracking always form one clique (`SSLConfig` merges all images of a tracking). Negatives are pairs of
+partitioned groups, trackings for the two-layer graph ("overlapping" negative mining) and videos for the three-layer
+graph ("social_groups"). A clique is pruned when no group partitioned from its group has any images. The builder keeps
+the image count of every group and, per group, the number of partitioned groups with images, so pruning needs no
+extra pass and rows can arrive in any order and in batches.
+"""
+
+from __future__ import annotations
+
+from array import array
+from collections import defaultdict
+from pathlib import Path
+from typing import Iterable, Literal, Optional
+
+from gorillatracker.data.contrastive_sampler import CliqueGroupSampler, ContrastiveImage
+from gorillatracker.ssl_pipeline.models import TrackingFrameFeature
+
+NegativeLevel = Literal["tracking", "video"]
+
+
+class CliqueGraphBuilder:
+    """Collects image rows (tff_id, tracking_id, video_id) and negative pairs of the `level` (tracking or video ids)."""
+
+    def __init__(self, level: NegativeLevel) -> None:
+        assert level in ("tracking", "video"), f"Unknown negative level {level}"
+        self.level = level
+        self.tff_ids = array("q")
+        self.tracking_ids = array("q")
+        self.group_ids = array("q")
+        self.negatives: defaultdict[int, set[int]] = defaultdict(set)
+        self.group_images: defaultdict[int, int] = defaultdict(int)
+        self.negatives_with_images: defaultdict[int, int] = defaultdict(int)
+
+    def __len__(self) -> int:
+        return len(self.tff_ids)
+
+    def add_images(self, rows: Iterable[tuple[int, int, int]]) -> None:
+        for tff_id, tracking_id, video_id in rows:
+            group = tracking_id if self.level == "tracking" else video_id
+            self.tff_ids.append(tff_id)
+            self.tracking_ids.append(tracking_id)
+            self.group_ids.append(group)
+            if self.group_images[group] == 0:
+                for other in self.negatives.get(group, ()):
+                    self.negatives_with_images[other] += 1
+            self.group_images[group] += 1
+
+    def add_negatives(self, pairs: Iterable[tuple[int, int]]) -> None:
+        for left, right in pairs:
+            assert left != right, "Self loops are not allowed."
+            if right in self.negatives[left]:
+                continue
+            self.negatives[left].add(right)
+            self.negatives[right].add(left)
+            if self.group_images.get(left):
+                self.negatives_with_images[right] += 1
+            if self.group_images.get(right):
+                self.negatives_with_images[left] += 1
+
+    def is_prunable(self, group: int) -> bool:
+        """Whether the cliques of `group` would be pruned, i.e. no partitioned group has images (yet)."""
+        return self.negatives_with_images.get(group, 0) == 0
+
+    def build(self, base_path: Path, seed: Optional[int] = None) -> CliqueGroupSampler:
+        """The sampler over all images of cliques that are not pruned, in the order they were added."""
+        images: list[ContrastiveImage] = []
+        cliques: list[int] = []
+        groups: list[int] = []
+        for tff_id, tracking_id, group in zip(self.tff_ids, self.tracking_ids, self.group_ids):
+            if self.is_prunable(group):
+                continue
+            image_path = TrackingFrameFeature.cache_path_of(base_path, tff_id)
+            images.append(ContrastiveImage(str(tff_id), image_path, tracking_id))
+            cliques.append(tracking_id)
+            groups.append(group)
+        negative_groups = [
+            (left, right)
+            for left, rights in self.negatives.items()
+            if self.group_images.get(left)
+            for right in rights
+            if left < right and self.group_images.get(right)
+        ]
+        return CliqueGroupSampler(images, cliques, groups, negative_groups, seed=seed)
@@ -1,9 +1,13 @@
 from __future__ import annotations
 
 import random
+from array import array
 from collections import defaultdict
+from dataclasses import dataclass
 from itertools import chain
-from typing import Generic, Protocol, TypeVar
+from typing import Generic, Optional, Protocol, Sequence, TypeVar
+
+import numpy as np
 
 CT = TypeVar("CT")
 
@@ -94,6 +98,11 @@ class CliqueGraph(Generic[T]):
         self.union_find = UnionFind(vertices)
         # NOTE(memben): the key and values are always the root of a set in union find
         self.cut_edges = {v: set[T]() for v in vertices}
+        self.version = 0  # NOTE: incremented by every change of the cliques or cut edges
+
+    def state_version(self) -> tuple[int, ...]:
+        """Versions of this and all parent layers, changes whenever the adjacency of any clique might change."""
+        return (self.version,)
 
     def is_partitioned(self, u: T, v: T) -> bool:
         root_u, root_v = self._find_root(u), self._find_root(v)
@@ -111,6 +120,8 @@ class CliqueGraph(Generic[T]):
 
     def get_random_clique_member(self, v: T, exclude: list[T] = []) -> T:
         clique = self.get_clique(v)
+        if not exclude:
+            return random.choice(clique)
         return random.choice([m for m in clique if m not in exclude])
 
     def get_random_adjacent_clique(self, v: T) -> T:
@@ -123,6 +134,7 @@ class CliqueGraph(Generic[T]):
         root_u, root_v = self._find_root(u), self._find_root(v)
         if root_u == root_v:
             return
+        self.version += 1
         root = self.union_find.union(u, v)
         old_root = root_v if root == root_u else root_u
         old_cut_edges = self.cut_edges.pop(old_root)
@@ -134,6 +146,7 @@ class CliqueGraph(Generic[T]):
     def partition(self, u: T, v: T) -> None:
         assert u != v, "Self loops are not allowed."
         assert not self.is_connected(u, v), "Cannot partition a clique"
+        self.version += 1
         root_u, root_v = self._find_root(u), self._find_root(v)
         self.cut_edges[root_u].add(root_v)
         self.cut_edges[root_v].add(root_u)
@@ -146,6 +159,169 @@ class CliqueGraph(Generic[T]):
         return self.cut_edges[root_v]
 
 
+class ArrayUnionFind(Generic[T]):
+    """`UnionFind` over the integer indices of the vertices in typed arrays, with union by size and iterative path
+    compression.
+
+    Every set is a circular linked list over the indices (`next`), so a union is constant time. The members of a set
+    are materialized into one list on the first `get_members` after its last union. With `vertices` a `range(n)` the
+    vertices are their own indices and no vertex to index map is built.
+    """
+
+    def __init__(self, vertices: Sequence[T]) -> None:
+        self.vertices: Sequence[T] = vertices if _is_identity(vertices) else list(vertices)
+        self.index: Optional[dict[T, int]] = None
+        if not _is_identity(vertices):
+            self.index = {v: i for i, v in enumerate(self.vertices)}
+            assert len(self.index) == len(self.vertices), "Vertices must be unique."
+        n = len(self.vertices)
+        # NOTE: typed arrays, as compact as numpy arrays but scalar indexing is several times faster
+        self.parent = array("q", range(n))
+        self.size = array("q", [1]) * n
+        self.next = array("q", range(n))
+        self.deleted = bytearray(n)
+        self._members: dict[int, list[T]] = {}
+
+    def index_of(self, x: T) -> int:
+        i = self.index[x] if self.index is not None else int(x)  # type: ignore[call-overload]
+        if not 0 <= i < len(self.vertices) or self.deleted[i]:
+            raise KeyError(x)
+        return i
+
+    def find_index(self, i: int) -> int:
+        parent = self.parent
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    def find(self, x: T) -> T:
+        return self.vertices[self.find_index(self.index_of(x))]
+
+    def union(self, x: T, y: T) -> T:
+        return self.vertices[self.union_roots(self.find_index(self.index_of(x)), self.find_index(self.index_of(y)))]
+
+    def union_roots(self, root_x: int, root_y: int) -> int:
+        if root_x == root_y:
+            return root_y
+        if self.size[root_x] > self.size[root_y]:
+            root_x, root_y = root_y, root_x
+        self.parent[root_x] = root_y
+        self.size[root_y] += self.size[root_x]
+        # NOTE: splicing two circular lists merges them
+        self.next[root_x], self.next[root_y] = self.next[root_y], self.next[root_x]
+        self._members.pop(root_x, None)
+        self._members.pop(root_y, None)
+        return root_y
+
+    def member_indices(self, root: int) -> list[int]:
+        members, next_ = [root], self.next
+        i = next_[root]
+        while i != root:
+            members.append(i)
+            i = next_[i]
+        return members
+
+    def get_members(self, x: T) -> list[T]:
+        root = self.find_index(self.index_of(x))
+        members = self._members.get(root)
+        if members is None:
+            members = [self.vertices[i] for i in self.member_indices(root)]
+            self._members[root] = members
+        return members
+
+    def delete_set(self, root: T) -> None:
+        root_index = self.index_of(root)
+        assert self.parent[root_index] == root_index, "Only sets can be deleted, i.e. by their root"
+        for i in self.member_indices(root_index):
+            self.deleted[i] = True
+        self._members.pop(root_index, None)
+
+
+def _is_identity(vertices: Sequence[T]) -> bool:
+    return isinstance(vertices, range) and vertices.start == 0 and vertices.step == 1
+
+
+class ArrayCliqueGraph(Generic[T]):
+    """`CliqueGraph` on top of an `ArrayUnionFind`, cut edges are only stored for cliques that have some.
+
+    Random clique members are drawn by rejection sampling instead of filtering the whole clique.
+    """
+
+    MAX_REJECTIONS = 8
+
+    def __init__(self, vertices: Sequence[T]) -> None:
+        self.union_find = ArrayUnionFind(vertices)
+        # NOTE: keys and values are always root indices of the union find
+        self.cut_edges: dict[int, set[int]] = {}
+        self.version = 0
+
+    def state_version(self) -> tuple[int, ...]:
+        return (self.version,)
+
+    def is_partitioned(self, u: T, v: T) -> bool:
+        root_u, root_v = self._find_root_index(u), self._find_root_index(v)
+        return root_u in self.cut_edges.get(root_v, ())
+
+    def is_connected(self, u: T, v: T) -> bool:
+        return self._find_root_index(u) == self._find_root_index(v)
+
+    def get_clique(self, v: T) -> list[T]:
+        return self.union_find.get_members(v)
+
+    def get_adjacent_cliques(self, v: T) -> dict[T, list[T]]:
+        vertices = self.union_find.vertices
+        return {vertices[r]: self.get_clique(vertices[r]) for r in self.cut_edges.get(self._find_root_index(v), ())}
+
+    def get_random_clique_member(self, v: T, exclude: list[T] = []) -> T:
+        clique = self.get_clique(v)
+        for _ in range(self.MAX_REJECTIONS):
+            member = clique[random.randrange(len(clique))]
+            if member not in exclude:
+                return member
+        return random.choice([m for m in clique if m not in exclude])
+
+    def get_random_adjacent_clique(self, v: T) -> T:
+        adjacent_clique_roots = self.cut_edges.get(self._find_root_index(v), ())
+        return self.union_find.vertices[random.choice(list(adjacent_clique_roots))]
+
+    def merge(self, u: T, v: T) -> None:
+        assert u != v, "Self loops are not allowed."
+        root_u, root_v = self._find_root_index(u), self._find_root_index(v)
+        assert root_u not in self.cut_edges.get(root_v, ()), "Cannot merge partitioned cliques"
+        if root_u == root_v:
+            return
+        self.version += 1
+        root = self.union_find.union_roots(root_u, root_v)
+        old_root = root_v if root == root_u else root_u
+        old_cut_edges = self.cut_edges.pop(old_root, set())
+        for root_p in old_cut_edges:
+            self.cut_edges[root_p].remove(old_root)
+            self.cut_edges[root_p].add(root)
+        if old_cut_edges:
+            self.cut_edges.setdefault(root, set()).update(old_cut_edges)
+
+    def partition(self, u: T, v: T) -> None:
+        assert u != v, "Self loops are not allowed."
+        root_u, root_v = self._find_root_index(u), self._find_root_index(v)
+        assert root_u != root_v, "Cannot partition a clique"
+        self.version += 1
+        self.cut_edges.setdefault(root_u, set()).add(root_v)
+        self.cut_edges.setdefault(root_v, set()).add(root_u)
+
+    def _find_root(self, v: T) -> T:
+        return self.union_find.vertices[self._find_root_index(v)]
+
+    def _find_root_index(self, v: T) -> int:
+        return self.union_find.find_index(self.union_find.index_of(v))
+
+    def _get_adjacent_clique_roots(self, v: T) -> set[T]:
+        vertices = self.union_find.vertices
+        return {vertices[r] for r in self.cut_edges.get(self._find_root_index(v), ())}
+
+
 K = TypeVar("K", bound=Comparable)
 
 
@@ -182,6 +358,32 @@ class IndexedCliqueGraph(CliqueGraph[K]):
 P = TypeVar("P", bound=Comparable)
 
 
+@dataclass(frozen=True)
+class CliqueAdjacency(Generic[K]):
+    """The adjacent cliques of every clique of a layer in CSR layout, valid for one `state_version` of the layer.
+
+    The adjacent cliques of the clique with root r are `vertices[targets[offsets[row_of[r]] : offsets[row_of[r] + 1]]]`.
+    The integer arrays are never written after the build, forked DataLoader workers share their pages.
+    """
+
+    version: tuple[int, ...]
+    row_of: dict[K, int]
+    offsets: np.ndarray
+    targets: np.ndarray
+    vertices: list[K]
+
+    def adjacent(self, root: K) -> list[K]:
+        row = self.row_of[root]
+        return [self.vertices[t] for t in self.targets[self.offsets[row] : self.offsets[row + 1]].tolist()]
+
+    def random_adjacent(self, root: K) -> K:
+        row = self.row_of[root]
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        if end == start:
+            raise IndexError(f"{root} has no adjacent cliques")
+        return self.vertices[self.targets[start + random.randrange(end - start)]]
+
+
 class MultiLayerCliqueGraph(IndexedCliqueGraph[K]):
     """Indexed Clique Graph supporting multiple layers of cut edges.
     This allows for hierarchical or multi-layered connections between cliques.
@@ -202,6 +404,32 @@ class MultiLayerCliqueGraph(IndexedCliqueGraph[K]):
         for child_r, parent_r in parent_edges.items():
             if parent_r is not None:
                 self.inverse_parent_edges[parent_r].add(child_r)
+        self._adjacency: Optional[CliqueAdjacency[K]] = None
+
+    # override
+    def state_version(self) -> tuple[int, ...]:
+        return (self.version, *self.parent.state_version())
+
+    def adjacency(self) -> CliqueAdjacency[K]:
+        """The memoized adjacency of all cliques, rebuilt after a `merge` or `partition` in this or a parent layer."""
+        version = self.state_version()
+        if self._adjacency is None or self._adjacency.version != version:
+            self._adjacency = self._build_adjacency(version)
+        return self._adjacency
+
+    def _build_adjacency(self, version: tuple[int, ...]) -> CliqueAdjacency[K]:
+        row_of: dict[K, int] = {}
+        vertex_index: dict[K, int] = {}
+        counts: list[int] = []
+        targets: list[int] = []
+        for root in self.union_find.members:
+            row_of[root] = len(counts)
+            adjacent = self._compute_adjacent_clique_roots(root)
+            counts.append(len(adjacent))
+            targets.extend(vertex_index.setdefault(a, len(vertex_index)) for a in adjacent)
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return CliqueAdjacency(version, row_of, offsets, np.array(targets, dtype=np.int64), list(vertex_index))
 
     # override
     def merge(self, u: K, v: K) -> None:
@@ -234,8 +462,15 @@ class MultiLayerCliqueGraph(IndexedCliqueGraph[K]):
         adjacent_clique_representatives = self._get_adjacent_clique_roots_via_parent(v)
         return {r: self.get_clique(r) for r in adjacent_clique_representatives}
 
+    # override
+    def get_random_adjacent_clique(self, v: K) -> K:
+        return self.adjacency().random_adjacent(self._find_root(v))
+
     # override
     def _get_adjacent_clique_roots(self, v: K) -> set[K]:
+        return set(self.adjacency().adjacent(self._find_root(v)))
+
+    def _compute_adjacent_clique_roots(self, v: K) -> set[K]:
         return super()._get_adjacent_clique_roots(v) | self._get_adjacent_clique_roots_via_parent(v)
 
     def _get_adjacent_clique_roots_via_parent(self, v: K) -> set[K]:
@@ -248,7 +483,8 @@ class MultiLayerCliqueGraph(IndexedCliqueGraph[K]):
         if parent_v is None:
             return set()
         parent_adjacent_cliques = self.parent.get_adjacent_cliques(parent_v)
-        adjacent_clique_parents = chain.from_iterable(parent_adjacent_cliques.values())
+        # NOTE: a merged parent clique can be listed under its representative and under one of its vertices
+        adjacent_clique_parents = set(chain.from_iterable(parent_adjacent_cliques.values()))
         adjacent_clique_representatives = list(
             chain.from_iterable([self.inverse_parent_edges[p] for p in adjacent_clique_parents])
         )
@@ -262,7 +498,8 @@ class MultiLayerCliqueGraph(IndexedCliqueGraph[K]):
         deleted_vertices = set()
         roots = self.union_find.members.keys()
         for root in list(roots):
-            if len(self._get_adjacent_clique_roots(root)) == 0:
+            if len(self._compute_adjacent_clique_roots(root)) == 0:
                 deleted_vertices.update(self.get_clique(root))
                 self.union_find.delete_set(root)
         self.vertices = list(set(self.vertices) - deleted_vertices)
+        self.version += 1
@@ -276,11 +276,15 @@ class TrackingFrameFeature(Base):
         return frame_nr
 
     def cache_path(self, base_path: Path) -> Path:
+        return self.cache_path_of(base_path, self.tracking_frame_feature_id)
+
+    @staticmethod
+    def cache_path_of(base_path: Path, tracking_frame_feature_id: int) -> Path:
         return Path(
             base_path,
-            str(self.tracking_frame_feature_id % 2**8),
-            str(self.tracking_frame_feature_id % 2**16),
-            f"{self.tracking_frame_feature_id}.png",
+            str(tracking_frame_feature_id % 2**8),
+            str(tracking_frame_feature_id % 2**16),
+            f"{tracking_frame_feature_id}.png",
         )
 
     __table_args__ = (
@@ -0,0 +1,275 @@
+"""Persistent snapshots of the contrastive samplers built by `SSLConfig`.
+
+Building a sampler queries all TrackingFrameFeatures of a split and, for the clique samplers, all negative pairs. A
+snapshot stores the result in one uncompressed `.npz` file:
+
+    meta               uint8, utf-8 json {"version", "key", "db_version", "sampler", "layers"}
+    image_ids          int64 (N,), the TrackingFrameFeature ids of the selected images
+    image_labels       int64 (N,)
+    image_paths        uint8, the "\\0" joined utf-8 image paths
+    cliques, groups    int64 (N,), negative_groups int64 (M x 2), of a `CliqueGroupSampler`
+    layer{l}_*         the internal state of clique graph layer l (0 is the image layer) as position arrays
+
+Snapshots are content addressed (`key`, see `SSLConfig.snapshot_key`) and stamped with the `database_version` they
+were built from, a snapshot of another database version is deleted on load.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Hashable, Iterable, Mapping, Optional, Sequence
+
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from gorillatracker.data.contrastive_sampler import (
+    CliqueGraphSampler,
+    CliqueGroupSampler,
+    ContrastiveClassSampler,
+    ContrastiveImage,
+    ContrastiveSampler,
+    group_contrastive_images,
+)
+from gorillatracker.ssl_pipeline.data_structures import IndexedCliqueGraph, MultiLayerCliqueGraph, UnionFind
+from gorillatracker.ssl_pipeline.models import (
+    Tracking,
+    TrackingFrameFeature,
+    TrackingRelationship,
+    Video,
+    VideoRelationship,
+)
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT_VERSION = 1
+
+_VERSIONED_COLUMNS = (
+    Video.video_id,
+    Tracking.tracking_id,
+    TrackingFrameFeature.tracking_frame_feature_id,
+    VideoRelationship.video_relationship_id,
+    TrackingRelationship.tracking_relationship_id,
+)
+
+
+def database_version(session: Session) -> str:
+    """Row count and largest primary key of every table a sampler is built from, plus the database URL.
+
+    NOTE: in-place updates of rows do not change the version, `SamplerSnapshotCache.invalidate` them explicitly.
+    """
+    # NOTE: one scalar subquery per aggregate, a single select over all tables would be their cartesian product
+    aggregates = [
+        select(aggregate(column)).scalar_subquery()
+        for column in _VERSIONED_COLUMNS
+        for aggregate in (func.count, func.max)
+    ]
+    counts = session.execute(select(*aggregates)).one()
+    url = session.get_bind().engine.url.render_as_string(hide_password=True)
+    return hashlib.sha256(json.dumps([url, *counts]).encode()).hexdigest()[:16]
+
+
+def _encode_csr(mapping: Mapping[Any, Iterable[Any]], position: dict[Any, int]) -> tuple[np.ndarray, ...]:
+    keys = np.array([position.get(k, -1) for k in mapping], dtype=np.int64)
+    values = [[position[v] for v in vs] for vs in mapping.values()]
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum([len(vs) for vs in values], out=offsets[1:])
+    return keys, offsets, np.array([v for vs in values for v in vs], dtype=np.int64)
+
+
+def _decode_csr(keys: list[Any], offsets: list[int], values: list[Any]) -> list[tuple[Any, list[Any]]]:
+    return [(key, values[offsets[i] : offsets[i + 1]]) for i, key in enumerate(keys)]
+
+
+def _layer_universe(graph: IndexedCliqueGraph[Any]) -> list[Any]:
+    """Every vertex the internal state of `graph` refers to, merged and pruned vertices included."""
+    universe = set(graph.vertices) | set(graph.union_find.root) | set(graph.cut_edges)
+    if isinstance(graph, MultiLayerCliqueGraph):
+        universe |= set(graph.parent_edges)
+        universe.update(*graph.inverse_parent_edges.values())
+    return sorted(universe)
+
+
+def _encode_layer(
+    graph: IndexedCliqueGraph[Any], position: dict[Any, int], parent_position: Optional[dict[Any, int]]
+) -> dict[str, np.ndarray]:
+    union_find = graph.union_find
+    arrays = {
+        "vertices": np.array([position[v] for v in graph.vertices], dtype=np.int64),
+        "uf_nodes": np.array([position[v] for v in union_find.root], dtype=np.int64),
+        "uf_roots": np.array([position[r] for r in union_find.root.values()], dtype=np.int64),
+        "uf_ranks": np.array(list(union_find.rank.values()), dtype=np.int64),
+    }
+    arrays["members_keys"], arrays["members_offsets"], arrays["members_values"] = _encode_csr(
+        union_find.members, position
+    )
+    arrays["cut_keys"], arrays["cut_offsets"], arrays["cut_values"] = _encode_csr(graph.cut_edges, position)
+    if isinstance(graph, MultiLayerCliqueGraph):
+        assert parent_position is not None
+        arrays["parent_keys"] = np.array([position[v] for v in graph.parent_edges], dtype=np.int64)
+        arrays["parent_values"] = np.array(
+            [-1 if p is None else parent_position[p] for p in graph.parent_edges.values()], dtype=np.int64
+        )
+        # NOTE: the inverse edges map vertices of the parent layer (keys) to vertices of this layer (values)
+        _, arrays["inverse_offsets"], arrays["inverse_values"] = _encode_csr(graph.inverse_parent_edges, position)
+        arrays["inverse_keys"] = np.array([parent_position[p] for p in graph.inverse_parent_edges], dtype=np.int64)
+    return arrays
+
+
+def _decode_layer(
+    arrays: dict[str, list[int]],
+    universe: Sequence[Any],
+    parent: Optional[IndexedCliqueGraph[Any]],
+    parent_universe: Sequence[Any],
+) -> IndexedCliqueGraph[Any]:
+    def vertices(positions: list[int]) -> list[Any]:
+        return [universe[p] for p in positions]
+
+    union_find: UnionFind[Any] = UnionFind.__new__(UnionFind)
+    union_find.root = dict(zip(vertices(arrays["uf_nodes"]), vertices(arrays["uf_roots"])))
+    union_find.rank = dict(zip(vertices(arrays["uf_nodes"]), arrays["uf_ranks"]))
+    members = _decode_csr(arrays["members_keys"], arrays["members_offsets"], arrays["members_values"])
+    union_find.members = {universe[root]: vertices(ms) for root, ms in members}
+
+    graph: IndexedCliqueGraph[Any]
+    if parent is None:
+        graph = IndexedCliqueGraph.__new__(IndexedCliqueGraph)
+    else:
+        multi_layer: MultiLayerCliqueGraph[Any] = MultiLayerCliqueGraph.__new__(MultiLayerCliqueGraph)
+        multi_layer.parent = parent
+        multi_layer._adjacency = None
+        multi_layer.parent_edges = {
+            universe[v]: None if p < 0 else parent_universe[p]
+            for v, p in zip(arrays["parent_keys"], arrays["parent_values"])
+        }
+        multi_layer.inverse_parent_edges = defaultdict(set)
+        inverse = _decode_csr(arrays["inverse_keys"], arrays["inverse_offsets"], arrays["inverse_values"])
+        for p, children in inverse:
+            multi_layer.inverse_parent_edges[parent_universe[p]] = set(vertices(children))
+        graph = multi_layer
+    graph.union_find = union_find
+    cut_edges = _decode_csr(arrays["cut_keys"], arrays["cut_offsets"], arrays["cut_values"])
+    graph.cut_edges = {universe[root]: set(vertices(others)) for root, others in cut_edges}
+    graph.vertices = vertices(arrays["vertices"])
+    graph.version = 0
+    return graph
+
+
+def _graph_layers(graph: IndexedCliqueGraph[Any]) -> list[IndexedCliqueGraph[Any]]:
+    """The layers of a multi-layer clique graph, from `graph` up to the root layer."""
+    layers = [graph]
+    while isinstance(layers[-1], MultiLayerCliqueGraph):
+        parent = layers[-1].parent
+        assert isinstance(parent, IndexedCliqueGraph), "Only indexed parent layers can be snapshotted"
+        layers.append(parent)
+    return layers
+
+
+def save_sampler_snapshot(path: Path, key: str, db_version: str, sampler: ContrastiveSampler) -> None:
+    """Writes the snapshot of `sampler` (image ids are TrackingFrameFeature ids) atomically to `path`."""
+    arrays: dict[str, np.ndarray] = {}
+    layers: list[IndexedCliqueGraph[Any]] = []
+    if isinstance(sampler, ContrastiveClassSampler):
+        kind, images = "class", list(sampler)
+    elif isinstance(sampler, CliqueGroupSampler):
+        kind, images = "group", sampler.images
+        arrays["cliques"], arrays["groups"] = sampler.cliques, sampler.groups
+        arrays["negative_groups"] = np.array(sampler.negative_groups, dtype=np.int64).reshape(-1, 2)
+    elif isinstance(sampler, CliqueGraphSampler):
+        # NOTE: the image layer refers to pruned and merged images too
+        layers = _graph_layers(sampler.graph)
+        kind, images = "clique", _layer_universe(sampler.graph)
+    else:
+        raise ValueError(f"Cannot snapshot a {type(sampler).__name__}")
+    arrays["image_ids"] = np.array([int(image.id) for image in images], dtype=np.int64)
+    arrays["image_labels"] = np.array([image.class_label for image in images], dtype=np.int64)
+    arrays["image_paths"] = np.frombuffer("\0".join(str(image.image_path) for image in images).encode(), dtype=np.uint8)
+
+    positions = [{image: i for i, image in enumerate(images)}] + [
+        {v: i for i, v in enumerate(_layer_universe(layer))} for layer in layers[1:]
+    ]
+    for depth, layer in enumerate(layers):
+        if depth > 0:
+            arrays[f"layer{depth}_universe"] = np.array(list(positions[depth]), dtype=np.int64)
+        parent_position = positions[depth + 1] if depth + 1 < len(layers) else None
+        for name, array in _encode_layer(layer, positions[depth], parent_position).items():
+            arrays[f"layer{depth}_{name}"] = array
+
+    meta = {"version": SNAPSHOT_FORMAT_VERSION, "key": key, "db_version": db_version, "sampler": kind}
+    arrays["meta"] = np.frombuffer(json.dumps({**meta, "layers": len(layers)}).encode(), dtype=np.uint8)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        np.savez(f, **arrays)  # type: ignore[arg-type]
+    os.replace(tmp_path, path)
+
+
+def read_snapshot_meta(path: Path) -> dict[str, Any]:
+    with np.load(path, allow_pickle=False) as snapshot:
+        return json.loads(snapshot["meta"].tobytes())
+
+
+def load_sampler_snapshot(path: Path) -> ContrastiveSampler:
+    with np.load(path, allow_pickle=False) as snapshot:
+        meta = json.loads(snapshot["meta"].tobytes())
+        assert meta["version"] == SNAPSHOT_FORMAT_VERSION, f"Unsupported snapshot version {meta['version']}"
+        ids = snapshot["image_ids"].tolist()
+        labels = snapshot["image_labels"].tolist()
+        paths = snapshot["image_paths"].tobytes().decode().split("\0") if ids else []
+        images = [ContrastiveImage(str(id), Path(p), label) for id, p, label in zip(ids, paths, labels)]
+        if meta["sampler"] == "class":
+            return ContrastiveClassSampler(group_contrastive_images(images))
+        if meta["sampler"] == "group":
+            negative_groups = [(left, right) for left, right in snapshot["negative_groups"].tolist()]
+            return CliqueGroupSampler(images, snapshot["cliques"], snapshot["groups"], negative_groups)
+
+        # NOTE: python lists, the layers are rebuilt element by element
+        arrays = {name: snapshot[name].tolist() for name in snapshot.files if name.startswith("layer")}
+
+    graph: Optional[IndexedCliqueGraph[Any]] = None
+    parent_universe: Sequence[Hashable] = []
+    for depth in reversed(range(meta["layers"])):
+        universe: Sequence[Hashable] = images if depth == 0 else arrays[f"layer{depth}_universe"]
+        prefix = f"layer{depth}_"
+        layer_arrays = {name[len(prefix) :]: values for name, values in arrays.items() if name.startswith(prefix)}
+        graph = _decode_layer(layer_arrays, universe, graph, parent_universe)
+        parent_universe = universe
+    assert graph is not None
+    return CliqueGraphSampler(graph)
+
+
+class SamplerSnapshotCache:
+    """One snapshot file per key below `root`, reused as long as the database version does not change."""
+
+    def __init__(self, root: Path) -> None:
+        self.root = Path(root)
+
+    def path(self, key: str) -> Path:
+        return self.root / f"{key}.npz"
+
+    def load(self, key: str, db_version: str) -> Optional[ContrastiveSampler]:
+        path = self.path(key)
+        if not path.exists():
+            return None
+        snapshot_db_version = read_snapshot_meta(path)["db_version"]
+        if snapshot_db_version != db_version:
+            logger.info(f"Snapshot {path} is of database version {snapshot_db_version}, not {db_version}, removing it")
+            self.invalidate(key)
+            return None
+        return load_sampler_snapshot(path)
+
+    def save(self, key: str, db_version: str, sampler: ContrastiveSampler) -> None:
+        save_sampler_snapshot(self.path(key), key, db_version, sampler)
+
+    def invalidate(self, key: str) -> None:
+        self.path(key).unlink(missing_ok=True)
+
+    def clear(self) -> None:
+        for path in self.root.glob("*.npz"):
+            path.unlink(missing_ok=True)
@@ -1,26 +1,28 @@
-from dataclasses import dataclass
+import hashlib
+import json
+from dataclasses import asdict, dataclass, field
+from functools import cache
 from pathlib import Path
-from typing import List, Literal, Optional, Sequence
+from typing import Callable, Iterable, Iterator, List, Literal, Optional, Sequence, cast
 
-from sqlalchemy import Select, create_engine
+from sqlalchemy import Engine, Select, create_engine
 from sqlalchemy.orm import Session, defer, load_only
 from tqdm import tqdm
 
 from gorillatracker.data.contrastive_sampler import (
-    CliqueGraphSampler,
+    CliqueGroupSampler,
     ContrastiveClassSampler,
     ContrastiveImage,
     ContrastiveSampler,
     group_contrastive_images,
 )
-from gorillatracker.ssl_pipeline.data_structures import IndexedCliqueGraph, MultiLayerCliqueGraph
+from gorillatracker.ssl_pipeline.clique_graph_builder import CliqueGraphBuilder, NegativeLevel
 from gorillatracker.ssl_pipeline.dataset import GorillaDatasetKISZ
 from gorillatracker.ssl_pipeline.dataset_splitter import SplitArgs
-from gorillatracker.ssl_pipeline.models import Tracking, TrackingFrameFeature
+from gorillatracker.ssl_pipeline.models import TrackingFrameFeature
 from gorillatracker.ssl_pipeline.negative_mining_queries import (
-    find_overlapping_trackings,
-    find_social_group_negatives,
-    trackings_from_videos,
+    build_overlapping_trackings_query,
+    social_group_negatives,
 )
 from gorillatracker.ssl_pipeline.queries import (
     associated_filter,
@@ -37,6 +39,20 @@ from gorillatracker.ssl_pipeline.sampler import (
     movement_sample,
     random_sample,
 )
+from gorillatracker.ssl_pipeline.snapshot import SamplerSnapshotCache, database_version
+
+# NOTE: overlapping trackings are negatives of each other (two-layer graph), so are the videos of different social
+# groups (three-layer graph)
+NEGATIVE_QUERIES: dict[str, tuple[NegativeLevel, Callable[[Sequence[int]], Select[tuple[int, int]]]]] = {
+    "overlapping": ("tracking", build_overlapping_trackings_query),
+    "social_groups": ("video", social_group_negatives),
+}
+
+
+@cache
+def get_engine(db_uri: str) -> Engine:
+    # NOTE: one engine (and connection pool) per process instead of one per sampler
+    return create_engine(db_uri, echo=False)
 
 
 @dataclass(kw_only=True)
@@ -52,6 +68,8 @@ class SSLConfig:
     height_range: tuple[Optional[int], Optional[int]]
     forced_train_image_count: Optional[int] = None
     movement_delta: Optional[float] = None
+    # NOTE: directory of the sampler snapshots, None disables them (not part of the snapshot key)
+    snapshot_dir: Optional[Path] = field(default=None, compare=False, repr=False)
 
     def __post_init__(self) -> None:
         assert self.tff_selection != "movement" or self.movement_delta is not None, "Combination not allowed"
@@ -61,20 +79,68 @@ class SSLConfig:
         base_path: Path,
         partition: Literal["train", "val", "test"],
     ) -> ContrastiveSampler:
-        engine = create_engine(GorillaDatasetKISZ.DB_URI, echo=False)
-
-        with Session(engine) as session:
-            video_ids = self._get_video_ids(partition)
-            tracking_frame_features = self._sample_tracking_frame_features(video_ids, session)
-            contrastive_images = self._create_contrastive_images(tracking_frame_features, base_path)
-            if self.forced_train_image_count is not None and partition == "train":
-                if len(contrastive_images) < self.forced_train_image_count:
-                    raise ValueError(
-                        f"Not enough images for training, required: {self.forced_train_image_count}, got {len(contrastive_images)}"
-                    )
-                contrastive_images = contrastive_images[: self.forced_train_image_count]
+        with Session(get_engine(GorillaDatasetKISZ.DB_URI)) as session:
+            if self.snapshot_dir is None:
+                return self._build_contrastive_sampler(base_path, partition, session)
+
+            snapshots = SamplerSnapshotCache(self.snapshot_dir)
+            key, db_version = self.snapshot_key(base_path, partition), database_version(session)
+            sampler = snapshots.load(key, db_version)
+            if sampler is None:
+                sampler = self._build_contrastive_sampler(base_path, partition, session)
+                snapshots.save(key, db_version, sampler)
+            return sampler
+
+    def snapshot_key(self, base_path: Path, partition: Literal["train", "val", "test"]) -> str:
+        """Hash of the config fields, the contents of the split pickle, `base_path` and `partition`.
+
+        NOTE: the random TFF selection is frozen by the snapshot, a new sample needs `SamplerSnapshotCache.invalidate`.
+        """
+        fields = asdict(self)
+        fields.pop("snapshot_dir")
+        fields["split_path"] = hashlib.sha256(Path(self.split_path).read_bytes()).hexdigest()
+        content = json.dumps([fields, str(base_path), partition], sort_keys=True, default=str)
+        return f"{partition}-{hashlib.sha256(content.encode()).hexdigest()[:32]}"
+
+    def _build_contrastive_sampler(
+        self, base_path: Path, partition: Literal["train", "val", "test"], session: Session
+    ) -> ContrastiveSampler:
+        video_ids = self._get_video_ids(partition)
+        image_limit = self.forced_train_image_count if partition == "train" else None
+        if self.negative_mining == "random":
+            contrastive_images: List[ContrastiveImage] = []
+            for _, tracking_frame_features in self._iter_tracking_frame_features(video_ids, session):
+                contrastive_images += self._create_contrastive_images(tracking_frame_features, base_path)
+            self._check_image_count(len(contrastive_images), image_limit)
+            classes = group_contrastive_images(contrastive_images[:image_limit])
+            return ContrastiveClassSampler(classes)
+        elif self.negative_mining in NEGATIVE_QUERIES:
+            return self._build_clique_group_sampler(video_ids, base_path, session, image_limit)
+        else:
+            raise ValueError(f"Unknown negative mining method: {self.negative_mining}")
 
-            return self._create_contrastive_sampler(contrastive_images, video_ids, session)
+    def _build_clique_group_sampler(
+        self, video_ids: List[int], base_path: Path, session: Session, image_limit: Optional[int]
+    ) -> CliqueGroupSampler:
+        level, negative_query = NEGATIVE_QUERIES[self.negative_mining]
+        builder = CliqueGraphBuilder(level)
+        for batch_video_ids, tracking_frame_features in self._iter_tracking_frame_features(video_ids, session):
+            rows: list[tuple[int, int, int]] = []
+            for f in tracking_frame_features:
+                assert f.tracking_id is not None, "associated_filter only selects features of a tracking"
+                rows.append((f.tracking_frame_feature_id, f.tracking_id, f.video_id))
+            rows = rows if image_limit is None else rows[: max(0, image_limit - len(builder))]
+            builder.add_images(rows)
+            if batch_video_ids:
+                # NOTE: SQLAlchemy 2.0 and 2.1 type Select[tuple[int, int]] rows differently, the rows are (left, right)
+                negatives = cast(Iterable[tuple[int, int]], session.execute(negative_query(batch_video_ids)).tuples())
+                builder.add_negatives(negatives)
+        self._check_image_count(len(builder), image_limit)
+        return builder.build(base_path)
+
+    def _check_image_count(self, image_count: int, image_limit: Optional[int]) -> None:
+        if image_limit is not None and image_count < image_limit:
+            raise ValueError(f"Not enough images for training, required: {image_limit}, got {image_count}")
 
     def _get_video_ids(self, partition: Literal["train", "val", "test"]) -> List[int]:
         split = SplitArgs.load_pickle(str(self.split_path))
@@ -87,22 +153,6 @@ class SSLConfig:
         else:
             raise ValueError(f"Unknown partition: {partition}")
 
-    def _create_contrastive_sampler(
-        self,
-        contrastive_images: List[ContrastiveImage],
-        video_ids: List[int],
-        session: Session,
-    ) -> ContrastiveSampler:
-        if self.negative_mining == "random":
-            classes = group_contrastive_images(contrastive_images)
-            return ContrastiveClassSampler(classes)
-        elif self.negative_mining == "overlapping":
-            return self._create_two_layer_clique_sampler(contrastive_images, video_ids, session)
-        elif self.negative_mining == "social_groups":
-            return self._create_three_layer_clique_sampler(contrastive_images, video_ids, session)
-        else:
-            raise ValueError(f"Unknown negative mining method: {self.negative_mining}")
-
     def _build_query(self, video_ids: List[int]) -> Select[tuple[TrackingFrameFeature]]:
         query = multiple_videos_filter(video_ids)
         query = cached_filter(query)
@@ -116,6 +166,7 @@ class SSLConfig:
             load_only(
                 TrackingFrameFeature.tracking_frame_feature_id,
                 TrackingFrameFeature.tracking_id,
+                TrackingFrameFeature.video_id,
                 TrackingFrameFeature.frame_nr,
                 TrackingFrameFeature.bbox_x_center_n,
                 TrackingFrameFeature.bbox_y_center_n,
@@ -125,17 +176,32 @@ class SSLConfig:
         )
         return query
 
-    def _sample_tracking_frame_features(self, video_ids: list[int], session: Session) -> list[TrackingFrameFeature]:
+    def _iter_tracking_frame_features(
+        self, video_ids: list[int], session: Session
+    ) -> Iterator[tuple[list[int], list[TrackingFrameFeature]]]:
+        """The selected TrackingFrameFeatures of every batch of videos, a tracking never spans two batches.
+
+        The embedding distant selection runs once over all batches, its batches are yielded without features and
+        followed by all selected features (with an empty batch).
+        """
         BATCH_SIZE = 200
         num_batches = len(video_ids) // BATCH_SIZE
-        tffs: list[TrackingFrameFeature] = []
+        pending: list[TrackingFrameFeature] = []
         for i in tqdm(
             range(num_batches + 1), desc="Sampling TrackingFrameFeatures", total=num_batches + 1, unit="batch"
         ):
             batch_video_ids = video_ids[i * BATCH_SIZE : (i + 1) * BATCH_SIZE]
-            batch_tffs = session.execute(self._build_query(batch_video_ids)).scalars().all()
-            tffs += batch_tffs
-
+            batch_tffs: list[TrackingFrameFeature] = []
+            batch_tffs += session.execute(self._build_query(batch_video_ids)).scalars().all()
+            if self.tff_selection == "embeddingdistant":
+                pending += batch_tffs
+                yield batch_video_ids, []
+            else:
+                yield batch_video_ids, self._select_tracking_frame_features(batch_tffs)
+        if pending:
+            yield [], self._select_tracking_frame_features(pending)
+
+    def _select_tracking_frame_features(self, tffs: list[TrackingFrameFeature]) -> list[TrackingFrameFeature]:
         if self.tff_selection == "random":
             return list(random_sample(tffs, self.n_samples))
         elif self.tff_selection == "equidistant":
@@ -158,52 +224,6 @@ class SSLConfig:
             for f in tracked_features
         ]
 
-    def _merge_same_class_vertices(self, graph: MultiLayerCliqueGraph[ContrastiveImage]) -> None:
-        # NOTE(V1nce1): Should be functionality of MultiLayerCliqueGraph and could be extended
-        for _, childrens in graph.inverse_parent_edges.items():
-            children_list = list(childrens)
-            for i in range(len(children_list) - 1):
-                graph.merge(children_list[i], children_list[i + 1])
-
-    def _create_two_layer_clique_sampler(
-        self, contrastive_images: List[ContrastiveImage], video_ids: List[int], session: Session
-    ) -> CliqueGraphSampler:
-        trackings = session.execute(trackings_from_videos(video_ids)).scalars().all()
-        first_layer: IndexedCliqueGraph[int] = IndexedCliqueGraph([tracking.tracking_id for tracking in trackings])
-        overlapping_trackings = find_overlapping_trackings(session, video_ids)
-        for left, right in overlapping_trackings:
-            first_layer.partition(left, right)
-
-        parent_edges: dict[ContrastiveImage, Optional[int]] = {img: img.class_label for img in contrastive_images}
-        second_layer = MultiLayerCliqueGraph(vertices=contrastive_images, parent=first_layer, parent_edges=parent_edges)
-        self._merge_same_class_vertices(second_layer)
-        second_layer.prune_cliques_without_neighbors()
-        return CliqueGraphSampler(second_layer)
-
-    def _create_three_layer_clique_sampler(
-        self, contrastive_images: List[ContrastiveImage], video_ids: List[int], session: Session
-    ) -> CliqueGraphSampler:
-        first_layer: IndexedCliqueGraph[int] = IndexedCliqueGraph(list(video_ids))
-        video_negatives = find_social_group_negatives(session, video_ids)
-        for left, right in video_negatives:
-            first_layer.partition(left, right)
-        trackings: Sequence[Tracking] = session.execute(trackings_from_videos(video_ids)).scalars().all()
-        first_parent_edges: dict[int, Optional[int]] = {
-            trackings.tracking_id: trackings.video_id for trackings in trackings
-        }
-        second_layer = MultiLayerCliqueGraph(
-            vertices=list(first_parent_edges.keys()), parent=first_layer, parent_edges=first_parent_edges
-        )
-        second_parent_edges: dict[ContrastiveImage, Optional[int]] = {
-            img: img.class_label for img in contrastive_images
-        }
-        third_layer = MultiLayerCliqueGraph(
-            vertices=contrastive_images, parent=second_layer, parent_edges=second_parent_edges
-        )
-        self._merge_same_class_vertices(third_layer)
-        third_layer.prune_cliques_without_neighbors()
-        return CliqueGraphSampler(third_layer)
-
 
 if __name__ == "__main__":
     ssl_config = SSLConfig(
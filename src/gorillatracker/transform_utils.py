@@ -1,8 +1,12 @@
-from typing import Literal, Optional, Union
+import math
+from typing import Callable, Literal, Optional, Union
 
 import numpy as np
 import torch
+import torch.nn.functional as F
+import torchvision.transforms.v2 as transforms_v2
 from PIL import Image
+from torch import nn
 from torchvision.transforms.functional import pad
 
 
@@ -130,3 +134,130 @@ class PlanckianJitter(object):
             )
         else:
             return self.__class__.__name__ + "(" + self.mode + ")"
+
+
+class BatchPlanckianJitter(nn.Module):
+    """`PlanckianJitter` for float batches (B x 3 x H x W in [0, 1]), every image gets its own illuminant."""
+
+    def __init__(self, mode: Literal["blackbody", "CIED"] = "blackbody") -> None:
+        super().__init__()
+        pl = torch.tensor(PlanckianJitter(mode).pl, dtype=torch.float32)
+        gains = torch.stack([pl[:, 0] / pl[:, 1], torch.ones(len(pl)), pl[:, 2] / pl[:, 1]], dim=1)
+        self.gains: torch.Tensor
+        self.register_buffer("gains", gains, persistent=False)
+
+    def forward(self, images: torch.Tensor, generator: Optional[torch.Generator] = None) -> torch.Tensor:
+        idx = torch.randint(0, len(self.gains), (len(images),), generator=generator, device=images.device)
+        return (images * self.gains[idx][:, :, None, None]).clamp_(max=1)
+
+
+class BatchAugmentation(nn.Module):
+    """Batched equivalent of the worker-side pipeline
+    PlanckianJitter -> RandomHorizontalFlip -> RandomErasing(value=0) -> RandomRotation(fill=0) -> RandomResizedCrop,
+    run on whole batches on the device the batch lives on (the CPU as fallback).
+
+    The workers only resize to `input_size` and send uint8 (see `worker_transform`). Flip, rotation and crop are fused
+    into a single `grid_sample` per batch. Erasing and cropping draw a single attempt per image (clamped to the image)
+    instead of rejection sampling. With a `seed`, every device gets its own seeded generator, otherwise the global
+    torch generator is used.
+    """
+
+    def __init__(
+        self,
+        size: int = 224,
+        input_size: int = 256,
+        flip_p: float = 0.5,
+        erase_p: float = 0.5,
+        erase_scale: tuple[float, float] = (0.02, 0.13),
+        erase_ratio: tuple[float, float] = (0.3, 3.3),
+        degrees: float = 60.0,
+        crop_scale: tuple[float, float] = (0.75, 1.0),
+        crop_ratio: tuple[float, float] = (3 / 4, 4 / 3),
+        jitter: bool = True,
+        seed: Optional[int] = None,
+    ) -> None:
+        super().__init__()
+        self.size = size
+        self.input_size = input_size
+        self.flip_p = flip_p
+        self.erase_p = erase_p
+        self.erase_scale = erase_scale
+        self.erase_log_ratio = (math.log(erase_ratio[0]), math.log(erase_ratio[1]))
+        self.degrees = degrees
+        self.crop_scale = crop_scale
+        self.crop_log_ratio = (math.log(crop_ratio[0]), math.log(crop_ratio[1]))
+        self.jitter = BatchPlanckianJitter() if jitter else None
+        self.seed = seed
+        self._generators: dict[torch.device, torch.Generator] = {}
+
+    def worker_transform(self) -> Callable[[torch.Tensor], torch.Tensor]:
+        """Replaces the training transforms in the DataLoader workers: resize and convert to uint8."""
+        return transforms_v2.Compose(
+            [
+                transforms_v2.Resize((self.input_size, self.input_size), antialias=True),
+                transforms_v2.ToDtype(torch.uint8, scale=True),
+            ]
+        )
+
+    def generator(self, device: torch.device) -> Optional[torch.Generator]:
+        if self.seed is None:
+            return None
+        if device not in self._generators:
+            self._generators[device] = torch.Generator(device=device).manual_seed(self.seed)
+        return self._generators[device]
+
+    def _uniform(
+        self, n: int, low: float, high: float, like: torch.Tensor, generator: Optional[torch.Generator]
+    ) -> torch.Tensor:
+        return torch.rand(n, generator=generator, device=like.device) * (high - low) + low
+
+    def forward(self, images: torch.Tensor) -> torch.Tensor:
+        """uint8 or float images (B x 3 x H x W) to float images (B x 3 x size x size) in [0, 1]."""
+        generator = self.generator(images.device)
+        images = images.float().div_(255) if images.dtype == torch.uint8 else images.float()
+        if self.jitter is not None:
+            images = self.jitter.to(images.device)(images, generator)
+        images = self._erase(images, generator)
+        return self._flip_rotate_crop(images, generator)
+
+    def _erase(self, images: torch.Tensor, generator: Optional[torch.Generator]) -> torch.Tensor:
+        n, _, height, width = images.shape
+        area = self._uniform(n, *self.erase_scale, images, generator) * height * width
+        aspect = self._uniform(n, *self.erase_log_ratio, images, generator).exp()
+        h = (area * aspect).sqrt().round().clamp(1, height - 1)
+        w = (area / aspect).sqrt().round().clamp(1, width - 1)
+        top = (torch.rand(n, generator=generator, device=images.device) * (height - h + 1)).floor()
+        left = (torch.rand(n, generator=generator, device=images.device) * (width - w + 1)).floor()
+        apply = torch.rand(n, generator=generator, device=images.device) < self.erase_p
+        rows = torch.arange(height, device=images.device)[None, :]
+        cols = torch.arange(width, device=images.device)[None, :]
+        in_rows = (rows >= top[:, None]) & (rows < (top + h)[:, None])
+        in_cols = (cols >= left[:, None]) & (cols < (left + w)[:, None])
+        erased = (in_rows[:, :, None] & in_cols[:, None, :]) & apply[:, None, None]
+        return images.masked_fill(erased[:, None], 0.0)
+
+    def _flip_rotate_crop(self, images: torch.Tensor, generator: Optional[torch.Generator]) -> torch.Tensor:
+        n, _, height, width = images.shape
+        device = images.device
+        # NOTE: crop box in pixels of the rotated image, like RandomResizedCrop.get_params
+        area = self._uniform(n, *self.crop_scale, images, generator) * height * width
+        aspect = self._uniform(n, *self.crop_log_ratio, images, generator).exp()
+        crop_w = (area * aspect).sqrt().round().clamp(1, width)
+        crop_h = (area / aspect).sqrt().round().clamp(1, height)
+        left = (torch.rand(n, generator=generator, device=device) * (width - crop_w + 1)).floor()
+        top = (torch.rand(n, generator=generator, device=device) * (height - crop_h + 1)).floor()
+
+        # NOTE: output coordinates u in [-1, 1] map to the crop as c + s * u in normalized coordinates of the rotated
+        # image, those are rotated back (in pixel units, D = diag(W / 2, H / 2)) and flipped: src = D^-1 F R D (c + s u)
+        scale = torch.stack([crop_w / width, crop_h / height], dim=1)
+        center = torch.stack([(2 * left + crop_w) / width - 1, (2 * top + crop_h) / height - 1], dim=1)
+        angle = self._uniform(n, -self.degrees, self.degrees, images, generator) * (math.pi / 180)
+        cos, sin = angle.cos(), angle.sin()
+        rotation = torch.stack([torch.stack([cos, -sin], dim=1), torch.stack([sin, cos], dim=1)], dim=1)
+        flip = torch.where(torch.rand(n, generator=generator, device=device) < self.flip_p, -1.0, 1.0)
+        d = torch.tensor([width / 2, height / 2], device=device)
+        linear = (rotation * d[None, None, :]) / d[None, :, None]  # D^-1 R D
+        linear[:, 0, :] *= flip[:, None]
+        theta = torch.cat([linear * scale[:, None, :], (linear @ center[:, :, None])], dim=2)
+        grid = F.affine_grid(theta, [n, images.shape[1], self.size, self.size], align_corners=False)
+        return F.grid_sample(images, grid, mode="bilinear", padding_mode="zeros", align_corners=False)
@@ -1,3 +1,5 @@
+import logging
+import time
 from copy import deepcopy
 from typing import Any, Literal
 
@@ -5,6 +7,8 @@ import torch
 import wandb
 from lightning import Callback, LightningModule, Trainer
 
+logger = logging.getLogger(__name__)
+
 
 class BestMetricLogger(Callback):
     def __init__(self, metric_name: str, mode: Literal["max", "min"] = "max") -> None:
@@ -35,3 +39,42 @@ class BestMetricLogger(Callback):
             wandb.log({f"{self.metric_name}_{self.mode}": self.best_value})
             for key, value in self.best_metrics.items():
                 wandb.log({f"{key}_{self.mode}": value.item()})
+
+
+class DataLoaderThroughputLogger(Callback):
+    """Logs training batches/s and the time spent waiting for data (between the end of a batch and the start of the
+    next one, which includes the host to device transfer) per epoch."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._epoch_start = self._last_batch_end = 0.0
+        self._wait = 0.0
+        self._batches = 0
+
+    def on_train_epoch_start(self, trainer: Trainer, pl_module: LightningModule) -> None:
+        self._epoch_start = self._last_batch_end = time.perf_counter()
+        self._wait = 0.0
+        self._batches = 0
+
+    def on_train_batch_start(self, trainer: Trainer, pl_module: LightningModule, batch: Any, batch_idx: int) -> None:
+        self._wait += time.perf_counter() - self._last_batch_end
+
+    def on_train_batch_end(
+        self, trainer: Trainer, pl_module: LightningModule, outputs: Any, batch: Any, batch_idx: int
+    ) -> None:
+        self._batches += 1
+        self._last_batch_end = time.perf_counter()
+
+    def on_train_epoch_end(self, trainer: Trainer, pl_module: LightningModule) -> None:
+        elapsed = self._last_batch_end - self._epoch_start
+        if self._batches == 0 or elapsed <= 0:
+            return
+        metrics = {
+            "data/batches_per_sec": self._batches / elapsed,
+            "data/wait_s": self._wait,
+            "data/wait_fraction": self._wait / elapsed,
+        }
+        pl_module.log_dict(metrics, on_epoch=True)
+        logger.info(
+            f"Epoch {trainer.current_epoch} data loading: " + ", ".join(f"{k}={v:.3f}" for k, v in metrics.items())
+        )
@@ -0,0 +1,166 @@
+from typing import Literal, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.distributed as dist
+
+import gorillatracker.type_helper as gtypes
+
+Partition = Literal["val", "train", "test"]
+PARTITIONS: tuple[Partition, ...] = ("val", "train", "test")
+EMBEDDINGS_TABLE_COLUMNS = ["label", "embedding", "id", "partition", "dataset"]
+
+
+class EmbeddingAccumulator:
+    """Collects embeddings with their labels, ids, partitions and dataloader indices in contiguous columns.
+
+    Tensor columns are preallocated and grown geometrically, so adding a batch is an amortized O(batch) copy instead
+    of the O(table) `pd.concat` it replaces. A DataFrame in the layout expected by `evaluate_embeddings` is only built
+    on demand by `to_dataframe`.
+    """
+
+    def __init__(
+        self,
+        embedding_size: int,
+        dataset_names: Sequence[str],
+        initial_capacity: int = 1024,
+        device: torch.device | str = "cpu",
+        dtype: torch.dtype = torch.float32,
+    ) -> None:
+        self.embedding_size = embedding_size
+        self.dataset_names = list(dataset_names)
+        self.device = torch.device(device)
+        self.dtype = dtype
+        self._initial_capacity = max(1, initial_capacity)
+        self.reset()
+
+    def reset(self) -> None:
+        self._size = 0
+        self._embeddings = torch.empty(
+            (self._initial_capacity, self.embedding_size), dtype=self.dtype, device=self.device
+        )
+        self._labels = torch.empty(self._initial_capacity, dtype=torch.long, device=self.device)
+        self._partitions = torch.empty(self._initial_capacity, dtype=torch.int8, device=self.device)
+        self._dataloader_indices = torch.empty(self._initial_capacity, dtype=torch.long, device=self.device)
+        self.ids: list[gtypes.Id] = []
+        self.batch_sizes: list[int] = []
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def capacity(self) -> int:
+        return len(self._labels)
+
+    @property
+    def embeddings(self) -> torch.Tensor:
+        return self._embeddings[: self._size]
+
+    @property
+    def labels(self) -> torch.Tensor:
+        return self._labels[: self._size]
+
+    @property
+    def partitions(self) -> torch.Tensor:
+        """Partition codes, indices into `PARTITIONS`."""
+        return self._partitions[: self._size]
+
+    @property
+    def dataloader_indices(self) -> torch.Tensor:
+        return self._dataloader_indices[: self._size]
+
+    def _reserve(self, capacity: int) -> None:
+        if capacity <= self.capacity:
+            return
+        new_capacity = max(capacity, 2 * self.capacity)
+
+        def grow(column: torch.Tensor) -> torch.Tensor:
+            grown = torch.empty((new_capacity, *column.shape[1:]), dtype=column.dtype, device=column.device)
+            grown[: self._size] = column[: self._size]
+            return grown
+
+        self._embeddings = grow(self._embeddings)
+        self._labels = grow(self._labels)
+        self._partitions = grow(self._partitions)
+        self._dataloader_indices = grow(self._dataloader_indices)
+
+    def add(
+        self,
+        ids: Sequence[gtypes.Id],
+        embeddings: torch.Tensor,
+        labels: torch.Tensor,
+        dataloader_idx: int = 0,
+        partition: Partition = "val",
+    ) -> None:
+        """Appends one batch. Embeddings are detached and copied to the accumulator's device."""
+        embeddings = embeddings.detach().reshape(-1, self.embedding_size)
+        n = len(embeddings)
+        assert len(ids) == n and len(labels) == n, "ids, embeddings and labels must have the same length"
+        self._reserve(self._size + n)
+        end = self._size + n
+        self._embeddings[self._size : end] = embeddings.to(device=self.device, dtype=self.dtype)
+        self._labels[self._size : end] = labels.detach().to(device=self.device, dtype=torch.long)
+        self._partitions[self._size : end] = PARTITIONS.index(partition)
+        self._dataloader_indices[self._size : end] = dataloader_idx
+        self.ids.extend(ids)
+        self.batch_sizes.append(n)
+        self._size = end
+
+    def all_gather(self) -> "EmbeddingAccumulator":
+        """Returns an accumulator holding the rows of all processes (rank order), or `self` outside of DDP.
+
+        Tensor columns are exchanged with padded `all_gather` calls, only the ids and batch sizes are pickled.
+        """
+        if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() == 1:
+            return self
+        world_size = dist.get_world_size()
+        comm_device = torch.device("cuda", torch.cuda.current_device()) if dist.get_backend() == "nccl" else "cpu"
+
+        metadata: list[Optional[tuple[list[gtypes.Id], list[int]]]] = [None] * world_size
+        dist.all_gather_object(metadata, (self.ids, self.batch_sizes))
+        sizes = [sum(batch_sizes) for _, batch_sizes in metadata]  # type: ignore
+        max_size = max(sizes)
+
+        def gather(column: torch.Tensor) -> list[torch.Tensor]:
+            padded = torch.zeros((max_size, *column.shape[1:]), dtype=column.dtype, device=comm_device)
+            padded[: self._size] = column[: self._size]
+            gathered = [torch.empty_like(padded) for _ in range(world_size)]
+            dist.all_gather(gathered, padded)
+            return [g[:size].to(self.device) for g, size in zip(gathered, sizes)]
+
+        columns = [gather(c) for c in (self._embeddings, self._labels, self._partitions, self._dataloader_indices)]
+        merged = EmbeddingAccumulator(self.embedding_size, self.dataset_names, 1, self.device, self.dtype)
+        merged._embeddings, merged._labels, merged._partitions, merged._dataloader_indices = (
+            torch.cat(c) for c in columns
+        )
+        merged._size = sum(sizes)
+        for ids, batch_sizes in metadata:  # type: ignore
+            merged.ids.extend(ids)
+            merged.batch_sizes.extend(batch_sizes)
+        return merged
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Builds the embeddings table with columns `EMBEDDINGS_TABLE_COLUMNS`.
+
+        NOTE: rows are emitted newest batch first, matching the table built by prepending every batch, so label
+        encodings and tie-breaking downstream stay unchanged.
+        """
+        ends = np.cumsum(self.batch_sizes, dtype=np.int64)
+        order = np.concatenate(
+            [np.arange(end - size, end) for size, end in zip(reversed(self.batch_sizes), reversed(ends))]
+            or [np.empty(0, dtype=np.int64)]
+        )
+        embeddings = self.embeddings.cpu().numpy()[order]
+        partitions = np.array(PARTITIONS, dtype=object)[self.partitions.cpu().numpy()[order]]
+        datasets = np.array(self.dataset_names, dtype=object)[self.dataloader_indices.cpu().numpy()[order]]
+        return pd.DataFrame(
+            {
+                "label": self.labels.cpu().numpy()[order].tolist(),
+                "embedding": list(embeddings),
+                "id": [self.ids[i] for i in order],
+                "partition": partitions,
+                "dataset": datasets,
+            },
+            columns=EMBEDDINGS_TABLE_COLUMNS,
+        )
@@ -0,0 +1,408 @@
+"""Streaming exact k-nearest-neighbour search.
+
+The gallery is processed in (query block x gallery block) tiles and only a running top-k per query row is kept, so
+memory is bounded by the tile size instead of growing with N^2. Works on CPU and GPU.
+"""
+
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Literal, Optional, Sequence
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torchmetrics.functional import pairwise_euclidean_distance
+
+DistanceMetric = Literal["euclidean", "cosine"]
+# (query indices [bq], gallery indices [bg]) -> bool tensor [bq, bg], True where the pair is an allowed neighbor
+MaskFn = Callable[[torch.Tensor, torch.Tensor], torch.Tensor]
+
+DEFAULT_MEMORY_BUDGET_MB = 256.0
+# NOTE: distances, mask, candidate concatenation and topk workspace are alive at the same time per tile
+_TILE_OVERHEAD = 4
+
+
+def pairwise_distances(queries: torch.Tensor, gallery: torch.Tensor, distance_metric: DistanceMetric) -> torch.Tensor:
+    """Returns the (len(queries) x len(gallery)) distance matrix."""
+    if distance_metric == "cosine":
+        return 1.0 - F.normalize(queries, dim=-1) @ F.normalize(gallery, dim=-1).T  # range [0, 2]
+    elif distance_metric == "euclidean":
+        return pairwise_euclidean_distance(queries, gallery)  # range [0, inf]
+    else:
+        raise ValueError(f"Unknown distance metric: {distance_metric}")
+
+
+def resolve_block_sizes(
+    n_queries: int,
+    n_gallery: int,
+    query_block_size: Optional[int] = None,
+    gallery_block_size: Optional[int] = None,
+    memory_budget_mb: float = DEFAULT_MEMORY_BUDGET_MB,
+    element_size: int = 4,
+) -> tuple[int, int]:
+    """Derives tile sizes from the memory budget for every block size that is not given explicitly."""
+    budget = int(memory_budget_mb * 2**20) // (element_size * _TILE_OVERHEAD)
+    if gallery_block_size is None:
+        gallery_block_size = min(n_gallery, max(1, budget // max(1, min(n_queries, query_block_size or 1024))))
+    if query_block_size is None:
+        query_block_size = max(1, budget // max(1, gallery_block_size))
+    return max(1, min(query_block_size, n_queries)), max(1, min(gallery_block_size, n_gallery))
+
+
+def blocked_topk_multi(
+    queries: torch.Tensor,
+    gallery: torch.Tensor,
+    k: int,
+    distance_metric: DistanceMetric = "euclidean",
+    mask_fns: Sequence[Optional[MaskFn]] = (None,),
+    exclude_self: bool = False,
+    query_block_size: Optional[int] = None,
+    gallery_block_size: Optional[int] = None,
+    memory_budget_mb: float = DEFAULT_MEMORY_BUDGET_MB,
+    device: Optional[torch.device] = None,
+) -> list[tuple[torch.Tensor, torch.Tensor]]:
+    """Like `blocked_topk`, but returns one neighbor list per mask while computing every distance tile only once.
+
+    Masks are applied cumulatively in the given order, i.e. the i-th result is restricted by `mask_fns[: i + 1]`.
+    """
+    device = device if device is not None else queries.device
+    n_queries, n_gallery = len(queries), len(gallery)
+    k = min(k, n_gallery)
+    if exclude_self:
+        assert n_queries == n_gallery, "exclude_self requires queries and gallery to be the same set"
+    query_block_size, gallery_block_size = resolve_block_sizes(
+        n_queries, n_gallery, query_block_size, gallery_block_size, memory_budget_mb, queries.element_size()
+    )
+
+    results_distances = [torch.empty((n_queries, k), device=device) for _ in mask_fns]
+    results_indices = [torch.empty((n_queries, k), dtype=torch.long, device=device) for _ in mask_fns]
+    for q_start in range(0, n_queries, query_block_size):
+        q_idx = torch.arange(q_start, min(q_start + query_block_size, n_queries), device=device)
+        q_block = queries[q_start : q_start + len(q_idx)].to(device)
+        running = [
+            (
+                torch.full((len(q_idx), 0), float("inf"), device=device),
+                torch.empty((len(q_idx), 0), dtype=torch.long, device=device),
+            )
+            for _ in mask_fns
+        ]
+        for g_start in range(0, n_gallery, gallery_block_size):
+            g_end = min(g_start + gallery_block_size, n_gallery)
+            g_idx = torch.arange(g_start, g_end, device=device)
+            distances = pairwise_distances(q_block, gallery[g_start:g_end].to(device), distance_metric)
+            overlap_start, overlap_end = max(q_start, g_start), min(q_start + len(q_idx), g_end)
+            if exclude_self and overlap_start < overlap_end:  # NOTE: the diagonal of the full matrix crosses this tile
+                overlap = torch.arange(overlap_start, overlap_end, device=device)
+                distances[overlap - q_start, overlap - g_start] = float("inf")
+            for i, mask_fn in enumerate(mask_fns):
+                if mask_fn is not None:  # NOTE: cumulative, later masks build on earlier ones
+                    distances = distances.masked_fill(~mask_fn(q_idx, g_idx).to(device), float("inf"))
+                # reduce the tile to its own top-k first, then merge with the running top-k
+                tile_distances, tile_positions = torch.topk(
+                    distances, min(k, distances.shape[1]), dim=1, largest=False, sorted=False
+                )
+                running_distances, running_indices = running[i]
+                candidate_distances = torch.cat([running_distances, tile_distances], dim=1)
+                candidate_indices = torch.cat([running_indices, tile_positions + g_start], dim=1)
+                top_distances, top_positions = torch.topk(
+                    candidate_distances, min(k, candidate_distances.shape[1]), dim=1, largest=False, sorted=True
+                )
+                running[i] = (top_distances, torch.gather(candidate_indices, 1, top_positions))
+        for i, (running_distances, running_indices) in enumerate(running):
+            results_distances[i][q_idx] = running_distances
+            results_indices[i][q_idx] = running_indices
+    return list(zip(results_distances, results_indices))
+
+
+def blocked_topk(
+    queries: torch.Tensor,
+    gallery: torch.Tensor,
+    k: int,
+    distance_metric: DistanceMetric = "euclidean",
+    mask_fn: Optional[MaskFn] = None,
+    exclude_self: bool = False,
+    query_block_size: Optional[int] = None,
+    gallery_block_size: Optional[int] = None,
+    memory_budget_mb: float = DEFAULT_MEMORY_BUDGET_MB,
+    device: Optional[torch.device] = None,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """Exact k-nearest-neighbour search that never materializes the full distance matrix.
+
+    Args:
+        queries: (n_queries x d) query embeddings.
+        gallery: (n_gallery x d) gallery embeddings.
+        k: number of neighbors, clipped to len(gallery).
+        distance_metric: "euclidean" or "cosine" (1 - cosine similarity).
+        mask_fn: optional callback returning which (query, gallery) pairs are allowed, disallowed pairs get an infinite
+            distance.
+        exclude_self: queries and gallery are the same set, a sample is never its own neighbor.
+        query_block_size, gallery_block_size: tile size, derived from `memory_budget_mb` if not given.
+        memory_budget_mb: approximate upper bound for the working memory of one tile.
+        device: device to compute on, defaults to the device of `queries`. Blocks are moved there lazily.
+
+    Returns:
+        distances and indices into `gallery` of the k nearest neighbors per query, sorted ascending by distance.
+        Rows with fewer than k allowed neighbors are padded with infinite distances.
+    """
+    ((distances, indices),) = blocked_topk_multi(
+        queries,
+        gallery,
+        k,
+        distance_metric=distance_metric,
+        mask_fns=(mask_fn,),
+        exclude_self=exclude_self,
+        query_block_size=query_block_size,
+        gallery_block_size=gallery_block_size,
+        memory_budget_mb=memory_budget_mb,
+        device=device,
+    )
+    return distances, indices
+
+
+class NeighborBackend(ABC):
+    """Nearest-neighbour search strategy used by the kNN metrics.
+
+    `search` returns one (distances, indices) pair per mask in `mask_fns`, masks are applied cumulatively like in
+    `blocked_topk_multi`. Distances are sorted ascending, rows with fewer than k allowed neighbors are padded with
+    infinite distances.
+    """
+
+    name: str
+
+    @abstractmethod
+    def search(
+        self,
+        queries: torch.Tensor,
+        gallery: torch.Tensor,
+        k: int,
+        distance_metric: DistanceMetric = "euclidean",
+        mask_fns: Sequence[Optional[MaskFn]] = (None,),
+        exclude_self: bool = False,
+    ) -> list[tuple[torch.Tensor, torch.Tensor]]:
+        pass
+
+
+class BruteForceBackend(NeighborBackend):
+    """Exact search on the full (len(queries) x len(gallery)) distance matrix."""
+
+    name = "brute-force"
+
+    def __init__(self, device: Optional[torch.device] = None) -> None:
+        self.device = device
+
+    def search(
+        self,
+        queries: torch.Tensor,
+        gallery: torch.Tensor,
+        k: int,
+        distance_metric: DistanceMetric = "euclidean",
+        mask_fns: Sequence[Optional[MaskFn]] = (None,),
+        exclude_self: bool = False,
+    ) -> list[tuple[torch.Tensor, torch.Tensor]]:
+        return blocked_topk_multi(
+            queries,
+            gallery,
+            k,
+            distance_metric=distance_metric,
+            mask_fns=mask_fns,
+            exclude_self=exclude_self,
+            query_block_size=len(queries),
+            gallery_block_size=len(gallery),
+            device=self.device,
+        )
+
+
+class BlockBackend(NeighborBackend):
+    """Exact search with the streaming tile engine, see `blocked_topk`."""
+
+    name = "block"
+
+    def __init__(
+        self,
+        memory_budget_mb: float = DEFAULT_MEMORY_BUDGET_MB,
+        query_block_size: Optional[int] = None,
+        gallery_block_size: Optional[int] = None,
+        device: Optional[torch.device] = None,
+    ) -> None:
+        self.memory_budget_mb = memory_budget_mb
+        self.query_block_size = query_block_size
+        self.gallery_block_size = gallery_block_size
+        self.device = device
+
+    def search(
+        self,
+        queries: torch.Tensor,
+        gallery: torch.Tensor,
+        k: int,
+        distance_metric: DistanceMetric = "euclidean",
+        mask_fns: Sequence[Optional[MaskFn]] = (None,),
+        exclude_self: bool = False,
+    ) -> list[tuple[torch.Tensor, torch.Tensor]]:
+        return blocked_topk_multi(
+            queries,
+            gallery,
+            k,
+            distance_metric=distance_metric,
+            mask_fns=mask_fns,
+            exclude_self=exclude_self,
+            query_block_size=self.query_block_size,
+            gallery_block_size=self.gallery_block_size,
+            memory_budget_mb=self.memory_budget_mb,
+            device=self.device,
+        )
+
+
+class FaissBackend(NeighborBackend):
+    """Approximate search with a faiss CPU index ("hnsw" or "ivf").
+
+    Masks and `exclude_self` are applied after the search: `oversample * k` candidates are retrieved and filtered.
+    Rows that keep fewer than k allowed candidates are recomputed exactly with the block engine, so masking never
+    costs recall. Cosine distance is searched as inner product on L2-normalized embeddings.
+    """
+
+    def __init__(
+        self,
+        index_type: Literal["hnsw", "ivf"] = "hnsw",
+        hnsw_m: int = 32,
+        ef_search: int = 128,
+        ef_construction: int = 200,
+        nlist: Optional[int] = None,
+        nprobe: int = 16,
+        oversample: int = 4,
+        fallback: Optional[NeighborBackend] = None,
+    ) -> None:
+        try:
+            import faiss
+        except ImportError as e:
+            raise ImportError("FaissBackend requires faiss, install faiss-cpu (see environment.yml)") from e
+        self.faiss = faiss
+        self.index_type = index_type
+        self.name = f"faiss-{index_type}"
+        self.hnsw_m = hnsw_m
+        self.ef_search = ef_search
+        self.ef_construction = ef_construction
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.oversample = oversample
+        self.fallback = fallback if fallback is not None else BlockBackend()
+
+    def build_index(self, gallery: np.ndarray, distance_metric: DistanceMetric) -> Any:
+        faiss = self.faiss
+        dim = gallery.shape[1]
+        metric = faiss.METRIC_INNER_PRODUCT if distance_metric == "cosine" else faiss.METRIC_L2
+        if self.index_type == "hnsw":
+            index = faiss.IndexHNSWFlat(dim, self.hnsw_m, metric)
+            index.hnsw.efConstruction = self.ef_construction
+            index.hnsw.efSearch = self.ef_search
+        elif self.index_type == "ivf":
+            nlist = self.nlist or max(1, min(int(4 * np.sqrt(len(gallery))), len(gallery) // 39 or 1))
+            quantizer = faiss.IndexFlatIP(dim) if distance_metric == "cosine" else faiss.IndexFlatL2(dim)
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, metric)
+            index.train(gallery)
+            index.nprobe = min(self.nprobe, nlist)
+        else:
+            raise ValueError(f"Unknown faiss index type: {self.index_type}")
+        index.add(gallery)
+        return index
+
+    def search(
+        self,
+        queries: torch.Tensor,
+        gallery: torch.Tensor,
+        k: int,
+        distance_metric: DistanceMetric = "euclidean",
+        mask_fns: Sequence[Optional[MaskFn]] = (None,),
+        exclude_self: bool = False,
+    ) -> list[tuple[torch.Tensor, torch.Tensor]]:
+        if distance_metric not in ("euclidean", "cosine"):
+            raise ValueError(f"Unknown distance metric: {distance_metric}")
+        k = min(k, len(gallery))
+        queries_np = queries.detach().float().cpu().numpy().copy()
+        gallery_np = gallery.detach().float().cpu().numpy().copy()
+        if distance_metric == "cosine":
+            self.faiss.normalize_L2(queries_np)
+            self.faiss.normalize_L2(gallery_np)
+
+        index = self.build_index(gallery_np, distance_metric)
+        needs_filter = exclude_self or any(mask_fn is not None for mask_fn in mask_fns)
+        n_candidates = min(len(gallery), k * self.oversample + int(exclude_self) if needs_filter else k)
+        raw_distances, raw_indices = index.search(queries_np, n_candidates)
+        candidate_indices = torch.from_numpy(raw_indices).long()
+        candidate_distances = torch.from_numpy(raw_distances)
+        if distance_metric == "cosine":
+            candidate_distances = 1.0 - candidate_distances
+        else:
+            candidate_distances = candidate_distances.clamp(min=0.0).sqrt()  # NOTE: faiss returns squared L2
+        allowed = candidate_indices >= 0  # NOTE: faiss pads missing results with -1
+        candidate_indices = candidate_indices.clamp(min=0)
+        if exclude_self:
+            allowed &= candidate_indices != torch.arange(len(queries)).unsqueeze(1)
+
+        results = []
+        for mask_fn in mask_fns:
+            if mask_fn is not None:
+                allowed &= _evaluate_mask_on_candidates(mask_fn, candidate_indices)
+            distances = candidate_distances.masked_fill(~allowed, float("inf"))
+            top_distances, top_positions = torch.topk(distances, k, dim=1, largest=False, sorted=True)
+            results.append((top_distances, torch.gather(candidate_indices, 1, top_positions)))
+
+        # recompute rows that lost too many candidates to the masks exactly
+        deficient = torch.zeros(len(queries), dtype=torch.bool)
+        for top_distances, _ in results:
+            deficient |= torch.isinf(top_distances).any(dim=1)
+        rows = deficient.nonzero().squeeze(1)
+        if len(rows) > 0:
+            exact = self.fallback.search(
+                queries[rows],
+                gallery,
+                k,
+                distance_metric=distance_metric,
+                mask_fns=[_restrict_mask_to_rows(mask_fn, rows, exclude_self) for mask_fn in mask_fns],
+            )
+            for (distances, indices), (exact_distances, exact_indices) in zip(results, exact):
+                distances[rows], indices[rows] = exact_distances.cpu(), exact_indices.cpu()
+        return results
+
+
+def _evaluate_mask_on_candidates(
+    mask_fn: MaskFn, candidate_indices: torch.Tensor, chunk_size: int = 256
+) -> torch.Tensor:
+    """Evaluates `mask_fn` for the (query, candidate) pairs of a (n_queries x n_candidates) candidate matrix."""
+    allowed = torch.empty(candidate_indices.shape, dtype=torch.bool)
+    for start in range(0, len(candidate_indices), chunk_size):
+        chunk = candidate_indices[start : start + chunk_size]
+        q_idx = torch.arange(start, start + len(chunk))
+        g_idx, columns = torch.unique(chunk, return_inverse=True)
+        allowed[start : start + len(chunk)] = mask_fn(q_idx, g_idx).cpu().gather(1, columns)
+    return allowed
+
+
+def _restrict_mask_to_rows(mask_fn: Optional[MaskFn], rows: torch.Tensor, exclude_self: bool) -> Optional[MaskFn]:
+    """Maps the mask of the full query set to a subset of queries, optionally adding the self exclusion."""
+    if mask_fn is None and not exclude_self:
+        return None
+
+    def restricted(q_idx: torch.Tensor, g_idx: torch.Tensor) -> torch.Tensor:
+        original_q_idx = rows.to(q_idx.device)[q_idx]
+        mask = torch.ones((len(q_idx), len(g_idx)), dtype=torch.bool, device=q_idx.device)
+        if mask_fn is not None:
+            mask &= mask_fn(original_q_idx, g_idx).to(q_idx.device)
+        if exclude_self:
+            mask &= original_q_idx.unsqueeze(1) != g_idx.unsqueeze(0)
+        return mask
+
+    return restricted
+
+
+NEIGHBOR_BACKENDS = ("brute-force", "block", "faiss-hnsw", "faiss-ivf")
+
+
+def get_neighbor_backend(name: str, **kwargs: Any) -> NeighborBackend:
+    """Returns the backend for one of `NEIGHBOR_BACKENDS`, kwargs are passed to its constructor."""
+    if name == "brute-force":
+        return BruteForceBackend(**kwargs)
+    elif name == "block":
+        return BlockBackend(**kwargs)
+    elif name in ("faiss-hnsw", "faiss-ivf"):
+        return FaissBackend(index_type=name.removeprefix("faiss-"), **kwargs)  # type: ignore
+    else:
+        raise ValueError(f"Unknown neighbor backend {name}, choose one of {NEIGHBOR_BACKENDS}")
@@ -1,8 +1,9 @@
 import collections
 import logging
 import os
+import re
 from copy import deepcopy
-from typing import Any, Dict, List, Tuple, Union
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
 
 import torch
 from torch import nn
@@ -129,15 +130,27 @@ class L2_SP(nn.Module):
         archivePrefix={arXiv},
         primaryClass={cs.LG}
     }
+
+    The (parameter, pretrained parameter) pairs are resolved on the first forward, the pretrained parameters are kept
+    in one flat `reference` buffer on the device of the model and the penalty is computed with multi-tensor (foreach)
+    ops. Parameters whose name matches one of the `exclude` regular expressions are not regularised at all.
     """
 
-    def __init__(self, model: nn.Module, path_to_pretrained_weights: str, alpha: float, beta: float) -> None:
+    def __init__(
+        self,
+        model: nn.Module,
+        path_to_pretrained_weights: str,
+        alpha: float,
+        beta: float,
+        exclude: Sequence[str] = (),
+    ) -> None:
         #
 
         super().__init__()
 
         self.alpha = alpha
         self.beta = beta
+        self.exclude = [re.compile(pattern) for pattern in exclude]
         # assert cfg.train.regularization.style == 'l2_sp'
         assert (
             "pretrained_weights/" in path_to_pretrained_weights
@@ -170,14 +183,21 @@ class L2_SP(nn.Module):
         log.debug("pretrained keys for L2SP: {}".format(self.pretrained_keys))
         log.debug("Novel keys for L2SP: {}".format(self.new_keys))
 
-        for key in self.pretrained_keys:
-            # can't register a buffer with dots in the keys
-            self.register_buffer(self.dots_to_underscores(key), pretrained_state[key])
+        references = [pretrained_state[key].detach().flatten() for key in self.pretrained_keys]
+        self.reference_shapes = [pretrained_state[key].shape for key in self.pretrained_keys]
+        self.reference: torch.Tensor
+        self.register_buffer("reference", torch.cat(references) if references else torch.zeros(0))
+        # NOTE: not registered as submodules or buffers, (id(model), pretrained params, new params) and the views
+        self._parameters_of: Optional[Tuple[int, List[torch.Tensor], List[torch.Tensor]]] = None
+        self._reference_views: Optional[Tuple[int, List[torch.Tensor]]] = None
 
     @staticmethod
     def dots_to_underscores(key: str) -> str:
         return key.replace(".", "_")
 
+    def is_excluded(self, key: str) -> bool:
+        return any(pattern.search(key) for pattern in self.exclude)
+
     def get_keys(self, model: nn.Module, pretrained_state: StateDictType) -> Tuple[List[str], List[str]]:
         """Gets parameter names that are in both current model and pretrained weights, and unique keys to our model
 
@@ -196,7 +216,7 @@ class L2_SP(nn.Module):
             Keys uniquely in current model
         """
 
-        to_decay = get_keys_to_decay(model)
+        to_decay = [key for key in get_keys_to_decay(model) if not self.is_excluded(key)]
         model_state = model.state_dict()
         is_in_pretrained, not_in_pretrained = [], []
         for key in to_decay:
@@ -211,38 +231,64 @@ class L2_SP(nn.Module):
                 not_in_pretrained.append(key)
         return is_in_pretrained, not_in_pretrained
 
-    def forward(self, model: nn.Module) -> float:
-        towards_pretrained, towards_0 = 0, 0
-
-        # not passing keep_vars will detach the tensor from the computation graph, resulting in no effect on the
-        # training but also no error messages
-        model_state = model.state_dict(keep_vars=True)
-        pretrained_state = self.state_dict(keep_vars=True)
+    def resolve_parameters(self, model: nn.Module) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        """The parameters of `model` regularised towards the reference and towards 0, looked up once per model."""
+        if self._parameters_of is None or self._parameters_of[0] != id(model):
+            # not passing keep_vars will detach the tensor from the computation graph, resulting in no effect on the
+            # training but also no error messages
+            model_state = model.state_dict(keep_vars=True)
+            pretrained_params = [model_state[key] for key in self.pretrained_keys]
+            new_params = [model_state[key] for key in self.new_keys]
+            self._parameters_of = (id(model), pretrained_params, new_params)
+        return self._parameters_of[1], self._parameters_of[2]
+
+    def reference_views(self, device: torch.device) -> List[torch.Tensor]:
+        """Views into the flat `reference` buffer, one per pretrained key."""
+        if self.reference.device != device:
+            self.reference = self.reference.to(device)
+        if self._reference_views is None or self._reference_views[0] != self.reference.data_ptr():
+            numels = [shape.numel() for shape in self.reference_shapes]
+            views = [
+                view.view(shape) for view, shape in zip(torch.split(self.reference, numels), self.reference_shapes)
+            ]
+            self._reference_views = (self.reference.data_ptr(), views)
+        return self._reference_views[1]
 
-        for key in self.pretrained_keys:
-            model_param = model_state[key]
-            pretrained_param = pretrained_state[self.dots_to_underscores(key)]
-            towards_pretrained += (model_param - pretrained_param).pow(2).sum() * 0.5
+    def forward(self, model: nn.Module) -> float:
+        towards_pretrained: Union[float, torch.Tensor] = 0.0
+        towards_0: Union[float, torch.Tensor] = 0.0
+        pretrained_params, new_params = self.resolve_parameters(model)
 
-        for key in self.new_keys:
-            model_param = model_state[key]
-            towards_0 += model_param.pow(2).sum() * 0.5
+        # NOTE: the squared L2 norm of every tensor in one multi-tensor kernel instead of a Python loop over the keys
+        if pretrained_params:
+            differences = torch._foreach_sub(pretrained_params, self.reference_views(pretrained_params[0].device))
+            towards_pretrained = torch.stack(torch._foreach_norm(differences)).pow(2).sum() * 0.5
+        if new_params:
+            towards_0 = torch.stack(torch._foreach_norm(new_params)).pow(2).sum() * 0.5
 
         if towards_pretrained != towards_pretrained or towards_0 != towards_0:
             msg = "invalid loss in L2-SP: towards pretrained: {} towards 0: {}".format(towards_pretrained, towards_0)
             raise ValueError(msg)
 
-        # alternate method. same result, ~50% slower
-        #         towards_pretrained, towards_0 = 0, 0
-
-        #         for key, param in model.named_parameters():
-        #             if key in self.pretrained_keys:
-        #                 pretrained_param = getattr(self, self.dots_to_underscores(key))
-        #                 towards_pretrained += (param - pretrained_param).pow(2).sum()*0.5
-        #             elif key in self.new_keys:
-        #                 towards_0 += param.pow(2).sum()*0.5
-
-        return towards_pretrained * self.alpha + towards_0 * self.beta
+        return towards_pretrained * self.alpha + towards_0 * self.beta  # type: ignore
+
+    def _load_from_state_dict(
+        self,
+        state_dict: Dict[str, Any],
+        prefix: str,
+        local_metadata: Dict[str, Any],
+        strict: bool,
+        missing_keys: List[str],
+        unexpected_keys: List[str],
+        error_msgs: List[str],
+    ) -> None:
+        # NOTE: checkpoints before the flat reference buffer have one buffer per key, with dots replaced by underscores
+        legacy_keys = [prefix + self.dots_to_underscores(key) for key in self.pretrained_keys]
+        if prefix + "reference" not in state_dict and legacy_keys and all(key in state_dict for key in legacy_keys):
+            state_dict[prefix + "reference"] = torch.cat([state_dict.pop(key).flatten() for key in legacy_keys])
+        super()._load_from_state_dict(
+            state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs
+        )
 
 
 def get_regularization_loss(model: nn.Module, args: Dict[str, Any]) -> Union[L2, L2_SP]:
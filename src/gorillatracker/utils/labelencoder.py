@@ -1,6 +1,9 @@
-from typing import Dict, List, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union
+
+import torch
 
 mapping: Dict[str, int] = {}
+inverse_mapping: List[str] = []
 
 
 class LabelEncoder:
@@ -8,6 +11,7 @@ class LabelEncoder:
     def encode(label: str) -> int:
         if label not in mapping:
             mapping[label] = len(mapping)
+            inverse_mapping.append(label)
         return mapping[label]
 
     @staticmethod
@@ -16,38 +20,127 @@ class LabelEncoder:
 
     @staticmethod
     def decode(index: int) -> str:
-        decode_mapping = {v: k for k, v in mapping.items()}
-        assert len(decode_mapping) == len(mapping), "1:1 mapping"
-        return decode_mapping[index]
+        assert len(inverse_mapping) == len(mapping), "1:1 mapping"
+        return inverse_mapping[index]
 
     @staticmethod
     def decode_list(indices: List[int]) -> List[str]:
-        decode_mapping = {v: k for k, v in mapping.items()}
-        assert len(decode_mapping) == len(mapping), "1:1 mapping"
-        return [decode_mapping[index] for index in indices]
+        assert len(inverse_mapping) == len(mapping), "1:1 mapping"
+        return [inverse_mapping[index] for index in indices]
 
 
 class LinearSequenceEncoder:
     def __init__(self) -> None:
         self.mapping: Dict[int, int] = {}
+        self.inverse_mapping: List[int] = []
 
     def encode(self, label: int) -> int:
         if label not in self.mapping:
             self.mapping[label] = len(self.mapping)
+            self.inverse_mapping.append(label)
         return self.mapping[label]
 
     def encode_list(self, labels: Union[List[int], Tuple[int]]) -> List[int]:
         return [self.encode(label) for label in labels]
 
     def decode(self, index: int) -> int:
-        decode_mapping = {v: k for k, v in self.mapping.items()}
-        assert len(decode_mapping) == len(self.mapping), "1:1 mapping"
-        return decode_mapping[index]
+        assert len(self.inverse_mapping) == len(self.mapping), "1:1 mapping"
+        return self.inverse_mapping[index]
 
     def decode_list(self, indices: Union[List[int], Tuple[int]]) -> List[int]:
-        decode_mapping = {v: k for k, v in self.mapping.items()}
-        assert len(decode_mapping) == len(self.mapping), "1:1 mapping"
-        return [decode_mapping[index] for index in indices]
+        assert len(self.inverse_mapping) == len(self.mapping), "1:1 mapping"
+        return [self.inverse_mapping[index] for index in indices]
+
+
+def sorted_lookup(keys: torch.Tensor, values: torch.Tensor, queries: torch.Tensor, default: float) -> torch.Tensor:
+    """`values[i]` for every query equal to `keys[i]` (`keys` sorted ascending), `default` for all other queries."""
+    if len(keys) == 0:
+        return torch.full_like(queries, default, dtype=values.dtype)
+    idx = torch.searchsorted(keys, queries).clamp_(max=len(keys) - 1)
+    return torch.where(
+        keys[idx] == queries, values[idx], torch.tensor(default, dtype=values.dtype, device=values.device)
+    )
+
+
+class TensorLabelEncoder(LinearSequenceEncoder):
+    """`LinearSequenceEncoder` that also encodes and decodes label tensors on the device of the labels.
+
+    Labels are encoded by indexing `forward_lookup[label]` (the code of a non-negative label or -1) while the labels
+    are dense, i.e. the largest label is below `max(DENSE_FACTOR * len(mapping), DENSE_MIN_SIZE)`. Sparse labels
+    (e.g. SSL tracking ids) are looked up with `searchsorted` in `sorted_labels` instead, so the lookups never hold
+    more than that many entries. `inverse_lookup[code]` is the label of a code. The lookups are rebuilt only when the
+    mapping grew, i.e. when a batch has labels that were not seen before (these are encoded with `encode_list` in
+    order of appearance, like `LinearSequenceEncoder` would).
+
+    Finding unseen labels in a batch on the GPU synchronizes with the host. With a `capacity` (e.g. the number of
+    classes of the loss), the check is skipped once `capacity` labels are encoded: no code is left, so an unseen
+    label is invalid anyway and is encoded as -1 instead of a code beyond the capacity.
+    """
+
+    DENSE_FACTOR = 4
+    DENSE_MIN_SIZE = 4096
+
+    def __init__(self, capacity: Optional[int] = None) -> None:
+        super().__init__()
+        self.capacity = capacity
+        self.forward_lookup: Optional[torch.Tensor] = torch.full((0,), -1, dtype=torch.long)
+        self.sorted_labels = torch.zeros((0,), dtype=torch.long)
+        self.sorted_codes = torch.zeros((0,), dtype=torch.long)
+        self.inverse_lookup = torch.zeros((0,), dtype=torch.long)
+
+    @classmethod
+    def from_encoder(cls, encoder: LinearSequenceEncoder, capacity: Optional[int] = None) -> "TensorLabelEncoder":
+        """`encoder` itself if it already is a `TensorLabelEncoder` (its capacity is set), else a copy of its codes."""
+        tensor_encoder = encoder if isinstance(encoder, TensorLabelEncoder) else cls()
+        if tensor_encoder is not encoder:
+            tensor_encoder.encode_list(encoder.inverse_mapping)
+        tensor_encoder.capacity = capacity
+        return tensor_encoder
+
+    def lookups(self, device: torch.device) -> Tuple[Optional[torch.Tensor], torch.Tensor]:
+        """The forward (None for sparse labels) and inverse lookup tensors on `device`, rebuilt if labels were
+        encoded since the last call."""
+        if len(self.inverse_lookup) != len(self.mapping):
+            labels = torch.tensor(self.inverse_mapping, dtype=torch.long)
+            size = int(labels.max()) + 1 if len(labels) else 0
+            self.sorted_labels, self.sorted_codes = labels.sort()
+            self.forward_lookup = None
+            if size <= max(self.DENSE_FACTOR * len(labels), self.DENSE_MIN_SIZE):
+                self.forward_lookup = torch.full((size,), -1, dtype=torch.long)
+                self.forward_lookup[labels] = torch.arange(len(labels))
+            self.inverse_lookup = labels
+        if self.inverse_lookup.device != device:
+            self.forward_lookup = self.forward_lookup.to(device) if self.forward_lookup is not None else None
+            self.sorted_labels = self.sorted_labels.to(device)
+            self.sorted_codes = self.sorted_codes.to(device)
+            self.inverse_lookup = self.inverse_lookup.to(device)
+        return self.forward_lookup, self.inverse_lookup
+
+    def _codes(self, labels: torch.Tensor) -> torch.Tensor:
+        """The codes of (long) labels, -1 for labels that are not encoded yet."""
+        forward_lookup, _ = self.lookups(labels.device)
+        if forward_lookup is None:
+            return sorted_lookup(self.sorted_labels, self.sorted_codes, labels, default=-1)
+        if len(forward_lookup) == 0:
+            return torch.full_like(labels, -1)
+        known = torch.logical_and(labels >= 0, labels < len(forward_lookup))
+        return torch.where(known, forward_lookup[labels.clamp(0, len(forward_lookup) - 1)], -1)
+
+    def encode_tensor(self, labels: torch.Tensor) -> torch.Tensor:
+        labels = labels.long()
+        codes = self._codes(labels)
+        if self.capacity is not None and len(self.mapping) >= self.capacity:
+            return codes
+        if not (codes < 0).any():
+            return codes
+        new_labels = labels.tolist()
+        assert min(new_labels, default=0) >= 0, "Labels must be non-negative"
+        self.encode_list(new_labels)
+        return self._codes(labels)
+
+    def decode_tensor(self, codes: torch.Tensor) -> torch.Tensor:
+        _, inverse_lookup = self.lookups(codes.device)
+        return inverse_lookup[codes.long()]
 
 
 if __name__ == "__main__":
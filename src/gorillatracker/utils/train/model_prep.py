@@ -83,6 +83,7 @@ class ModelConstructor:
             l2_alpha=args.l2_alpha,
             l2_beta=args.l2_beta,
             path_to_pretrained_weights=args.path_to_pretrained_weights,
+            l2sp_exclude=args.l2sp_exclude,
             use_wildme_model=args.use_wildme_model,
             k_subcenters=args.k_subcenters,
             use_focal_loss=args.use_focal_loss,
@@ -92,6 +93,12 @@ class ModelConstructor:
             use_inbatch_mixup=args.use_inbatch_mixup,
             teacher_model_wandb_link=args.teacher_model_wandb_link,
             knn_with_train=args.knn_with_train,
+            knn_backend=args.knn_backend,
+            val_loss_chunk_size=args.val_loss_chunk_size,
+            train_embedding_cache_policy=args.train_embedding_cache_policy,
+            train_embedding_cache_refresh_interval=args.train_embedding_cache_refresh_interval,
+            train_embedding_cache_momentum=args.train_embedding_cache_momentum,
+            train_embedding_cache_max_size=args.train_embedding_cache_max_size,
             use_quantization_aware_training=args.use_quantization_aware_training,
             fast_dev_run=args.fast_dev_run,
             every_n_val_epochs=args.embedding_save_interval,  # TODO(rob2u): rename
@@ -40,6 +40,7 @@ def train_and_validate_model(
         devices=args.num_devices,
         accelerator=args.accelerator,
         strategy=str(args.distributed_strategy),
+        use_distributed_sampler=args.train_batch_sampler != "pk",  # NOTE: PKBatchSampler shards itself
         logger=wandb_logger,
         deterministic=(
             args.force_deterministic if args.force_deterministic and not args.use_quantization_aware_training else False
@@ -0,0 +1,143 @@
+from typing import Literal, Optional, Sequence
+
+import torch
+
+import gorillatracker.type_helper as gtypes
+
+RefreshPolicy = Literal["every_n_epochs", "on_checkpoint", "momentum"]
+
+
+class TrainEmbeddingCache:
+    """Keeps the training-set embeddings used as additional gallery by the kNN "with-train" metrics.
+
+    Refresh policies:
+    - "every_n_epochs": recompute with a full pass over the training set every `refresh_every_n_epochs` epochs. With
+      the default of 1, every validation after a training step recomputes (also several validations in one epoch).
+    - "on_checkpoint": recompute at the first validation after a checkpoint was saved (see `mark_stale`).
+    - "momentum": never recompute, instead `update` blends embeddings already computed in `training_step` into the
+      cache with an exponential moving average (new = momentum * old + (1 - momentum) * current).
+    A full pass is always done while the cache is empty. At most `max_size` embeddings are kept, later ids are dropped.
+    """
+
+    def __init__(
+        self,
+        policy: RefreshPolicy = "every_n_epochs",
+        refresh_every_n_epochs: int = 1,
+        momentum: float = 0.9,
+        max_size: Optional[int] = None,
+    ) -> None:
+        assert policy in ("every_n_epochs", "on_checkpoint", "momentum"), f"Unknown refresh policy {policy}"
+        assert refresh_every_n_epochs > 0
+        assert 0.0 <= momentum < 1.0
+        self.policy = policy
+        self.refresh_every_n_epochs = refresh_every_n_epochs
+        self.momentum = momentum
+        self.max_size = max_size
+        self.clear()
+
+    def clear(self) -> None:
+        # NOTE: grown geometrically, only the first len(self) rows are valid
+        self._embeddings: Optional[torch.Tensor] = None
+        self._labels: Optional[torch.Tensor] = None
+        self.ids: list[gtypes.Id] = []
+        self._index: dict[gtypes.Id, int] = {}
+        self._last_refresh_epoch: Optional[int] = None
+        self._last_refresh_step: Optional[int] = None
+        self._stale = False
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def embeddings(self) -> Optional[torch.Tensor]:
+        return None if self._embeddings is None else self._embeddings[: len(self)]
+
+    @property
+    def labels(self) -> Optional[torch.Tensor]:
+        return None if self._labels is None else self._labels[: len(self)]
+
+    @property
+    def remaining_capacity(self) -> Optional[int]:
+        return None if self.max_size is None else max(0, self.max_size - len(self))
+
+    def mark_stale(self) -> None:
+        """Called when a checkpoint is saved, the "on_checkpoint" policy refreshes on the next validation."""
+        self._stale = True
+
+    def needs_refresh(self, epoch: int, global_step: Optional[int] = None) -> bool:
+        """`global_step` is the number of training steps so far, without it every validation refreshes for N=1."""
+        if len(self) == 0:
+            return True
+        if self.policy == "every_n_epochs":
+            if self.refresh_every_n_epochs == 1:
+                return global_step is None or global_step != self._last_refresh_step
+            assert self._last_refresh_epoch is not None
+            return epoch - self._last_refresh_epoch >= self.refresh_every_n_epochs
+        if self.policy == "on_checkpoint":
+            return self._stale
+        return False
+
+    def refresh(
+        self,
+        embeddings: torch.Tensor,
+        labels: torch.Tensor,
+        ids: Sequence[gtypes.Id],
+        epoch: int,
+        global_step: Optional[int] = None,
+    ) -> None:
+        """Replaces the cache content with freshly computed embeddings."""
+        self.clear()
+        self._insert(embeddings.detach(), labels.detach(), ids)
+        self._last_refresh_epoch = epoch
+        self._last_refresh_step = global_step
+
+    def update(self, embeddings: torch.Tensor, labels: torch.Tensor, ids: Sequence[gtypes.Id]) -> None:
+        """Hook to reuse embeddings that were computed anyway, e.g. the anchors of a training step.
+
+        Only has an effect with the "momentum" policy. Known ids are blended into the cache, unknown ids are added
+        while there is capacity left.
+        """
+        if self.policy != "momentum":
+            return
+        embeddings, labels = embeddings.detach(), labels.detach()
+        positions = [self._index.get(id, -1) for id in ids]
+        known = torch.tensor([p >= 0 for p in positions], dtype=torch.bool)
+        if self._embeddings is not None and known.any():
+            rows = torch.tensor([p for p in positions if p >= 0], device=self._embeddings.device)
+            current = embeddings[known.to(embeddings.device)].to(self._embeddings)
+            self._embeddings[rows] = self.momentum * self._embeddings[rows] + (1.0 - self.momentum) * current
+        if not known.all():
+            first_position: dict[gtypes.Id, int] = {}  # NOTE: keep the first occurrence of duplicate ids
+            for i in (~known).nonzero().squeeze(1).tolist():
+                first_position.setdefault(ids[i], i)
+            new = list(first_position.values())
+            self._insert(embeddings[new], labels[new], list(first_position.keys()))
+
+    def _insert(self, embeddings: torch.Tensor, labels: torch.Tensor, ids: Sequence[gtypes.Id]) -> None:
+        capacity = self.remaining_capacity
+        if capacity is not None:
+            embeddings, labels, ids = embeddings[:capacity], labels[:capacity], ids[:capacity]
+        if len(ids) == 0:
+            return
+        start, end = len(self), len(self) + len(ids)
+        if self._embeddings is None or self._labels is None:
+            self._embeddings, self._labels = embeddings.clone(), labels.clone()
+        else:
+            if end > len(self._embeddings):
+                capacity = max(end, 2 * len(self._embeddings))
+                if self.max_size is not None:
+                    capacity = min(capacity, self.max_size)
+                self._embeddings = torch.cat(
+                    [self._embeddings[:start], self._embeddings.new_empty(capacity - start, embeddings.shape[1])]
+                )
+                self._labels = torch.cat([self._labels[:start], self._labels.new_empty(capacity - start)])
+            self._embeddings[start:end] = embeddings.to(self._embeddings)
+            self._labels[start:end] = labels.to(self._labels)
+        self._index.update((id, start + i) for i, id in enumerate(ids))
+        self.ids.extend(ids)
+
+    def get(self) -> tuple[torch.Tensor, torch.Tensor, list[gtypes.Id]]:
+        """Returns the cached embeddings, labels and ids on the CPU."""
+        embeddings, labels = self.embeddings, self.labels
+        assert embeddings is not None and labels is not None, "Train embedding cache is empty"
+        return embeddings.cpu(), labels.cpu(), list(self.ids)
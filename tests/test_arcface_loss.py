@@ -0,0 +1,71 @@
+from typing import Literal
+
+import pytest
+import torch
+
+from gorillatracker.losses.arcface_loss import ArcFaceLoss
+from gorillatracker.utils.labelencoder import LinearSequenceEncoder
+
+
+def make_loss_inputs(
+    use_focal_loss: bool, purpose: Literal["val", "train"]
+) -> tuple[ArcFaceLoss, torch.Tensor, torch.Tensor, torch.Tensor]:
+    torch.manual_seed(0)
+    loss_module = ArcFaceLoss(
+        embedding_size=8, num_classes=5, k_subcenters=2, use_focal_loss=use_focal_loss, purpose=purpose
+    )
+    embeddings = torch.randn(6, 8)
+    labels = torch.tensor([10, 13, 11, 13, 14, 12])
+    prototypes = torch.randn(5, 8)
+    return loss_module, embeddings, labels, prototypes
+
+
+# NOTE: losses of the previous validation loop (one forward call per embedding) and of a training batch, computed with
+# the ArcFace loss before the batched validation
+PER_ROW_LOOP_LOSSES = {
+    False: [48.2085, 1.4798, 53.5274, 0.0, 7.0734, 5.8205],
+    True: [48.2085, 0.8826, 53.5274, 0.0, 7.0614, 5.786],
+}
+TRAINING_BATCH_LOSSES = {False: 17.6805, True: 17.45}
+
+
+@pytest.mark.parametrize("use_focal_loss", [False, True])
+def test_per_embedding_loss_matches_previous_per_row_loop(use_focal_loss: bool) -> None:
+    loss_module, embeddings, labels, prototypes = make_loss_inputs(use_focal_loss, purpose="val")
+    le = LinearSequenceEncoder()
+    le.encode_list([10, 11, 12, 13, 14])
+    loss_module.update(prototypes, 5, le)
+
+    per_row, _, _ = loss_module(embeddings, labels, reduction="none")
+
+    assert per_row.shape == (6,)
+    torch.testing.assert_close(per_row, torch.tensor(PER_ROW_LOOP_LOSSES[use_focal_loss]), atol=1e-3, rtol=1e-4)
+
+
+@pytest.mark.parametrize("use_focal_loss", [False, True])
+def test_training_loss_is_unchanged(use_focal_loss: bool) -> None:
+    loss_module, embeddings, labels, prototypes = make_loss_inputs(use_focal_loss, purpose="train")
+    with torch.no_grad():
+        loss_module.prototypes.copy_(torch.stack([prototypes, prototypes.flip(0)]))
+
+    loss, _, _ = loss_module(embeddings, labels)
+
+    assert loss.item() == pytest.approx(TRAINING_BATCH_LOSSES[use_focal_loss], abs=1e-3)
+
+
+def test_class_weights_divide_by_class_frequency() -> None:
+    torch.manual_seed(0)
+    class_distribution = {10: 6, 11: 3, 12: 1}
+    loss_module = ArcFaceLoss(
+        embedding_size=8, num_classes=3, class_distribution=class_distribution, use_class_weights=True
+    )
+    embeddings = torch.randn(5, 8)
+    labels = torch.tensor([12, 10, 11, 10, 12])
+
+    weighted, _, _ = loss_module(embeddings, labels, reduction="none")
+    loss_module.use_class_weights = False
+    unweighted, _, _ = loss_module(embeddings, labels, reduction="none")
+
+    frequencies = torch.tensor([class_distribution[label] / 10 for label in labels.tolist()])
+    assert torch.allclose(weighted, unweighted / frequencies)
+    assert loss_module.le.encode_list(labels.tolist()) == [0, 1, 2, 1, 0]
@@ -0,0 +1,29 @@
+import torch
+
+from gorillatracker.transform_utils import BatchAugmentation, BatchPlanckianJitter, PlanckianJitter
+
+
+def test_seeded_batches() -> None:
+    images = torch.randint(0, 256, (4, 3, 64, 64), dtype=torch.uint8)
+    first, second = BatchAugmentation(size=32, seed=3), BatchAugmentation(size=32, seed=3)
+    augmented = first(images)
+    assert augmented.shape == (4, 3, 32, 32) and augmented.dtype == torch.float32
+    assert 0 <= augmented.min() and augmented.max() <= 1
+    assert torch.equal(augmented, second(images))
+    assert not torch.equal(augmented, first(images))  # NOTE: the generator advances
+
+
+def test_geometry_without_randomness() -> None:
+    images = torch.rand(2, 3, 16, 16)
+    fixed = dict(size=16, erase_p=0.0, degrees=0.0, crop_scale=(1.0, 1.0), crop_ratio=(1.0, 1.0), jitter=False)
+    assert torch.allclose(BatchAugmentation(flip_p=0.0, **fixed)(images), images, atol=1e-5)  # type: ignore[arg-type]
+    assert torch.allclose(BatchAugmentation(flip_p=1.0, **fixed)(images), images.flip(-1), atol=1e-5)  # type: ignore[arg-type]
+
+
+def test_batch_planckian_jitter_matches_per_image() -> None:
+    jitter = BatchPlanckianJitter()
+    images = torch.rand(5, 3, 8, 8)
+    generator = torch.Generator().manual_seed(0)
+    idx = torch.randint(0, len(jitter.gains), (5,), generator=generator)
+    expected = torch.stack([PlanckianJitter(idx=int(i))(image) for i, image in zip(idx, images)])  # type: ignore[misc]
+    assert torch.allclose(jitter(images, torch.Generator().manual_seed(0)), expected.float(), atol=1e-5)
@@ -0,0 +1,30 @@
+from collections import Counter
+
+import numpy as np
+
+from gorillatracker.data.batch_sampler import PKBatchSampler
+
+
+def test_pk_batches() -> None:
+    labels = np.repeat(np.arange(10), [12, 8, 6, 5, 4, 3, 3, 2, 2, 1])  # NOTE: label 9 has no positive
+    video_ids = np.arange(len(labels)) % 3 + 3 * labels
+    sampler = PKBatchSampler(labels, p=3, k=4, video_ids=video_ids, seed=1)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == len(labels) // 12
+    for batch in batches:
+        counts = Counter(labels[batch].tolist())
+        assert len(counts) == 3 and set(counts.values()) == {4} and 9 not in counts
+        for label in counts:
+            available = len(np.unique(video_ids[labels == label]))
+            assert len(np.unique(video_ids[batch][labels[batch] == label])) == min(available, 4)
+
+    assert list(PKBatchSampler(labels, p=3, k=4, video_ids=video_ids, seed=1)) == batches
+    sampler.set_epoch(1)
+    assert list(sampler) != batches
+
+
+def test_pk_replicas_split_the_batches() -> None:
+    labels = np.repeat(np.arange(20), 6)
+    single = list(PKBatchSampler(labels, p=4, k=3, seed=0))
+    replicas = [list(PKBatchSampler(labels, p=4, k=3, seed=0, num_replicas=2, rank=rank)) for rank in range(2)]
+    assert replicas[0] == single[0::2] and replicas[1] == single[1::2]
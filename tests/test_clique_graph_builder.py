@@ -0,0 +1,73 @@
+from pathlib import Path
+from typing import Optional
+
+import pytest
+
+from gorillatracker.data.contrastive_sampler import ContrastiveImage
+from gorillatracker.ssl_pipeline.clique_graph_builder import CliqueGraphBuilder
+from gorillatracker.ssl_pipeline.data_structures import IndexedCliqueGraph, MultiLayerCliqueGraph
+from gorillatracker.ssl_pipeline.models import TrackingFrameFeature
+
+BASE_PATH = Path("crops")
+TRACKING_VIDEOS = {0: 0, 1: 1, 2: 0, 3: 1, 5: 2, 6: 3}
+# NOTE: (tff_id, tracking_id, video_id), tracking 5 has no images, tracking 6 is the only one of video 3
+ROWS = [(100 + i, i % 4, TRACKING_VIDEOS[i % 4]) for i in range(16)] + [(200, 6, 3), (201, 6, 3)]
+
+
+def reference_graph(level: str, negatives: list[tuple[int, int]]) -> MultiLayerCliqueGraph[ContrastiveImage]:
+    """The multi-layer clique graph the SSL pipeline used to build, merged and pruned."""
+    images = [
+        ContrastiveImage(str(tff), TrackingFrameFeature.cache_path_of(BASE_PATH, tff), tracking)
+        for tff, tracking, _ in ROWS
+    ]
+    if level == "tracking":
+        parent: IndexedCliqueGraph[int] = IndexedCliqueGraph(list(TRACKING_VIDEOS))
+    else:
+        videos: IndexedCliqueGraph[int] = IndexedCliqueGraph(sorted(set(TRACKING_VIDEOS.values())))
+        for left, right in negatives:
+            videos.partition(left, right)
+        tracking_edges: dict[int, Optional[int]] = dict(TRACKING_VIDEOS)
+        parent = MultiLayerCliqueGraph(list(TRACKING_VIDEOS), videos, tracking_edges)
+    if level == "tracking":
+        for left, right in negatives:
+            parent.partition(left, right)
+    parent_edges: dict[ContrastiveImage, Optional[int]] = {img: img.class_label for img in images}
+    graph = MultiLayerCliqueGraph(images, parent, parent_edges)
+    for children in graph.inverse_parent_edges.values():
+        children_list = list(children)
+        for u, v in zip(children_list, children_list[1:]):
+            graph.merge(u, v)
+    graph.prune_cliques_without_neighbors()
+    return graph
+
+
+@pytest.mark.parametrize(
+    "level,negatives", [("tracking", [(0, 1), (1, 2), (3, 5)]), ("video", [(0, 1), (1, 2), (2, 3)])]
+)
+def test_builder_matches_multi_layer_clique_graph(level: str, negatives: list[tuple[int, int]]) -> None:
+    builder = CliqueGraphBuilder(level)  # type: ignore[arg-type]
+    builder.add_images(ROWS[:8])
+    builder.add_negatives(negatives)
+    builder.add_images(ROWS[8:])
+    sampler = builder.build(BASE_PATH, seed=0)
+    graph = reference_graph(level, negatives)
+
+    assert {image.id for image in sampler} == {image.id for image in graph.vertices}
+    for image in sampler:
+        expected_negatives = {root.class_label for root in graph.get_adjacent_cliques(image)}
+        assert set(sampler.negative_classes(image)) == expected_negatives
+        assert sampler.negative(image).class_label in expected_negatives
+        positive = sampler.positive(image)
+        assert positive.class_label == image.class_label and positive != image
+
+
+def test_builder_prune_eligibility_is_incremental() -> None:
+    builder = CliqueGraphBuilder("tracking")
+    builder.add_negatives([(1, 2)])
+    assert builder.is_prunable(1) and builder.is_prunable(2)
+    builder.add_images([(10, 1, 0)])
+    assert builder.is_prunable(1) and not builder.is_prunable(2)
+    builder.add_images([(11, 2, 0), (12, 2, 0)])
+    assert not builder.is_prunable(1)
+    assert [image.id for image in builder.build(BASE_PATH)] == ["10", "11", "12"]
+    assert builder.build(BASE_PATH)[0].image_path == BASE_PATH / "10" / "10" / "10.png"
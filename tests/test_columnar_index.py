@@ -0,0 +1,36 @@
+import random
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from gorillatracker.data.columnar_index import GroupedIndex, MultiSpeciesIndex
+
+
+def test_grouped_index_draws() -> None:
+    index = GroupedIndex(np.array([5, 3, 5, 5, 3, 9]))
+    assert index.keys.tolist() == [3, 5, 9]
+    assert index.rows(1).tolist() == [0, 2, 3]
+    rng = random.Random(0)
+    assert {index.draw_other(2, rng) for _ in range(100)} == {0, 3}
+    assert index.draw_other(5, rng) == 5
+
+
+def test_multispecies_index() -> None:
+    labels = np.array([0, 0, 1, 1, 2, 3, 3, 0])
+    species = ["a", "a", "a", "a", "a", "b", "b", "b"]  # NOTE: label 0 occurs in both species
+    index = MultiSpeciesIndex(labels, species)
+    rng = random.Random(0)
+
+    assert {index.positive(0, rng) for _ in range(100)} == {1, 7}
+    assert {index.negative(0, rng) for _ in range(100)} == {2, 3, 4}
+    assert {index.negative(7, rng) for _ in range(100)} == {5, 6}
+    assert sorted(index.negative_labels(5)) == [0]
+    assert np.allclose(index.anchor_weights(), 1 / 8)
+
+    balanced = MultiSpeciesIndex(labels, species, species_weights={"a": 1.0, "b": 3.0}, class_balanced=True)
+    weights = balanced.anchor_weights()
+    assert weights.sum() == pytest.approx(1.0)
+    assert weights[4] == pytest.approx(0.25 / 3) and weights[7] == pytest.approx(0.75 / 2)
+    counts = Counter(balanced.anchor(rng) for _ in range(20_000))
+    assert counts[7] / 20_000 == pytest.approx(weights[7], abs=0.02)
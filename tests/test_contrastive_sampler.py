@@ -0,0 +1,82 @@
+import pickle
+import random
+from pathlib import Path
+
+import pytest
+
+from gorillatracker.data.contrastive_sampler import (
+    ContrastiveClassSampler,
+    ContrastiveImage,
+    SupervisedCrossEncounterSampler,
+    SupervisedHardCrossEncounterSampler,
+    get_individual_video_id,
+    sampler_rng,
+)
+
+
+def make_classes() -> dict[int, list[ContrastiveImage]]:
+    ids = {
+        0: ["A_R1_20240101_0.png", "A_R2_20240101_1.png", "A_R1_20240101_2.png", "A_R3_20240102_3.png"],
+        1: ["B_R1_20240101_0.png", "B_R1_20240101_1.png"],
+        2: ["C_R1_20240101_0.png"],
+    }
+    return {label: [ContrastiveImage(id, Path(id), label) for id in class_ids] for label, class_ids in ids.items()}
+
+
+def test_draws_are_valid_and_seeded() -> None:
+    classes = make_classes()
+    sampler = ContrastiveClassSampler(classes, seed=0)
+    assert sampler.class_labels == [0, 1, 2]
+    for sample in sampler:
+        assert sampler.negative_classes(sample) == [c for c in (0, 1, 2) if c != sample.class_label]
+        for _ in range(20):
+            positive, negative = sampler.positive(sample), sampler.negative(sample)
+            assert positive.class_label == sample.class_label and negative.class_label != sample.class_label
+            assert positive != sample or len(classes[sample.class_label]) == 1
+
+    anchor = classes[0][0]
+    first, second = ContrastiveClassSampler(classes, seed=1), ContrastiveClassSampler(classes, seed=1)
+    draws = [(first.positive(anchor), first.negative(anchor)) for _ in range(10)]
+    assert draws == [(second.positive(anchor), second.negative(anchor)) for _ in range(10)]
+    assert {p for p, _ in draws} == set(classes[0][1:])  # NOTE: all other samples of the class are reachable
+
+
+def test_cross_encounter_positives() -> None:
+    classes = make_classes()
+    sampler = SupervisedCrossEncounterSampler(classes, seed=0)
+    anchor = classes[0][0]
+    positives = {sampler.positive(anchor) for _ in range(100)}
+    assert positives == {classes[0][1], classes[0][3]}  # NOTE: classes[0][2] is from the same video
+    assert {sampler.positive(classes[1][0]) for _ in range(10)} == {classes[1][1]}  # NOTE: single video class
+
+    hard = SupervisedHardCrossEncounterSampler(classes, seed=0)
+    assert hard.class_labels == [0] and len(hard) == 4
+    for sample in hard:
+        assert get_individual_video_id(hard.positive(sample).id) != get_individual_video_id(sample.id)
+
+
+def test_lookup_index() -> None:
+    classes = make_classes()
+    sampler = ContrastiveClassSampler(classes)
+    assert sampler.indices_of([s.id for s in reversed(sampler.samples)]).tolist() == list(reversed(range(len(sampler))))
+    assert sampler.first_indices([2, 0]).tolist() == [6, 0]
+    assert sampler.find_any_images([1, 2]) == {1: classes[1][0], 2: classes[2][0]}
+    with pytest.raises(ValueError):
+        sampler.find_any_image(3)
+
+    new = ContrastiveImage("D_R1_20240101_0.png", Path("D_R1_20240101_0.png"), 3)
+    sampler.samples.append(new)  # NOTE: a mutation the lookup index picks up without explicit invalidation
+    assert sampler.find_any_image(3) == new and sampler.index_of(new.id) == 7
+
+
+def test_unseeded_sampler_rng_follows_the_random_module() -> None:
+    rng = sampler_rng()
+    random.seed(3)
+    draws = [rng.randrange(100) for _ in range(5)] + [rng.choice("abcdef"), rng.random()]
+    random.seed(3)
+    assert [random.randrange(100) for _ in range(5)] + [random.choice("abcdef"), random.random()] == draws
+
+    random.seed(4)  # NOTE: like a reseeded DataLoader worker with a copy of the sampler
+    worker_draws = [pickle.loads(pickle.dumps(rng)).randrange(100) for _ in range(5)]
+    random.seed(4)
+    assert worker_draws == [random.randrange(100) for _ in range(5)]
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+import torch
+
+from gorillatracker.utils.embedding_accumulator import EMBEDDINGS_TABLE_COLUMNS, EmbeddingAccumulator
+
+
+def test_accumulator_matches_prepended_dataframe() -> None:
+    accumulator = EmbeddingAccumulator(embedding_size=4, dataset_names=["a", "b"], initial_capacity=3)
+    expected = pd.DataFrame(columns=EMBEDDINGS_TABLE_COLUMNS)
+    generator = torch.Generator().manual_seed(0)
+    for batch_idx in range(5):
+        ids = [f"ID{batch_idx}_R001_20220101_{i}.png" for i in range(batch_idx + 1)]
+        embeddings = torch.randn(len(ids), 4, generator=generator)
+        labels = torch.arange(len(ids)) + batch_idx
+        accumulator.add(ids, embeddings, labels, dataloader_idx=1)
+        # NOTE: the previous implementation prepended every batch with pd.concat
+        batch_df = pd.DataFrame(
+            {
+                "label": labels.tolist(),
+                "embedding": [e.numpy() for e in embeddings],
+                "id": ids,
+                "partition": "val",
+                "dataset": "b",
+            }
+        )
+        expected = pd.concat([batch_df, expected], ignore_index=True)
+
+    assert len(accumulator) == 15 and accumulator.capacity >= 15
+    actual = accumulator.to_dataframe()
+    assert list(actual.columns) == EMBEDDINGS_TABLE_COLUMNS
+    assert actual["label"].tolist() == expected["label"].tolist()
+    assert actual["id"].tolist() == expected["id"].tolist()
+    assert (actual["partition"] == "val").all() and (actual["dataset"] == "b").all()
+    assert np.array_equal(np.stack(actual["embedding"]), np.stack(expected["embedding"]))
+
+    accumulator.reset()
+    assert len(accumulator) == 0 and len(accumulator.to_dataframe()) == 0
+    assert accumulator.all_gather() is accumulator  # not running distributed
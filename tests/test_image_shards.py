@@ -0,0 +1,46 @@
+import pickle
+from pathlib import Path
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+from gorillatracker.data.nlet import ShardedSupervisedDataset, SupervisedDataset, build_onelet
+from gorillatracker.data.shards import ImageShard, load_padded_image
+from gorillatracker.scripts.build_image_shards import build_image_shards
+
+
+def write_images(data_dir: Path) -> None:
+    rng = np.random.default_rng(0)
+    for partition in ("train", "val"):
+        (data_dir / partition).mkdir(parents=True)
+        for individual in ("AB01", "CD02", "EF03"):
+            for i, (width, height) in enumerate([(20, 12), (9, 17), (16, 16)]):
+                pixels = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+                Image.fromarray(pixels).save(data_dir / partition / f"{individual}_R00{i}_20220101_{i}.png")
+
+
+def test_shards_match_per_file_loading(tmp_path: Path) -> None:
+    write_images(tmp_path / "files")
+    build_image_shards(tmp_path / "files", tmp_path / "shards", image_size=16)
+
+    shard = ImageShard(tmp_path / "shards" / "train")
+    assert len(shard) == 9 and shard.images.shape == (9, 16, 16, 3)
+    for row, id in enumerate(shard.ids):
+        assert np.array_equal(shard.array(row), load_padded_image(Path(id), 16))
+    assert pickle.loads(pickle.dumps(shard))._images is None  # NOTE: workers reopen the memory map
+
+    transform = transforms.Resize((16, 16), antialias=True)
+    per_file = SupervisedDataset(tmp_path / "files", build_onelet, "val", transform)
+    sharded = ShardedSupervisedDataset(tmp_path / "shards", build_onelet, "val", transform)
+    assert sharded.num_classes == per_file.num_classes
+    assert sharded.class_distribution == per_file.class_distribution
+
+    per_file_items = {per_file[i][0]: per_file[i] for i in range(len(per_file))}
+    for i in range(len(sharded)):
+        ids, values, labels = sharded[i]
+        expected_ids, expected_values, expected_labels = per_file_items[ids]
+        assert labels == expected_labels and values[0].dtype == torch.float32
+        # NOTE: shards are resized before the uint8 quantization, the per-file path after, within one intensity step
+        assert torch.allclose(values[0], expected_values[0], atol=1.5 / 255)
@@ -0,0 +1,72 @@
+from pathlib import Path
+
+import pytest
+import torch
+from torch import nn
+
+from gorillatracker.utils.l2sp_regularisation import L2_SP
+
+
+def make_model() -> nn.Sequential:
+    return nn.Sequential(nn.Linear(4, 8), nn.BatchNorm1d(8), nn.Linear(8, 3))
+
+
+def make_l2sp(tmp_path: Path, model: nn.Sequential, exclude: tuple[str, ...] = ()) -> L2_SP:
+    pretrained = make_model()
+    del pretrained[2]  # NOTE: the last linear layer is new and decays towards 0
+    path = tmp_path / "pretrained_weights" / "model.pt"
+    path.parent.mkdir()
+    torch.save(pretrained.state_dict(), path)
+    return L2_SP(model, str(path), alpha=0.1, beta=0.01, exclude=exclude)
+
+
+def reference_penalty(model: nn.Module, l2sp: L2_SP) -> torch.Tensor:
+    state = model.state_dict(keep_vars=True)
+    references = l2sp.reference_views(l2sp.reference.device)
+    towards_pretrained = sum(
+        (state[key] - reference).pow(2).sum() * 0.5 for key, reference in zip(l2sp.pretrained_keys, references)
+    )
+    towards_0 = sum(state[key].pow(2).sum() * 0.5 for key in l2sp.new_keys)
+    return towards_pretrained * l2sp.alpha + towards_0 * l2sp.beta
+
+
+def test_l2sp_matches_per_key_penalty(tmp_path: Path) -> None:
+    model = make_model()
+    l2sp = make_l2sp(tmp_path, model)
+    assert l2sp.pretrained_keys == ["0.weight"] and l2sp.new_keys == ["2.weight"]
+
+    penalty = l2sp(model)
+    expected = reference_penalty(model, l2sp)
+    torch.testing.assert_close(penalty, expected)
+
+    penalty.backward()
+    gradients = [param.grad.clone() for param in model.parameters() if param.grad is not None]
+    model.zero_grad()
+    expected.backward()  # type: ignore
+    torch.testing.assert_close(gradients, [param.grad for param in model.parameters() if param.grad is not None])
+
+
+def test_l2sp_exclude_patterns(tmp_path: Path) -> None:
+    model = make_model()
+    l2sp = make_l2sp(tmp_path, model, exclude=(r"^2\.",))
+    assert l2sp.pretrained_keys == ["0.weight"] and l2sp.new_keys == []
+
+
+def test_l2sp_follows_parameter_updates_and_loads_legacy_buffers(tmp_path: Path) -> None:
+    model = make_model()
+    l2sp = make_l2sp(tmp_path, model)
+    with torch.no_grad():
+        model.get_parameter("0.weight").add_(1.0)
+    torch.testing.assert_close(l2sp(model), reference_penalty(model, l2sp))
+
+    legacy_state = {"0_weight": model.get_parameter("0.weight").detach().clone()}
+    l2sp.load_state_dict(legacy_state)
+    torch.testing.assert_close(l2sp(model), model.get_parameter("2.weight").pow(2).sum() * 0.5 * 0.01)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="needs a GPU")
+def test_l2sp_reference_on_model_device(tmp_path: Path) -> None:
+    model = make_model().cuda()
+    l2sp = make_l2sp(tmp_path, model)
+    l2sp(model)
+    assert l2sp.reference.is_cuda
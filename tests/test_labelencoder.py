@@ -0,0 +1,53 @@
+import torch
+
+from gorillatracker.utils.labelencoder import LinearSequenceEncoder, TensorLabelEncoder
+
+
+def test_tensor_encoder_matches_linear_sequence_encoder() -> None:
+    batches = [[7, 3, 7, 12], [3, 12, 7], [0, 12, 40, 0], [40, 7]]
+    reference = LinearSequenceEncoder()
+    encoder = TensorLabelEncoder()
+    for batch in batches:
+        codes = encoder.encode_tensor(torch.tensor(batch))
+        assert codes.tolist() == reference.encode_list(batch)
+        assert encoder.decode_tensor(codes).tolist() == batch
+    assert encoder.mapping == reference.mapping
+    assert encoder.decode_list([0, 3, 1]) == reference.decode_list([0, 3, 1]) == [7, 0, 3]
+
+
+def test_tensor_encoder_rebuilds_lookups_only_for_new_labels() -> None:
+    encoder = TensorLabelEncoder()
+    encoder.encode_tensor(torch.tensor([5, 2]))
+    forward_lookup = encoder.forward_lookup
+    encoder.encode_tensor(torch.tensor([2, 2, 5]))
+    assert encoder.forward_lookup is forward_lookup
+
+    encoder.encode_list([9])  # NOTE: e.g. by mixup, the lookups have to pick this up
+    assert encoder.encode_tensor(torch.tensor([9, 11])).tolist() == [2, 3]
+    assert encoder.forward_lookup is not forward_lookup
+
+
+def test_from_encoder_keeps_codes() -> None:
+    reference = LinearSequenceEncoder()
+    reference.encode_list([4, 1, 8])
+    encoder = TensorLabelEncoder.from_encoder(reference)
+    assert encoder.encode_tensor(torch.tensor([8, 4, 1])).tolist() == [2, 0, 1]
+    assert TensorLabelEncoder.from_encoder(encoder) is encoder
+
+
+def test_sparse_labels_are_looked_up_sorted() -> None:
+    batches = [[10**9, 5, 10**9 + 7], [5, 3 * 10**8, 10**9]]
+    reference = LinearSequenceEncoder()
+    encoder = TensorLabelEncoder()
+    for batch in batches:
+        codes = encoder.encode_tensor(torch.tensor(batch))
+        assert codes.tolist() == reference.encode_list(batch)
+        assert encoder.decode_tensor(codes).tolist() == batch
+    assert encoder.forward_lookup is None and len(encoder.sorted_labels) == 4
+
+
+def test_full_encoder_skips_the_unseen_label_check() -> None:
+    encoder = TensorLabelEncoder(capacity=2)
+    encoder.encode_tensor(torch.tensor([3, 8]))
+    assert encoder.encode_tensor(torch.tensor([8, 5, 3])).tolist() == [1, -1, 0]
+    assert encoder.mapping == {3: 0, 8: 1}
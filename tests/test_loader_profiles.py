@@ -0,0 +1,30 @@
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from gorillatracker.data.loader_profiles import autotune_loader_profile, get_loader_profile, worker_init_fn
+
+
+def test_profile_kwargs() -> None:
+    assert get_loader_profile("default").dataloader_kwargs(4) == {
+        "num_workers": 4,
+        "pin_memory": False,
+        "persistent_workers": False,
+        "prefetch_factor": None,
+    }
+    assert get_loader_profile("debug").dataloader_kwargs(4) == {"num_workers": 0, "pin_memory": False}
+    low_memory = get_loader_profile("low-memory").dataloader_kwargs(8)
+    assert low_memory["num_workers"] == 2 and low_memory["prefetch_factor"] == 1
+    assert low_memory["worker_init_fn"] is worker_init_fn
+
+
+def test_autotune_picks_a_measured_candidate() -> None:
+    dataset = TensorDataset(torch.arange(64))
+    tuned = autotune_loader_profile(
+        get_loader_profile("throughput"),
+        lambda kwargs: DataLoader(dataset, batch_size=4, **kwargs),
+        max_workers=1,
+        prefetch_factors=(2,),
+        warmup_batches=3,
+    )
+    assert not tuned.autotune and tuned.workers in (0, 1) and tuned.persistent_workers
+    assert tuned.dataloader_kwargs(8)["num_workers"] == tuned.workers
@@ -0,0 +1,248 @@
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+
+from gorillatracker.data.contrastive_sampler import (
+    ContrastiveClassSampler,
+    ContrastiveImage,
+    ContrastiveKFoldValSampler,
+)
+from gorillatracker.metrics import NeighborCache, knn, knn_classification_matrix, knn_kfold_val, knn_ssl
+from gorillatracker.utils.knn import blocked_topk, get_neighbor_backend, pairwise_distances
+from gorillatracker.utils.labelencoder import LinearSequenceEncoder
+
+
+def make_embeddings_table(n_individuals: int = 6, n_videos: int = 3, n_images: int = 4, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    rows = []
+    for individual in range(n_individuals):
+        center = rng.normal(size=8)
+        for video in range(n_videos):
+            for image in range(n_images):
+                partition = "train" if image == 0 else "val"
+                rows.append(
+                    {
+                        "label": individual,
+                        "embedding": (center + rng.normal(scale=0.8, size=8)).astype(np.float32),
+                        "id": f"/data/ID{individual}_R00{video}_2022010{video}_{image}.png",
+                        "partition": partition,
+                        "dataset": "test",
+                    }
+                )
+    data = pd.DataFrame(rows)
+    data["encoded_label"] = LinearSequenceEncoder().encode_list(data["label"].tolist())
+    return data
+
+
+KNN_VARIANTS: list[dict[str, Any]] = [
+    dict(k=1),
+    dict(k=5),
+    dict(k=5, average="macro"),
+    dict(k=1, use_filter=True),
+    dict(k=5, distance_metric="cosine"),
+    dict(k=1, use_train_embeddings=True),
+    dict(k=5, use_train_embeddings=True, distance_metric="cosine"),
+    dict(k=1, use_crossvideo_positives=True),
+    dict(k=5, use_crossvideo_positives=True, distance_metric="cosine"),
+    dict(k=5, use_crossvideo_positives=True, use_train_embeddings=True),
+]
+
+
+@pytest.mark.parametrize("crossvideo", [False, True])
+def test_knn_shared_cache_matches_uncached(crossvideo: bool) -> None:
+    data = make_embeddings_table()
+    cache = NeighborCache(k_max=5, crossvideo=crossvideo)
+    for kwargs in KNN_VARIANTS:
+        uncached = knn(data, **kwargs)
+        cached = knn(data, cache=cache, **kwargs)
+        assert cached == pytest.approx(uncached), kwargs
+
+
+def test_neighbor_cache_slices_sorted_neighbors() -> None:
+    data = make_embeddings_table()
+    cache = NeighborCache(k_max=5)
+    distances_5, indices_5 = cache.neighbors(data, 5)
+    distances_1, indices_1 = cache.neighbors(data, 1)
+    assert torch.equal(indices_1, indices_5[:, :1])
+    assert torch.all(distances_5[:, :-1] <= distances_5[:, 1:])
+    # self is never a neighbor
+    assert not torch.any(indices_5 == torch.arange(len(indices_5)).unsqueeze(1))
+
+
+@pytest.mark.parametrize("distance_metric", ["euclidean", "cosine"])
+@pytest.mark.parametrize("block_sizes", [(1, 1), (7, 5), (64, 64)])
+def test_blocked_topk_matches_full_distance_matrix(distance_metric: str, block_sizes: tuple[int, int]) -> None:
+    embeddings = torch.randn(50, 16, generator=torch.Generator().manual_seed(0))
+    allowed = torch.rand(50, 50, generator=torch.Generator().manual_seed(1)) > 0.3
+
+    distances = pairwise_distances(embeddings, embeddings, distance_metric)  # type: ignore
+    distances.fill_diagonal_(float("inf"))
+    distances[~allowed] = float("inf")
+    expected_distances, expected_indices = torch.topk(distances, 5, largest=False, sorted=True)
+
+    query_block_size, gallery_block_size = block_sizes
+    actual_distances, actual_indices = blocked_topk(
+        embeddings,
+        embeddings,
+        5,
+        distance_metric=distance_metric,  # type: ignore
+        mask_fn=lambda q, g: allowed[q.unsqueeze(1), g.unsqueeze(0)],
+        exclude_self=True,
+        query_block_size=query_block_size,
+        gallery_block_size=gallery_block_size,
+    )
+    assert torch.allclose(actual_distances, expected_distances)
+    assert torch.equal(actual_indices, expected_indices)
+
+
+def reference_legacy_classification_matrix(
+    closest_labels: torch.Tensor, closest_indices: torch.Tensor, num_classes: int
+) -> torch.Tensor:
+    # NOTE: copy of the original per-row implementation in metrics.knn
+    n, k = closest_labels.shape
+    classification_matrix = torch.zeros((n, num_classes))
+    for i in range(num_classes):
+        classification_matrix[:, i] = torch.sum(closest_labels == i, dim=1) / k
+    for i in range(n):
+        max_prob = torch.max(classification_matrix[i])
+        max_prob_indices = torch.where(max_prob - classification_matrix[i] < 1e-6)[0]
+        if len(max_prob_indices) == 1:
+            continue
+        classification_matrix[i, max_prob_indices] += (1e-6) / len(max_prob_indices)
+        for j in range(k):
+            if closest_indices[i][j] in max_prob_indices:
+                classification_matrix[i][closest_labels[i][j].to(torch.int)] += 1e-6
+                break
+    return classification_matrix
+
+
+def test_knn_classification_matrix_legacy_matches_reference() -> None:
+    generator = torch.Generator().manual_seed(0)
+    closest_indices = torch.randint(0, 20, (200, 4), generator=generator)
+    closest_labels = torch.randint(0, 6, (200, 4), generator=generator)
+    closest_distances = torch.rand(200, 4, generator=generator).sort(dim=1).values
+    expected = reference_legacy_classification_matrix(closest_labels, closest_indices, 6)
+    actual = knn_classification_matrix(closest_labels, closest_distances, 6, closest_indices=closest_indices)
+    assert torch.allclose(actual, expected, atol=0, rtol=0)
+
+
+def test_knn_classification_matrix_tie_policies() -> None:
+    # two votes each for class 0 and 1, class 1 is the nearest, class 0 the closest in sum
+    closest_labels = torch.tensor([[1, 0, 0, 1], [2, 2, 2, 3]])
+    closest_distances = torch.tensor([[0.5, 0.6, 0.7, 10.0], [0.1, 0.2, 0.3, 0.4]])
+
+    nearest = knn_classification_matrix(closest_labels, closest_distances, 4, tie_policy="nearest")
+    assert nearest.argmax(dim=1).tolist() == [1, 2]
+    distance = knn_classification_matrix(closest_labels, closest_distances, 4, tie_policy="distance")
+    assert distance.argmax(dim=1).tolist() == [0, 2]
+    random_a = knn_classification_matrix(closest_labels, closest_distances, 4, tie_policy="random", seed=3)
+    random_b = knn_classification_matrix(closest_labels, closest_distances, 4, tie_policy="random", seed=3)
+    assert torch.equal(random_a, random_b)
+    assert random_a.argmax(dim=1)[0].item() in (0, 1)
+    # no tie: plain vote fractions
+    assert torch.equal(nearest[1], torch.tensor([0.0, 0.0, 0.75, 0.25]))
+
+
+@pytest.mark.parametrize("backend_name", ["brute-force", "faiss-hnsw"])
+def test_neighbor_backends_match_block_engine(backend_name: str) -> None:
+    if backend_name.startswith("faiss"):
+        pytest.importorskip("faiss")
+    embeddings = torch.randn(300, 16, generator=torch.Generator().manual_seed(0))
+    codes = torch.randint(0, 30, (300,), generator=torch.Generator().manual_seed(1))
+
+    def mask_fn(q: torch.Tensor, g: torch.Tensor) -> torch.Tensor:
+        return codes[q].unsqueeze(1) != codes[g].unsqueeze(0)
+
+    expected = get_neighbor_backend("block").search(embeddings, embeddings, 5, "cosine", [None, mask_fn], True)
+    actual = get_neighbor_backend(backend_name).search(embeddings, embeddings, 5, "cosine", [None, mask_fn], True)
+    for (actual_distances, actual_indices), (expected_distances, expected_indices) in zip(actual, expected):
+        assert torch.allclose(actual_distances, expected_distances, atol=1e-5)
+        assert torch.equal(actual_indices, expected_indices)
+
+
+class RingSampler(ContrastiveClassSampler):
+    """Every third class has no negatives, the others only see their two successors."""
+
+    def negative_classes(self, sample: ContrastiveImage) -> list[int]:
+        label = int(sample.class_label)
+        return [] if label % 3 == 0 else [(label + 1) % 9, (label + 2) % 9]
+
+
+def test_knn_ssl_matches_per_label_search() -> None:
+    data = make_embeddings_table(n_individuals=9, n_videos=2, n_images=3, seed=4)
+    classes: dict[int, list[ContrastiveImage]] = {}
+    for id, label in zip(data["id"], data["label"]):
+        classes.setdefault(int(label), []).append(ContrastiveImage(id, Path(id), int(label)))
+    sampler = RingSampler(classes)
+    dm: Any = SimpleNamespace(val=[SimpleNamespace(contrastive_sampler=sampler)])
+    k = 3
+
+    val = data[data["partition"] == "val"]
+    embeddings = torch.tensor(np.stack(val["embedding"]))
+    labels = torch.tensor(val["label"].to_numpy())
+    distances = pairwise_distances(embeddings, embeddings, "euclidean")
+    true_labels, pred_labels, top5_hits = [], [], []
+    for label in range(9):
+        allowed = torch.isin(labels, torch.tensor([label, *sampler.negative_classes(classes[label][0])]))
+        if label % 3 == 0 or allowed.sum() <= k:
+            continue
+        for row in (labels == label).nonzero().squeeze(1).tolist():
+            candidates = allowed.clone()
+            candidates[row] = False
+            row_distances = distances[row].masked_fill(~candidates, float("inf"))
+            neighbor_labels = labels[row_distances.topk(k, largest=False).indices]
+            true_labels.append(label)
+            pred_labels.append(torch.mode(neighbor_labels).values.item())
+            top5_hits.append(label in neighbor_labels.tolist())
+
+    metrics = knn_ssl(data, dm, k=k)
+    assert metrics["accuracy"] == pytest.approx(np.mean(np.array(true_labels) == np.array(pred_labels)))
+    assert metrics["accuracy_top5"] == pytest.approx(np.mean(top5_hits))
+
+
+@pytest.mark.filterwarnings("ignore:No positive samples in targets")  # train-only classes of the other folds
+@pytest.mark.parametrize("variant", KNN_VARIANTS)
+def test_knn_kfold_val_matches_knn_per_fold(variant: dict[str, Any]) -> None:
+    data = make_embeddings_table(n_individuals=9, n_videos=3, n_images=3, seed=5)
+    val_data = data[data["partition"] == "val"]
+    classes: dict[int, list[ContrastiveImage]] = {}
+    for id, label in zip(val_data["id"], val_data["label"]):
+        classes.setdefault(int(label), []).append(
+            ContrastiveImage(id, Path(f"/folds/fold-{label % 3}") / Path(id).name, label)
+        )
+    dm: Any = SimpleNamespace(val=[SimpleNamespace(contrastive_sampler=ContrastiveKFoldValSampler(classes, k=3))])
+
+    metrics = knn_kfold_val(data, dm, current_val_index=0, cache=NeighborCache(crossvideo=True), **variant)
+
+    for fold in range(3):
+        # NOTE: every fold is only searched by its own val embeddings
+        fold_data = val_data[val_data["label"] % 3 == fold].reset_index(drop=True)
+        fold_data["encoded_label"] = LinearSequenceEncoder().encode_list(fold_data["label"].tolist())
+        fold_variant = {key: value for key, value in variant.items() if key != "use_train_embeddings"}
+        for metric_name, value in knn(fold_data, **fold_variant).items():
+            assert metrics[f"val-fold-{fold}/{metric_name}"] == pytest.approx(value)
+    assert metrics["accuracy"] == pytest.approx(np.mean([metrics[f"val-fold-{fold}/accuracy"] for fold in range(3)]))
+
+
+def test_knn_kfold_val_with_fewer_val_rows_than_k() -> None:
+    # NOTE: one val image per individual, 3 per fold, so k=5 neighbors run past the end of every fold
+    data = make_embeddings_table(n_individuals=9, n_videos=1, n_images=2, seed=3)
+    val_data = data[data["partition"] == "val"]
+    classes = {
+        int(label): [ContrastiveImage(id, Path(f"/folds/fold-{label % 3}") / Path(id).name, label)]
+        for id, label in zip(val_data["id"], val_data["label"])
+    }
+    dm: Any = SimpleNamespace(val=[SimpleNamespace(contrastive_sampler=ContrastiveKFoldValSampler(classes, k=3))])
+
+    metrics = knn_kfold_val(data, dm, current_val_index=0, k=5)
+
+    for fold in range(3):
+        fold_data = val_data[val_data["label"] % 3 == fold].reset_index(drop=True)
+        fold_data["encoded_label"] = LinearSequenceEncoder().encode_list(fold_data["label"].tolist())
+        for metric_name, value in knn(fold_data, k=5).items():
+            assert metrics[f"val-fold-{fold}/{metric_name}"] == pytest.approx(value)
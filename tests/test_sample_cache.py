@@ -0,0 +1,69 @@
+import pickle
+from pathlib import Path
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+from gorillatracker.data.nlet import SupervisedDataset, build_onelet
+from gorillatracker.data.sample_cache import SampleCache, SampleCacheConfig, create_sample_cache, transform_fingerprint
+
+
+def make_nlet(idx: int) -> tuple[tuple[str], tuple[torch.Tensor], tuple[int]]:
+    return (f"img_{idx}.png",), (torch.full((1, 16, 16), float(idx)),), (idx,)  # 1 KiB of values
+
+
+def test_memory_level_is_byte_bounded_lru() -> None:
+    cache = SampleCache(SampleCacheConfig(max_memory_mb=3 / 1024), namespace="lru")  # room for 3 nlets
+    for idx in range(4):
+        cache.get_or_compute(idx, lambda: make_nlet(idx))
+    cache.get_or_compute(1, lambda: make_nlet(-1))  # hit, 1 is now the most recently used
+    cache.get_or_compute(4, lambda: make_nlet(4))  # evicts 2
+
+    stats = cache.stats()
+    assert (stats.memory_hits, stats.misses, stats.evictions) == (1, 5, 2)
+    assert stats.memory_items == 3 and stats.memory_bytes == 3 * 1024
+    assert cache.get_or_compute(1, lambda: make_nlet(-1))[2] == (1,)
+    assert cache.get_or_compute(2, lambda: make_nlet(-2))[2] == (-2,)  # recomputed after eviction
+
+
+def test_store_is_visible_to_workers(tmp_path: Path) -> None:
+    for config in (
+        SampleCacheConfig(max_memory_mb=1, store="shared"),
+        SampleCacheConfig(max_memory_mb=1, store="disk", disk_dir=tmp_path),
+    ):
+        cache = SampleCache(config, namespace="val")
+        cache.get_or_compute(7, lambda: make_nlet(7))
+
+        worker_cache = pickle.loads(pickle.dumps(cache))  # NOTE: like a spawned DataLoader worker
+        ids, values, labels = worker_cache.get_or_compute(7, lambda: make_nlet(-1))
+        assert ids == ("img_7.png",) and labels == (7,) and torch.equal(values[0], make_nlet(7)[1][0])
+        assert worker_cache.stats().store_hits == 1 and worker_cache.stats().store_bytes > 1024
+        assert cache.store is not None and len(list(cache.store.root.glob("*.pt"))) == 1
+
+
+def test_store_budget_and_train_partition(tmp_path: Path) -> None:
+    # NOTE: a stored nlet takes a bit more than 2 KiB on disk, storing stops once 5 KiB are used
+    config = SampleCacheConfig(max_memory_mb=0, store="disk", store_max_mb=5 / 1024, disk_dir=tmp_path)
+    cache = create_sample_cache(config, "val", "dataset")
+    assert cache is not None
+    for idx in range(4):
+        cache.get_or_compute(idx, lambda: make_nlet(idx))
+    assert cache.store is not None and sorted(p.name for p in cache.store.root.glob("*.pt")) == ["0.pt", "1.pt"]
+    assert create_sample_cache(config, "train", "dataset") is None
+
+
+def test_store_namespace_depends_on_transform(tmp_path: Path) -> None:
+    (tmp_path / "data" / "val").mkdir(parents=True)
+    Image.fromarray(np.zeros((8, 8, 3), dtype=np.uint8)).save(tmp_path / "data" / "val" / "AB01_R000_20220101_0.png")
+    config = SampleCacheConfig(store="disk", disk_dir=tmp_path / "cache")
+
+    def store_root(transform: transforms.Resize) -> Path:
+        dataset = SupervisedDataset(tmp_path / "data", build_onelet, "val", transform, sample_cache_config=config)
+        assert dataset.sample_cache is not None and dataset.sample_cache.store is not None
+        return dataset.sample_cache.store.root
+
+    assert store_root(transforms.Resize((8, 8))) == store_root(transforms.Resize((8, 8)))
+    assert store_root(transforms.Resize((8, 8))) != store_root(transforms.Resize((4, 4)))
+    assert transform_fingerprint(lambda x: x) == transform_fingerprint(lambda x: x)  # NOTE: no memory addresses
@@ -1,6 +1,10 @@
+from typing import cast
+
 import pytest
 
 from gorillatracker.ssl_pipeline.data_structures import (
+    ArrayCliqueGraph,
+    ArrayUnionFind,
     CliqueGraph,
     IndexedCliqueGraph,
     MultiLayerCliqueGraph,
@@ -8,14 +12,14 @@ from gorillatracker.ssl_pipeline.data_structures import (
 )
 
 
-@pytest.fixture
-def setup_union_find() -> UnionFind[int]:
-    return UnionFind(list(range(10)))
+@pytest.fixture(params=[UnionFind, ArrayUnionFind])
+def setup_union_find(request: pytest.FixtureRequest) -> UnionFind[int]:
+    return request.param(list(range(10)))
 
 
-@pytest.fixture
-def setup_clique_graph() -> CliqueGraph[int]:
-    clique_graph = CliqueGraph(list(range(5)))
+@pytest.fixture(params=[CliqueGraph, ArrayCliqueGraph])
+def setup_clique_graph(request: pytest.FixtureRequest) -> CliqueGraph[int]:
+    clique_graph = request.param(list(range(5)))
     clique_graph.merge(0, 1)
     clique_graph.merge(1, 2)
     clique_graph.partition(2, 3)
@@ -69,6 +73,42 @@ def test_clique_graph_group_relationship(setup_clique_graph: CliqueGraph[int]) -
     assert set(c_graph.get_clique(4)) == {4}, "CliqueGraph group relationship check failed."
 
 
+def test_array_union_find_members_and_delete() -> None:
+    uf: ArrayUnionFind[str] = ArrayUnionFind(list("abcdef"))
+    uf.union("a", "b")
+    uf.union("c", "d")
+    root = uf.union("b", "d")
+    assert uf.find("a") == uf.find("c") == root
+    assert sorted(uf.get_members("c")) == ["a", "b", "c", "d"]
+    assert uf.get_members("e") == ["e"]
+    uf.delete_set(root)
+    with pytest.raises(KeyError):
+        uf.find("a")
+    assert uf.find("f") == "f"
+
+
+def test_array_union_find_identity_vertices() -> None:
+    uf: ArrayUnionFind[int] = ArrayUnionFind(range(1_000))
+    assert uf.index is None
+    for i in range(999):
+        uf.union(i, i + 1)
+    assert uf.find(0) == uf.find(999)
+    assert sorted(uf.get_members(500)) == list(range(1_000))
+    with pytest.raises(KeyError):
+        uf.find(1_000)
+
+
+def test_array_clique_graph_random_clique_member() -> None:
+    graph: ArrayCliqueGraph[int] = ArrayCliqueGraph(list(range(4)))
+    graph.merge(0, 1)
+    graph.merge(1, 2)
+    draws = {graph.get_random_clique_member(0, exclude=[0]) for _ in range(200)}
+    assert draws == {1, 2}
+    assert graph.get_random_clique_member(0, exclude=[0, 1]) == 2
+    with pytest.raises(IndexError):
+        graph.get_random_clique_member(3, exclude=[3])
+
+
 def test_clique_graph_merge_groups(setup_clique_graph: CliqueGraph[int]) -> None:
     c_graph = setup_clique_graph
     assert not c_graph.is_connected(0, 4), "CliqueGraph negative relationship check failed."
@@ -168,3 +208,29 @@ def test_three_layer_clique_graph_connections(three_layer_clique_graph: MultiLay
     # Check that partitioning works from the top down
     assert ttcg.is_partitioned(111, 211)
     assert ttcg.is_partitioned(111, 212)
+
+
+def test_memoized_adjacency_matches_traversal(three_layer_clique_graph: MultiLayerCliqueGraph[int]) -> None:
+    ttcg = three_layer_clique_graph
+    adjacency = ttcg.adjacency()
+    assert ttcg.adjacency() is adjacency, "Adjacency rebuilt without a change"
+    for root in list(ttcg.union_find.members):
+        assert set(adjacency.adjacent(root)) == ttcg._compute_adjacent_clique_roots(root)
+        if adjacency.adjacent(root):
+            assert ttcg.get_random_adjacent_clique(root) in ttcg._compute_adjacent_clique_roots(root)
+
+
+def test_memoized_adjacency_invalidation(three_layer_clique_graph: MultiLayerCliqueGraph[int]) -> None:
+    ttcg = three_layer_clique_graph
+    second_layer = cast(CliqueGraph[int], ttcg.parent)
+    assert ttcg._get_adjacent_clique_roots(312) == {313}
+
+    second_layer.partition(11, 31)  # NOTE: a partition in the parent layer invalidates the child layer
+    assert ttcg.adjacency().version == ttcg.state_version()
+    assert ttcg._get_adjacent_clique_roots(312) == {111, 313}
+
+    version = ttcg.state_version()
+    second_layer.merge(31, 32)
+    assert ttcg.state_version() != version
+    for root in list(ttcg.union_find.members):
+        assert ttcg._get_adjacent_clique_roots(root) == ttcg._compute_adjacent_clique_roots(root)
@@ -0,0 +1,98 @@
+from pathlib import Path
+from typing import Optional
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from gorillatracker.data.contrastive_sampler import (
+    CliqueGraphSampler,
+    CliqueGroupSampler,
+    ContrastiveClassSampler,
+    ContrastiveImage,
+    group_contrastive_images,
+)
+from gorillatracker.ssl_pipeline.clique_graph_builder import CliqueGraphBuilder
+from gorillatracker.ssl_pipeline.data_structures import IndexedCliqueGraph, MultiLayerCliqueGraph
+from gorillatracker.ssl_pipeline.models import Base
+from gorillatracker.ssl_pipeline.snapshot import SamplerSnapshotCache, database_version
+
+
+def make_images(n: int, trackings: int) -> list[ContrastiveImage]:
+    return [ContrastiveImage(str(100 + i), Path(f"crops/{i}.png"), i % trackings) for i in range(n)]
+
+
+def make_clique_sampler(images: list[ContrastiveImage]) -> CliqueGraphSampler:
+    # NOTE: a two-layer graph of trackings and their images, tracking 3 overlaps with nothing and is pruned
+    first_layer: IndexedCliqueGraph[int] = IndexedCliqueGraph([0, 1, 2, 3])
+    first_layer.partition(0, 1)
+    first_layer.partition(1, 2)
+    parent_edges: dict[ContrastiveImage, Optional[int]] = {img: img.class_label for img in images}
+    second_layer = MultiLayerCliqueGraph(vertices=images, parent=first_layer, parent_edges=parent_edges)
+    for children in second_layer.inverse_parent_edges.values():
+        children_list = list(children)
+        for u, v in zip(children_list, children_list[1:]):
+            second_layer.merge(u, v)
+    second_layer.prune_cliques_without_neighbors()
+    return CliqueGraphSampler(second_layer)
+
+
+def test_class_sampler_round_trip(tmp_path: Path) -> None:
+    images = make_images(12, 3)
+    cache = SamplerSnapshotCache(tmp_path)
+    sampler = ContrastiveClassSampler(group_contrastive_images(images))
+    cache.save("key", "v1", sampler)
+
+    loaded = cache.load("key", "v1")
+    assert isinstance(loaded, ContrastiveClassSampler)
+    assert [loaded[i] for i in range(len(loaded))] == [sampler[i] for i in range(len(sampler))]
+    assert loaded.negative_classes(images[0]) == [1, 2]
+
+
+def test_clique_sampler_round_trip(tmp_path: Path) -> None:
+    images = make_images(16, 4)
+    sampler = make_clique_sampler(images)
+    cache = SamplerSnapshotCache(tmp_path)
+    cache.save("key", "v1", sampler)
+
+    loaded = cache.load("key", "v1")
+    assert isinstance(loaded, CliqueGraphSampler)
+    assert [loaded[i] for i in range(len(loaded))] == [sampler[i] for i in range(len(sampler))]
+    assert all(image.class_label != 3 for image in loaded.graph.vertices)
+    for image in loaded.graph.vertices:
+        assert sorted(loaded.graph.get_clique(image)) == sorted(sampler.graph.get_clique(image))
+        assert sorted(loaded.negative_classes(image)) == sorted(sampler.negative_classes(image))
+        assert loaded.positive(image).class_label == image.class_label
+        assert loaded.negative(image).class_label in loaded.negative_classes(image)
+
+
+def test_clique_group_sampler_round_trip(tmp_path: Path) -> None:
+    builder = CliqueGraphBuilder("video")
+    builder.add_images([(100 + i, i % 4, i % 2) for i in range(12)])
+    builder.add_negatives([(0, 1)])
+    sampler = builder.build(Path("crops"))
+    cache = SamplerSnapshotCache(tmp_path)
+    cache.save("key", "v1", sampler)
+
+    loaded = cache.load("key", "v1")
+    assert isinstance(loaded, CliqueGroupSampler)
+    assert list(loaded) == list(sampler)
+    assert loaded.negative_groups == [(0, 1)]
+    assert loaded.negative_classes(sampler[0]) == sampler.negative_classes(sampler[0]) == [1, 3]
+
+
+def test_other_database_version_invalidates(tmp_path: Path) -> None:
+    images = make_images(4, 2)
+    cache = SamplerSnapshotCache(tmp_path)
+    cache.save("key", "v1", ContrastiveClassSampler(group_contrastive_images(images)))
+
+    assert cache.load("key", "v2") is None
+    assert not cache.path("key").exists()
+    assert cache.load("key", "v1") is None
+
+
+def test_database_version() -> None:
+    engine = create_engine("sqlite:///:memory:").execution_options(schema_translate_map={"public": None})
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        version = database_version(session)
+        assert version == database_version(session)
@@ -0,0 +1,42 @@
+import torch
+
+from gorillatracker.utils.train_embedding_cache import TrainEmbeddingCache
+
+
+def test_refresh_policies() -> None:
+    every_two = TrainEmbeddingCache(policy="every_n_epochs", refresh_every_n_epochs=2)
+    assert every_two.needs_refresh(0)
+    every_two.refresh(torch.zeros(3, 2), torch.tensor([0, 1, 2]), ["a", "b", "c"], epoch=0)
+    assert not every_two.needs_refresh(1) and every_two.needs_refresh(2)
+
+    on_checkpoint = TrainEmbeddingCache(policy="on_checkpoint")
+    on_checkpoint.refresh(torch.zeros(3, 2), torch.tensor([0, 1, 2]), ["a", "b", "c"], epoch=0)
+    assert not on_checkpoint.needs_refresh(5)
+    on_checkpoint.mark_stale()
+    assert on_checkpoint.needs_refresh(5)
+    on_checkpoint.refresh(torch.zeros(3, 2), torch.tensor([0, 1, 2]), ["a", "b", "c"], epoch=5)
+    assert not on_checkpoint.needs_refresh(5)
+
+
+def test_every_epoch_refreshes_every_validation_after_training_steps() -> None:
+    cache = TrainEmbeddingCache(policy="every_n_epochs")
+    assert cache.needs_refresh(0, global_step=0)
+    cache.refresh(torch.zeros(3, 2), torch.tensor([0, 1, 2]), ["a", "b", "c"], epoch=0, global_step=0)
+    assert not cache.needs_refresh(0, global_step=0)  # NOTE: e.g. the next val dataloader of the same validation
+    assert cache.needs_refresh(0, global_step=50)  # NOTE: val_check_interval < 1, same epoch after training steps
+    cache.refresh(torch.ones(3, 2), torch.tensor([0, 1, 2]), ["a", "b", "c"], epoch=0, global_step=50)
+    assert not cache.needs_refresh(0, global_step=50) and cache.needs_refresh(0, global_step=100)
+    assert cache.needs_refresh(0)
+
+
+def test_momentum_update_and_max_size() -> None:
+    cache = TrainEmbeddingCache(policy="momentum", momentum=0.5, max_size=3)
+    assert cache.needs_refresh(0)
+    cache.update(torch.ones(2, 2), torch.tensor([0, 1]), ["a", "b"])
+    cache.update(torch.full((3, 2), 3.0), torch.tensor([0, 2, 3]), ["a", "c", "d"])  # "d" exceeds max_size
+    assert not cache.needs_refresh(10)
+
+    embeddings, labels, ids = cache.get()
+    assert ids == ["a", "b", "c"]
+    assert labels.tolist() == [0, 1, 2]
+    assert torch.equal(embeddings, torch.tensor([[2.0, 2.0], [1.0, 1.0], [3.0, 3.0]]))
@@ -1,9 +1,20 @@
-from typing import Tuple
+from typing import Literal, Tuple
 
+import pytest
 import torch
 from torch.nn import TripletMarginLoss
 
-from gorillatracker.losses.triplet_loss import TripletLossOffline, TripletLossOnline
+from gorillatracker.losses.triplet_loss import (
+    TripletLossOffline,
+    TripletLossOnline,
+    count_valid_triplets,
+    euclidean_distance_matrix,
+    get_cross_video_mask,
+    get_hard_mask,
+    get_semi_hard_mask,
+    get_triplet_mask,
+    masked_triplet_loss,
+)
 
 
 def calc_loss_of_triplet(
@@ -118,8 +129,71 @@ def test_tripletloss_online_semi_hard() -> None:
     assert approx_equal(distance_negative_manual, distance_negative_online_semi_hard)
 
 
+def test_cross_video_mask() -> None:
+    ids = [
+        "AB12_R001_20220101_0.png",
+        "AB12_R001_20220101_1.png",
+        "AB12_R002_20220101_0.png",
+        "CD34_R001_20220101_0.png",
+    ]
+    mask = get_cross_video_mask(tuple(ids))
+    assert mask.shape == (4, 4, 1)
+    expected = torch.tensor(
+        [
+            [False, False, True, True],
+            [False, False, True, True],
+            [True, True, False, True],
+            [True, True, True, False],
+        ]
+    )
+    assert torch.equal(mask.squeeze(2), expected)
+
+
+@pytest.mark.parametrize("mode", ["hard", "semi-hard", "soft"])
+@pytest.mark.parametrize("cross_video_masking", [False, True])
+def test_tripletloss_online_matches_triplet_masks(
+    mode: Literal["hard", "semi-hard", "soft"], cross_video_masking: bool
+) -> None:
+    generator = torch.Generator().manual_seed(0)
+    batch_size = 48
+    labels = torch.randint(0, 6, (batch_size,), generator=generator)
+    videos = torch.randint(0, 3, (batch_size,), generator=generator)
+    ids = tuple(f"AB12_R{video:03d}_20220101_{i}.png" for i, video in enumerate(videos.tolist()))
+    embeddings = torch.randn(batch_size, 16, generator=generator)
+
+    expected_embeddings = embeddings.clone().requires_grad_()
+    distance_matrix = euclidean_distance_matrix(expected_embeddings)
+    if mode == "hard":
+        triplet_mask = get_hard_mask(labels, distance_matrix)
+    elif mode == "semi-hard":
+        triplet_mask = get_semi_hard_mask(labels, distance_matrix, margin=1.0)
+    else:
+        triplet_mask = get_triplet_mask(labels)
+    if cross_video_masking:
+        triplet_mask = torch.logical_and(triplet_mask, get_cross_video_mask(ids))
+    loss_sum, pos_sum, neg_sum, count = masked_triplet_loss(distance_matrix, triplet_mask, margin=1.0, chunk_size=7)
+    expected: tuple[torch.Tensor, ...] = (loss_sum / count, pos_sum / count, neg_sum / count)
+    expected[0].backward()  # type: ignore
+
+    online_embeddings = embeddings.clone().requires_grad_()
+    loss_module = TripletLossOnline(margin=1.0, mode=mode, cross_video_masking=cross_video_masking)
+    actual = loss_module(online_embeddings, labels, ids)
+    actual[0].backward()
+
+    assert count > 0
+    for actual_value, expected_value in zip(actual, expected):
+        torch.testing.assert_close(actual_value, expected_value)
+    torch.testing.assert_close(online_embeddings.grad, expected_embeddings.grad)
+
+
+def test_count_valid_triplets() -> None:
+    labels = torch.tensor([0, 0, 0, 1, 1, 2])
+    assert count_valid_triplets(labels) == get_triplet_mask(labels).sum() == 6 * 3 + 2 * 4
+
+
 if __name__ == "__main__":
     test_tripletloss_offline()
     test_tripletloss_online_soft()
     test_tripletloss_online_hard()
     test_tripletloss_online_semi_hard()
+    test_cross_video_mask()
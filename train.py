@@ -12,8 +12,10 @@ from torchvision.transforms import Compose, Normalize, Resize
 
 from gorillatracker.args import TrainingArgs
 from gorillatracker.data.builder import build_data_module, force_nlet_builder
+from gorillatracker.data.sample_cache import SampleCacheConfig
 from gorillatracker.model.get_model_cls import get_model_cls
 from gorillatracker.ssl_pipeline.ssl_config import SSLConfig
+from gorillatracker.utils.callbacks import BestMetricLogger, DataLoaderThroughputLogger
 from gorillatracker.utils.train import (
     ModelConstructor,
     train_and_validate_model,
@@ -21,7 +23,6 @@ from gorillatracker.utils.train import (
     train_using_quantization_aware_training,
 )
 from gorillatracker.utils.wandb_logger import WandbLoggingModule
-from gorillatracker.utils.callbacks import BestMetricLogger
 
 warnings.filterwarnings("ignore", ".*was configured so validation will run at the end of the training epoch.*")
 warnings.filterwarnings("ignore", ".*Applied workaround for CuDNN issue.*")
@@ -83,10 +84,14 @@ def main(args: TrainingArgs) -> None:
         split_path=args.split_path,
         movement_delta=args.movement_delta,
         forced_train_image_count=args.forced_train_image_count,
+        snapshot_dir=args.ssl_snapshot_dir,
     )
     if args.force_nlet_builder is not None and args.force_nlet_builder != "None":
         force_nlet_builder(args.force_nlet_builder)
 
+    device_augmentation = model_cls.get_batch_augmentation(seed=args.seed) if args.device_augmentation else None
+    assert not args.device_augmentation or device_augmentation is not None, "Model has no batched augmentation"
+
     dm = build_data_module(
         dataset_class_id=args.dataset_class,
         data_dir=args.data_dir,
@@ -99,6 +104,19 @@ def main(args: TrainingArgs) -> None:
         additional_eval_data_dirs=[Path(d) for d in args.additional_val_data_dirs],
         dataset_names=args.dataset_names,
         ssl_config=ssl_config,
+        sample_cache_config=SampleCacheConfig(
+            max_memory_mb=args.sample_cache_memory_mb,
+            store=args.sample_cache_store,
+            store_max_mb=args.sample_cache_store_mb,
+            disk_dir=args.sample_cache_dir,
+        ),
+        train_batch_sampler=args.train_batch_sampler,
+        pk_identities=args.pk_identities,
+        pk_video_diverse=args.pk_video_diverse,
+        seed=args.seed or 0,
+        loader_profile=args.loader_profile,
+        loader_autotune_batches=args.loader_autotune_batches,
+        device_augmentation=device_augmentation,
     )
 
     ################# Construct model ##############
@@ -133,10 +151,12 @@ def main(args: TrainingArgs) -> None:
             max_metric_logger_callback,
             lr_monitor,
             early_stopping,
+            DataLoaderThroughputLogger(),
         ]
         if not args.kfold
         else [
             lr_monitor,
+            DataLoaderThroughputLogger(),
         ]
     )
 